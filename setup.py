@@ -21,5 +21,6 @@ setup(
         'requests >= 2.7.0',
         'roman',
         'dedupe',
+        'numpy',
     ],
 )
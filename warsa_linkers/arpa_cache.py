@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+#  -*- coding: UTF-8 -*-
+"""Persistent on-disk cache of ARPA responses"""
+import atexit
+import hashlib
+import inspect
+import logging
+import os
+import sqlite3
+import time
+
+import requests
+
+log = logging.getLogger(__name__)
+
+CACHE_FILE = 'arpa_cache.sqlite'
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+
+def get_preprocessor_version(preprocessor):
+    """
+    Hash the source of the module defining the preprocessor, so that any change in preprocessing
+    invalidates the cached responses.
+
+    >>> get_preprocessor_version(None)
+    ''
+    >>> len(get_preprocessor_version(get_preprocessor_version))
+    40
+    """
+    if preprocessor is None:
+        return ''
+    try:
+        with open(inspect.getsourcefile(preprocessor), 'rb') as f:
+            source = f.read()
+    except (TypeError, OSError):
+        source = preprocessor.__qualname__.encode('utf-8')
+
+    return hashlib.sha1(source).hexdigest()
+
+
+def pop_cache_args(argv):
+    """
+    Remove cache options from the argument list (in place), as the ARPA argument parser does not know about them.
+
+    :param argv: argument list
+    :return: tuple of cache directory (or None) and maximum cache size in bytes
+
+    >>> argv = ['units.py', 'input.ttl', '--cache-dir', '/tmp/cache', 'output.ttl']
+    >>> pop_cache_args(argv)
+    ('/tmp/cache', 536870912)
+    >>> argv
+    ['units.py', 'input.ttl', 'output.ttl']
+    >>> pop_cache_args(['units.py', '--cache-size', '1000', '--cache-dir', 'cache'])
+    ('cache', 1000)
+    >>> pop_cache_args(['units.py', 'input.ttl'])
+    (None, 536870912)
+    """
+    cache_dir = None
+    max_size = DEFAULT_MAX_SIZE
+
+    for option in ('--cache-dir', '--cache-size'):
+        if option in argv:
+            i = argv.index(option)
+            value = argv[i + 1]
+            del argv[i:i + 2]
+            if option == '--cache-dir':
+                cache_dir = value
+            else:
+                max_size = int(value)
+
+    return cache_dir, max_size
+
+
+class ArpaCache:
+    """
+    Content-addressed ARPA response cache, stored in an SQLite file in the cache directory.
+
+    Responses are keyed by the service URL, preprocessing version and the (preprocessed) query text.
+    When the total size of stored responses exceeds `max_size`, least recently used responses are evicted.
+
+    >>> import tempfile
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> cache = ArpaCache(tmp.name, version='1', max_size=10)
+    >>> cache.get('http://arpa', 'JR 8')
+    >>> cache.put('http://arpa', 'JR 8', b'12345')
+    >>> cache.get('http://arpa', 'JR 8')
+    b'12345'
+    >>> cache.put('http://arpa', 'JR 9', b'123456789')
+    >>> cache.get('http://arpa', 'JR 8')
+    >>> cache.hits, cache.misses
+    (1, 2)
+    >>> cache.close()
+    >>> tmp.cleanup()
+    """
+
+    def __init__(self, cache_dir, version='', max_size=DEFAULT_MAX_SIZE):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CACHE_FILE)
+        self.version = version
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                        '(key TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def make_key(self, url, text):
+        key = hashlib.sha256()
+        for part in (url, self.version, text):
+            key.update(part.encode('utf-8'))
+            key.update(b'\0')
+        return key.hexdigest()
+
+    def get(self, url, text):
+        key = self.make_key(url, text)
+        row = self.db.execute('SELECT body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def put(self, url, text, body):
+        key = self.make_key(url, text)
+        old = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        if old:
+            self.size -= old[0]
+        self.db.execute('INSERT OR REPLACE INTO responses (key, body, size, accessed) VALUES (?, ?, ?, ?)',
+                        (key, body, len(body), time.time()))
+        self.size += len(body)
+        self._evict()
+        self.db.commit()
+
+    def _evict(self):
+        if self.size <= self.max_size:
+            return
+
+        evicted = []
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if self.size <= self.max_size:
+                break
+            evicted.append((key,))
+            self.size -= size
+
+        self.db.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        log.debug('Evicted {} responses from ARPA cache'.format(len(evicted)))
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def log_stats(self):
+        log.info('ARPA cache: {h} hits, {m} misses (hit rate {r:.1%}), {s} bytes in {p}'.format(
+            h=self.hits, m=self.misses, r=self.hit_rate(), s=self.size, p=self.path))
+
+    def close(self):
+        self.log_stats()
+        self.db.commit()
+        self.db.close()
+
+
+def _get_text(data):
+    if isinstance(data, dict):
+        return data.get('text')
+    if isinstance(data, (list, tuple)):
+        return dict(data).get('text')
+    return None
+
+
+def _make_response(url, body):
+    response = requests.models.Response()
+    response._content = body
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response.url = url
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def install(cache):
+    """
+    Route ARPA queries (POST requests with a `text` field) through the cache.
+    Other requests, e.g. SPARQL queries, are passed through untouched.
+
+    The cache is closed at exit, unless it is uninstalled before.
+
+    :param cache: ArpaCache instance
+    :return: function that restores requests.post and closes the cache
+    """
+    post = requests.post
+
+    def cached_post(url, data=None, *args, **kwargs):
+        text = _get_text(data)
+        if text is None:
+            return post(url, data, *args, **kwargs)
+
+        body = cache.get(url, text)
+        if body is not None:
+            return _make_response(url, body)
+
+        response = post(url, data, *args, **kwargs)
+        if response.status_code == 200:
+            cache.put(url, text, response.content)
+        return response
+
+    def uninstall():
+        requests.post = post
+        atexit.unregister(cache.close)
+        cache.close()
+
+    requests.post = cached_post
+    atexit.register(cache.close)
+    return uninstall
+
+
+def setup_cache(argv, preprocessor):
+    """
+    Install an ARPA response cache if `--cache-dir` is given in the arguments.
+
+    :param argv: argument list, cache options are removed from it
+    :param preprocessor: text preprocessor of the linking stage, used for versioning the cache
+    :return: ArpaCache or None
+    """
+    cache_dir, max_size = pop_cache_args(argv)
+    if not cache_dir:
+        return None
+
+    cache = ArpaCache(cache_dir, version=get_preprocessor_version(preprocessor), max_size=max_size)
+    install(cache)
+    log.info('Using ARPA cache {}'.format(cache.path))
+    return cache
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#  -*- coding: UTF-8 -*-
+"""
+Vectorized Jaro-Winkler similarity with NumPy.
+
+Follows the jellyfish reference implementation, so that scores are identical to `jellyfish.jaro_winkler`.
+"""
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+from jellyfish import jaro_winkler
+
+log = logging.getLogger(__name__)
+
+PAD = -1
+
+
+def encode(strings, width=None):
+    """
+    Encode strings into a padded matrix of code points.
+
+    :return: tuple of code point matrix and string lengths
+
+    >>> codes, lengths = encode(['ab', 'c'])
+    >>> codes.tolist(), lengths.tolist()
+    ([[97, 98], [99, -1]], [2, 1])
+    """
+    lengths = np.array([len(s) for s in strings], dtype=np.int64)
+    width = max(width or 0, int(lengths.max()) if len(strings) else 0, 1)
+    codes = np.full((len(strings), width), PAD, dtype=np.int32)
+    for i, s in enumerate(strings):
+        codes[i, :len(s)] = [ord(c) for c in s]
+    return codes, lengths
+
+
+def jaro_winkler_pairs(s1, len1, s2, len2):
+    """
+    Jaro-Winkler similarity of string pairs given as rows of code point matrices.
+
+    :param s1: code point matrix of first strings
+    :param len1: lengths of first strings
+    :param s2: code point matrix of second strings
+    :param len2: lengths of second strings
+    :return: array of similarities
+
+    >>> s1, len1 = encode(['työmies', 'martha', 'abc', '', 'abc', '1234x'])
+    >>> s2, len2 = encode(['työmiez', 'marhta', 'xyz', 'abc', 'abd', '1234y'])
+    >>> jaro_winkler_pairs(s1, len1, s2, len2).round(4).tolist()
+    [0.9429, 0.9611, 0.0, 0.0, 0.7778, 0.8667]
+    """
+    pairs, width1 = s1.shape
+    width2 = s2.shape[1]
+    rows = np.arange(pairs)
+    cols = np.arange(width2)
+
+    search_range = np.maximum(np.maximum(len1, len2) // 2 - 1, 0)[:, None]
+    flags1 = np.zeros((pairs, width1), dtype=bool)
+    flags2 = np.zeros((pairs, width2), dtype=bool)
+
+    # Flag matching characters, in the order of the first string
+    for i in range(width1):
+        active = len1 > i
+        if not active.any():
+            break
+        candidates = (s2 == s1[:, i:i + 1]) & ~flags2 & (np.abs(cols - i) <= search_range) & active[:, None]
+        found = candidates.any(axis=1)
+        first = candidates.argmax(axis=1)
+        flags1[found, i] = True
+        flags2[rows[found], first[found]] = True
+
+    common = flags1.sum(axis=1)
+
+    # Count transpositions by comparing the matched characters in order
+    matched1 = np.take_along_axis(s1, np.argsort(~flags1, axis=1, kind='stable'), axis=1)
+    matched2 = np.take_along_axis(s2, np.argsort(~flags2, axis=1, kind='stable'), axis=1)
+    width = min(width1, width2)
+    in_common = np.arange(width) < common[:, None]
+    transpositions = ((matched1[:, :width] != matched2[:, :width]) & in_common).sum(axis=1) // 2
+
+    common_f = common.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = (common_f / len1 + common_f / len2 + (common_f - transpositions) / common_f) / 3
+    weight = np.where(common > 0, weight, 0.0)
+
+    # Winkler modification for up to four common non-digit prefix characters, only for strings longer than three
+    width = min(4, width1, width2)
+    prefix_eq = (s1[:, :width] == s2[:, :width]) & (np.arange(width) < np.minimum(len1, len2)[:, None])
+    prefix_eq &= (s1[:, :width] < ord('0')) | (s1[:, :width] > ord('9'))
+    prefix = np.cumprod(prefix_eq, axis=1).sum(axis=1)
+    boosted = weight + prefix * 0.1 * (1.0 - weight)
+
+    return np.where((weight > 0.7) & (len1 > 3) & (len2 > 3), boosted, weight)
+
+
+class JaroWinklerScorer:
+    """
+    Batch scorer of query strings against all occupation labels.
+
+    >>> scorer = JaroWinklerScorer([('http://tyomies', 'työmies'), ('http://mv', 'maanviljelijä'),
+    ...                             ('http://tyomies2', 'työmies')])
+    >>> scorer.find_best_match('työmiez')
+    ('http://tyomies', 0.9428571428571428)
+    >>> scorer.find_best_matches(['maanviljelijä', ''])
+    [('http://mv', 1.0), (None, 0)]
+    """
+
+    def __init__(self, occupations, block_size=16):
+        self.uris = [uri for uri, label in occupations]
+        self.labels, self.lengths = encode([label for uri, label in occupations])
+        self.block_size = block_size
+        self.comparisons = 0
+
+    def scores(self, literals):
+        """
+        Score a block of query strings against all labels.
+
+        :return: matrix of similarities, one row per query
+        """
+        queries, query_lengths = encode(literals)
+        n = len(self.uris)
+        b = len(literals)
+
+        s1 = np.tile(self.labels, (b, 1))
+        len1 = np.tile(self.lengths, b)
+        s2 = np.repeat(queries, n, axis=0)
+        len2 = np.repeat(query_lengths, n)
+
+        self.comparisons += n * b
+        return jaro_winkler_pairs(s1, len1, s2, len2).reshape(b, n)
+
+    def _best(self, scores):
+        # argmax returns the first maximum, like a linear scan with strict comparison
+        i = int(scores.argmax())
+        if scores[i] > 0:
+            return self.uris[i], float(scores[i])
+        return None, 0
+
+    def find_best_match(self, occupation_literal):
+        if not self.uris:
+            return None, 0
+        return self._best(self.scores([occupation_literal])[0])
+
+    def find_best_matches(self, literals):
+        results = []
+        if not self.uris:
+            return [(None, 0) for _ in literals]
+        for start in range(0, len(literals), self.block_size):
+            block = self.scores(literals[start:start + self.block_size])
+            results += [self._best(row) for row in block]
+        return results
+
+
+def check_scorer(occupations, literals):
+    """
+    Compare the batch scorer against jellyfish.jaro_winkler for all label and literal pairs.
+
+    :return: maximum absolute difference
+
+    >>> check_scorer([('http://mv', 'mv'), ('http://abd', 'abd'), ('http://1234y', '1234y')],
+    ...              ['mv.', 'abc', '1234x', 'työmies'])
+    0.0
+    """
+    scorer = JaroWinklerScorer(occupations)
+    max_diff = 0.0
+    for start in range(0, len(literals), scorer.block_size):
+        block = literals[start:start + scorer.block_size]
+        scores = scorer.scores(block)
+        for row, literal in zip(scores, block):
+            expected = np.array([jaro_winkler(label, literal) for uri, label in occupations])
+            max_diff = max(max_diff, float(np.abs(row - expected).max()))
+    return max_diff
+
+
+if __name__ == '__main__':
+    from warsa_linkers.occupations import OccupationIndex
+
+    argparser = argparse.ArgumentParser(description='Benchmark occupation matching engines')
+    argparser.add_argument('ontology', help='Occupation ontology as a SPARQL JSON result file (id, label)')
+    argparser.add_argument('literals', help='File of occupation strings, one per line')
+    argparser.add_argument('--loglevel', default='INFO', help='Logging level')
+
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    with open(args.ontology) as f:
+        occupation_do = [(res['id']['value'], res['label']['value']) for res in json.load(f)['results']['bindings']]
+    with open(args.literals) as f:
+        literals = sorted(set(line.strip() for line in f if line.strip()))
+
+    log.info('Max difference to jellyfish: {}'.format(check_scorer(occupation_do, literals)))
+
+    def linear(literal):
+        best_score = 0
+        best_uri = None
+        for uri, label in occupation_do:
+            match_score = jaro_winkler(label, literal)
+            if match_score > best_score:
+                best_uri = uri
+                best_score = match_score
+        return best_uri, best_score
+
+    def indexed():
+        index = OccupationIndex(occupation_do)
+        return [index.find_best_match(lit) for lit in literals]
+
+    engines = [
+        ('linear', lambda: [linear(lit) for lit in literals]),
+        ('index', indexed),
+        ('numpy', lambda: JaroWinklerScorer(occupation_do).find_best_matches(literals)),
+    ]
+
+    reference = None
+    for name, engine in engines:
+        start = time.time()
+        results = engine()
+        log.info('{e}: {n} strings against {o} labels in {t:.2f} s'.format(
+            e=name, n=len(literals), o=len(occupation_do), t=time.time() - start))
+        if reference is None:
+            reference = results
+        elif results != reference:
+            log.warning('{e}: results differ from linear scan'.format(e=name))
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 #  -*- coding: UTF-8 -*-
 """Link WarSampo municipalities"""
+import copy
 import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 from arpa_linker.arpa import process_graph
-from rdflib import URIRef, Graph, Literal
+from rdflib import URIRef, Graph, Literal, RDF
 from rdflib.namespace import SKOS
 
 log = logging.getLogger(__name__)
@@ -251,14 +255,62 @@ MUNICIPALITY_MAPPING = {
 }
 
 
-def link_to_pnr(graph, target_prop, source_prop, arpa, *args, preprocess=True, new_graph=False, **kwargs):
+def get_municipality_label(graph, uri):
+    """
+    Concatenate municipality labels into one string, using current names of merged municipalities.
+
+    :param uri: municipality URI
+
+    >>> g = Graph()
+    >>> g.add((URIRef('bar'), SKOS.prefLabel, Literal('Alatornio')))
+    >>> get_municipality_label(g, URIRef('bar'))
+    'Tornio'
+    """
+    lbls = graph.objects(uri, SKOS.prefLabel)
+    return ' '.join(CURRENT_MUNICIPALITIES.get(str(l), str(l)) for l in lbls)
+
+
+def memoize_arpa_queries(arpa):
+    """
+    Copy an ARPA object so that each distinct query is sent to the service only once.
+
+    :return: the copy, whose query method returns the memoized responses
+
+    >>> from unittest.mock import MagicMock
+    >>> arpa = MagicMock()
+    >>> memo_arpa = memoize_arpa_queries(arpa)
+    >>> _ = memo_arpa.query('Tornio'), memo_arpa.query('Tornio'), memo_arpa.query('Turku')
+    >>> arpa.query.call_count
+    2
+    """
+    query = arpa.query
+    responses = {}
+
+    def memoized_query(text, *args, **kwargs):
+        key = (text, args, tuple(sorted(kwargs.items())))
+        if key not in responses:
+            responses[key] = query(text, *args, **kwargs)
+        return responses[key]
+
+    memo_arpa = copy.copy(arpa)
+    memo_arpa.query = memoized_query
+    return memo_arpa
+
+
+def link_to_pnr(graph, target_prop, source_prop, arpa, *args, preprocess=True, new_graph=False, workers=4,
+                rdf_class=None, progress=True, **kwargs):
     """
     Link municipalities to Paikannimirekisteri.
     :returns dict containing graph and stuff
 
+    Many municipalities share the same query string, so the distinct query strings are first sent to ARPA
+    in `workers` concurrent threads, and process_graph then links each municipality with the memoized responses.
+
     :type graph: rdflib.Graph
     :param target_prop: target property to use for new links
     :param source_prop: source property as URIRef
+    :param workers: number of concurrent ARPA queries
+    :param rdf_class: only link subjects of this class
 
     >>> from unittest.mock import MagicMock
     >>> arpa = MagicMock()
@@ -268,24 +320,37 @@ def link_to_pnr(graph, target_prop, source_prop, arpa, *args, preprocess=True, n
     >>> link_to_pnr(g, 'target', 'source', arpa)['errors']
     []
     """
+    if not source_prop:
+        source_prop = SKOS.prefLabel
 
     def _get_municipality_label(val, uri, *args2):
-        """
-        Concatenate municipality labels into one string
+        return get_municipality_label(graph, uri)
 
-        :param uri: municipality URI
-        """
-        lbls = graph.objects(uri, URIRef('http://www.w3.org/2004/02/skos/core#prefLabel'))
-        return ' '.join(CURRENT_MUNICIPALITIES.get(str(l), str(l)) for l in lbls)
+    preprocessor = _get_municipality_label if preprocess else None
 
-    if preprocess:
-        preprocessor = _get_municipality_label
-    else:
-        preprocessor = None
+    if hasattr(arpa, 'query'):
+        arpa = memoize_arpa_queries(arpa)
+
+        texts = set()
+        for s, val in graph.subject_objects(source_prop):
+            if rdf_class is None or (s, RDF.type, rdf_class) in graph:
+                texts.add(preprocessor(val, s) if preprocessor else str(val))
+
+        log.info('Querying ARPA with {} distinct municipality labels'.format(len(texts)))
+
+        def prefetch(text):
+            try:
+                arpa.query(text)
+            except Exception as e:
+                # process_graph queries again and handles the error for the subject
+                log.warning('Prefetching ARPA results for {} failed: {}'.format(text, e))
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            list(executor.map(prefetch, sorted(texts)))
 
     # Query the ARPA service and add the matches
     return process_graph(graph, target_prop, arpa, new_graph=new_graph, source_prop=source_prop,
-                         preprocessor=preprocessor, progress=True, **kwargs)
+                         rdf_class=rdf_class, preprocessor=preprocessor, progress=progress, **kwargs)
 
 
 def link_warsa_municipality(warsa_munics: Graph, labels: list):
@@ -296,6 +361,8 @@ def link_warsa_municipality(warsa_munics: Graph, labels: list):
     :param labels: Labels of the municipality to be linked
     :return: list of matches
 
+    For linking many municipalities, use WarsaMunicipalityIndex.
+
     >>> warsa_munics = Graph()
     >>> warsa_munics.add((URIRef('http://muni/Espoo'), SKOS.prefLabel, Literal("Espoo", lang='fi')))
     >>> warsa_munics.add((URIRef('http://muni/Turku'), SKOS.prefLabel, Literal("Turku")))
@@ -310,23 +377,37 @@ def link_warsa_municipality(warsa_munics: Graph, labels: list):
     >>> link_warsa_municipality(warsa_munics, ['Uusikaarlepyyn kunta'])
     rdflib.term.URIRef('http://muni/Uusik')
     """
+    def lookup(label):
+        return list(warsa_munics[:SKOS.prefLabel:Literal(label)]) + \
+            list(warsa_munics[:SKOS.prefLabel:Literal(label, lang='fi')])
+
+    return _link_municipality(labels, lookup, MUNICIPALITY_MAPPING)
+
+
+def _link_municipality(labels, lookup, mapping):
+    """
+    Link municipality to Warsa using the given label lookup function.
+
+    :param labels: Labels of the municipality to be linked
+    :param lookup: function returning a list of URIs with the label as an untagged or Finnish prefLabel
+    :param mapping: predefined label -> URI mapping
+    :return: URI of the municipality or None
+    """
     warsa_matches = []
 
     for lbl in labels:
         log.debug('Finding Warsa matches for municipality {}'.format(lbl))
         lbl = str(lbl).strip()
-        munmap_match = MUNICIPALITY_MAPPING.get(lbl)
+        munmap_match = mapping.get(lbl)
         if munmap_match:
             log.debug('Found predefined mapping for {}: {}'.format(lbl, munmap_match))
             warsa_matches += [munmap_match]
         else:
-            warsa_matches += list(warsa_munics[:SKOS.prefLabel:Literal(lbl)])
-            warsa_matches += list(warsa_munics[:SKOS.prefLabel:Literal(lbl, lang='fi')])
+            warsa_matches += lookup(lbl)
 
         if not warsa_matches:
             log.debug('Trying with mlk: {}'.format(lbl))
-            warsa_matches += list(warsa_munics[:SKOS.prefLabel:Literal(lbl.replace(' kunta', ' mlk'))])
-            warsa_matches += list(warsa_munics[:SKOS.prefLabel:Literal(lbl.replace(' kunta', ' mlk'), lang='fi')])
+            warsa_matches += lookup(lbl.replace(' kunta', ' mlk'))
 
     if len(warsa_matches) == 1:
         match = warsa_matches[0]
@@ -341,3 +422,68 @@ def link_warsa_municipality(warsa_munics: Graph, labels: list):
     return None
 
 
+class WarsaMunicipalityIndex:
+    """
+    Label index of Warsa municipalities, for linking many municipalities with dict lookups.
+
+    Labels are matched to untagged and Finnish prefLabels, MUNICIPALITY_MAPPING overrides the labels,
+    and " kunta" is replaced with " mlk" if nothing is found.
+
+    >>> warsa_munics = Graph()
+    >>> warsa_munics.add((URIRef('http://muni/Espoo'), SKOS.prefLabel, Literal("Espoo", lang='fi')))
+    >>> warsa_munics.add((URIRef('http://muni/Turku'), SKOS.prefLabel, Literal("Turku")))
+    >>> warsa_munics.add((URIRef('http://muni/Uusik'), SKOS.prefLabel, Literal("Uusikaarlepyyn mlk", lang='fi')))
+    >>> warsa_munics.add((URIRef('http://muni/Åbo'), SKOS.prefLabel, Literal("Åbo", lang='sv')))
+    >>> index = WarsaMunicipalityIndex(warsa_munics)
+    >>> links = index.link_many([['Espoo', 'Esbo'], ['Åbo', 'Turku'], ['Turku', 'Espoo'], ['Uusikaarlepyyn kunta']])
+    >>> [str(link) if link else link for link in links]
+    ['http://muni/Espoo', 'http://muni/Turku', None, 'http://muni/Uusik']
+    >>> index.link(['Kemi'])
+    rdflib.term.URIRef('http://ldf.fi/warsa/places/municipalities/m_place_20')
+    """
+
+    def __init__(self, warsa_munics: Graph, mapping=None):
+        """
+        :param warsa_munics: Municipality graph for retrieving labels
+        :param mapping: predefined label -> URI mapping, by default MUNICIPALITY_MAPPING
+        """
+        self.mapping = MUNICIPALITY_MAPPING if mapping is None else mapping
+        self.plain = defaultdict(list)
+        self.finnish = defaultdict(list)
+
+        for uri, label in warsa_munics.subject_objects(SKOS.prefLabel):
+            if not isinstance(label, Literal):
+                continue
+            if label.language is None and label.datatype is None:
+                self.plain[str(label)].append(uri)
+            elif label.language == 'fi':
+                self.finnish[str(label)].append(uri)
+
+        log.debug('Indexed {} municipality labels'.format(len(self.plain) + len(self.finnish)))
+
+    def lookup(self, label):
+        """
+        :return: list of URIs with the label as an untagged or Finnish prefLabel
+        """
+        return self.plain.get(label, []) + self.finnish.get(label, [])
+
+    def link(self, labels):
+        """
+        Link municipality to Warsa
+
+        :param labels: Labels of the municipality to be linked
+        :return: URI of the municipality or None
+        """
+        return _link_municipality(labels, self.lookup, self.mapping)
+
+    def link_many(self, label_lists):
+        """
+        Link many municipalities to Warsa.
+
+        :param label_lists: list of label lists, one for each municipality
+        :return: list of URIs (or None)
+        """
+        links = [self.link(labels) for labels in label_lists]
+        log.info('Found Warsa URIs for {n} of {m} municipalities'.format(
+            n=sum(1 for link in links if link is not None), m=len(links)))
+        return links
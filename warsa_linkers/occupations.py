@@ -2,19 +2,36 @@
 #  -*- coding: UTF-8 -*-
 """Link occupation strings to WarSampo occupation ontology"""
 import argparse
+import gzip
+import hashlib
+import json
 import logging
 import operator
+import os
 import re
+import sqlite3
 
 import sys
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 import requests
 from collections import defaultdict
+from multiprocessing import Pool
 
 from jellyfish import jaro_winkler
 from rdflib import Graph, URIRef, RDF
 from rdflib.util import guess_format
 
+try:
+    from rdflib.plugins.parsers.ntriples import W3CNTriplesParser as NTriplesLineParser
+except ImportError:
+    from rdflib.plugins.parsers.ntriples import NTriplesParser as NTriplesLineParser
+
 log = logging.getLogger(__name__)
 
 occupation_mapping = {
@@ -271,12 +288,106 @@ occupation_substitutions = [
 ]
 
 
+def _literal_runs(parsed):
+    """
+    Literal character runs that any match of a parsed regular expression must contain, in order.
+    A run at index 0 is a prefix if the expression is anchored.
+    """
+    runs = [[]]
+    for i, (op, av) in enumerate(parsed):
+        if op == sre_parse.LITERAL:
+            runs[-1].append(chr(av))
+        elif op == sre_parse.SUBPATTERN:
+            inner = _literal_runs(av[-1])
+            runs[-1].extend(inner[0])
+            runs.extend(inner[1:])
+        elif not (i == 0 and op == sre_parse.AT and av == sre_parse.AT_BEGINNING):
+            runs.append([])
+    return runs
+
+
+def _prefilter(pattern):
+    """
+    Cheap test for whether a substitution pattern can match a string: a required prefix for patterns
+    anchored with ^, otherwise the longest literal substring every match contains.
+
+    :return: tuple (prefix, substring)
+
+    >>> _prefilter(r'^(mv\\.?)(.+)')
+    ('mv', '')
+    >>> _prefilter(r'(.+)(työntek\\.)')
+    ('', 'työntek.')
+    >>> _prefilter(r'(.+)(\\.| )(p|(pka))($|\\.)')
+    ('', '')
+    """
+    parsed = list(sre_parse.parse(pattern))
+    anchored = bool(parsed) and parsed[0] == (sre_parse.AT, sre_parse.AT_BEGINNING)
+    runs = _literal_runs(parsed)
+    if anchored and runs[0]:
+        return ''.join(runs[0]), ''
+    return '', max((''.join(run) for run in runs if run), key=len, default='')
+
+
+class SubstitutionRewriter:
+    """
+    Ordered list of regular expression substitutions, compiled once.
+
+    Each substitution is only tried if its literal prefix or required substring occurs in the value,
+    and results are memoized per value.
+
+    >>> rewriter = SubstitutionRewriter([(r'^(mv\\.?)(.+)', r'maanviljelijän\\2'), (r'(.*)(pka)($|\\.)', r'\\1poika')])
+    >>> rewriter('mv.pka')
+    'maanviljelijänpoika'
+    >>> rewriter('mv.pka') in rewriter.memo.values()
+    True
+    """
+
+    def __init__(self, subs):
+        self.subs = [(re.compile(pattern), repl) + _prefilter(pattern) for pattern, repl in subs]
+        self.memo = {}
+
+    def rewrite(self, value):
+        for regex, repl, prefix, substring in self.subs:
+            if prefix:
+                if not value.startswith(prefix):
+                    continue
+            elif substring not in value:
+                continue
+            value = regex.sub(repl, value)
+        return value
+
+    def __call__(self, value):
+        result = self.memo.get(value)
+        if result is None:
+            result = self.memo[value] = self.rewrite(value)
+        return result
+
+
+_rewriters = {}
+
+
+def get_rewriter(subs):
+    """
+    Get a compiled SubstitutionRewriter for a list of (pattern, replacement) tuples.
+    """
+    if isinstance(subs, SubstitutionRewriter):
+        return subs
+
+    key = tuple(tuple(sub) for sub in subs)
+    rewriter = _rewriters.get(key)
+    if rewriter is None:
+        rewriter = _rewriters[key] = SubstitutionRewriter(key)
+    return rewriter
+
+
 def _harmonize_labels(literal, sep, valuemap, subs):
     literal = str(literal).strip()
 
     if literal == '-':
         return ''
 
+    rewrite = get_rewriter(subs)
+
     processed = []
     for s in re.split(sep, literal):
         if not s:
@@ -286,9 +397,7 @@ def _harmonize_labels(literal, sep, valuemap, subs):
         if s in valuemap:
             value = valuemap[s]
         else:
-            value = s
-            for sub in subs:
-                value = re.sub(sub[0], sub[1], value)
+            value = rewrite(s)
 
         if value:
             processed.append(value)
@@ -296,12 +405,380 @@ def _harmonize_labels(literal, sep, valuemap, subs):
     return processed
 
 
+def _common_prefix_length(s1, s2):
+    i = 0
+    for c1, c2 in zip(s1, s2):
+        if c1 != c2:
+            break
+        i += 1
+    return i
+
+
+def _jaro_winkler_bound(len1, len2, prefix):
+    """
+    Upper bound of Jaro-Winkler similarity for strings of given lengths and common prefix length (max 4).
+
+    >>> _jaro_winkler_bound(10, 10, 4) >= jaro_winkler('työmies  x', 'työmies  x')
+    True
+    >>> _jaro_winkler_bound(3, 12, 0) >= jaro_winkler('mv.', 'maanviljelijä')
+    True
+    """
+    jaro = (2 + min(len1, len2) / max(len1, len2)) / 3
+    return jaro + prefix * 0.1 * (1.0 - jaro)
+
+
+class OccupationIndex:
+    """
+    Occupation labels bucketed by length and first characters, for finding the most similar label
+    without comparing against every label. Buckets whose Jaro-Winkler upper bound (implied by
+    the length difference and common prefix) is below the best score found so far are skipped.
+
+    The result is the same as with a linear scan: the first label in the original order with the highest score.
+
+    >>> index = OccupationIndex([('http://tyomies', 'työmies'), ('http://mv', 'maanviljelijä'),
+    ...                          ('http://tyomies2', 'työmies')])
+    >>> index.find_best_match('työmiez')
+    ('http://tyomies', 0.9428571428571428)
+    >>> index.find_best_match('')
+    (None, 0)
+    """
+    EPSILON = 1e-9
+
+    def __init__(self, occupations):
+        buckets = defaultdict(lambda: defaultdict(list))
+        for i, (uri, label) in enumerate(occupations):
+            buckets[len(label)][label[:4]].append((i, uri, label))
+
+        self.buckets = {length: list(prefixes.items()) for length, prefixes in buckets.items()}
+        self.comparisons = 0
+
+    def find_best_match(self, occupation_literal):
+        best_score = 0
+        best_index = None
+        best_uri = None
+
+        literal_len = len(occupation_literal)
+        if not literal_len:
+            return best_uri, best_score
+
+        literal_prefix = occupation_literal[:4]
+        lengths = sorted(self.buckets, key=lambda length: -min(length, literal_len) / max(length, literal_len))
+
+        for length in lengths:
+            if _jaro_winkler_bound(length, literal_len, 4) + self.EPSILON < best_score:
+                break
+
+            prefixes = sorted(((_common_prefix_length(prefix, literal_prefix), labels)
+                               for prefix, labels in self.buckets[length]), key=lambda x: -x[0])
+
+            for prefix_len, labels in prefixes:
+                if _jaro_winkler_bound(length, literal_len, prefix_len) + self.EPSILON < best_score:
+                    break
+
+                for i, uri, label in labels:
+                    self.comparisons += 1
+                    match_score = jaro_winkler(label, occupation_literal)
+                    if match_score > best_score or match_score == best_score and best_index is not None \
+                            and i < best_index:
+                        best_uri = uri
+                        best_score = match_score
+                        best_index = i
+
+        return best_uri, best_score
+
+
+def get_occupation_matcher(occupations, engine='index'):
+    """
+    Create a string similarity matcher for the occupation ontology.
+
+    :param occupations: list of (URI, label) tuples
+    :param engine: 'index' (pruned label index) or 'numpy' (vectorized batch scorer)
+    """
+    if engine == 'numpy':
+        from warsa_linkers.batch_jaro_winkler import JaroWinklerScorer
+        return JaroWinklerScorer(occupations)
+    elif engine == 'index':
+        return OccupationIndex(occupations)
+
+    raise ValueError('Invalid engine: {}'.format(engine))
+
+
+_worker_matcher = None
+
+
+def _init_worker_matcher(occupations, engine):
+    global _worker_matcher
+    _worker_matcher = get_occupation_matcher(occupations, engine)
+
+
+def _find_best_match(occupation):
+    return _worker_matcher.find_best_match(occupation)
+
+
+def match_occupations(occupations, occupation_do, engine='index', processes=None):
+    """
+    Find the best matching ontology label for each occupation string.
+
+    :param occupations: list of distinct occupation strings
+    :param occupation_do: list of (URI, label) tuples of the occupation ontology
+    :param engine: string similarity engine
+    :param processes: number of worker processes, None to match in this process
+    :return: list of (URI, score) tuples
+    """
+    if not occupations:
+        return []
+
+    if processes and processes > 1:
+        chunksize = max(1, len(occupations) // (processes * 4))
+        with Pool(processes, initializer=_init_worker_matcher, initargs=(occupation_do, engine)) as pool:
+            return pool.map(_find_best_match, occupations, chunksize=chunksize)
+
+    matcher = get_occupation_matcher(occupation_do, engine)
+    if hasattr(matcher, 'find_best_matches'):
+        matches = matcher.find_best_matches(occupations)
+    else:
+        matches = [matcher.find_best_match(occupation) for occupation in occupations]
+
+    log.debug('Compared {c} label pairs for {n} distinct occupations'.format(
+        c=matcher.comparisons, n=len(occupations)))
+
+    return matches
+
+
+OCCUPATION_QUERY = """
+    PREFIX text: <http://jena.apache.org/text#>
+    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+    SELECT ?id ?label {{
+        GRAPH <http://ldf.fi/warsa/occupations> {{
+            ?id a <http://ldf.fi/schema/ammo/Concept> .
+            ?id skos:prefLabel|skos:altLabel ?label .
+        }}
+     }}
+"""
+
+OCCUPATION_FINGERPRINT_QUERY = """
+    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+    PREFIX dct: <http://purl.org/dc/terms/>
+    SELECT (COUNT(?label) AS ?count) (MAX(?modified) AS ?modified) {
+        GRAPH <http://ldf.fi/warsa/occupations> {
+            ?id a <http://ldf.fi/schema/ammo/Concept> .
+            ?id skos:prefLabel|skos:altLabel ?label .
+            OPTIONAL { ?id dct:modified ?modified . }
+        }
+    }
+"""
+
+
+def read_snapshot(path):
+    """
+    Read a local occupation ontology snapshot.
+
+    :param path: snapshot file (gzipped JSON with one column for URIs and one for labels)
+    :return: tuple of fingerprint and list of (URI, label) tuples
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        data = json.load(f)
+
+    uris = data['uris']
+    return data['fingerprint'], [(uris[i], label) for i, label in zip(data['uri_index'], data['labels'])]
+
+
+def write_snapshot(path, fingerprint, occupations):
+    """
+    Write a local occupation ontology snapshot. URIs are stored once, with an index column for the labels.
+
+    :param path: snapshot file
+    :param fingerprint: fingerprint of the ontology version
+    :param occupations: list of (URI, label) tuples
+    """
+    uri_index = {}
+    for uri, label in occupations:
+        uri_index.setdefault(uri, len(uri_index))
+
+    data = {
+        'fingerprint': fingerprint,
+        'uris': list(uri_index),
+        'uri_index': [uri_index[uri] for uri, label in occupations],
+        'labels': [label for uri, label in occupations],
+    }
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+
+    log.info('Wrote {n} occupation labels to snapshot {p}'.format(n=len(occupations), p=path))
+
+
+def get_ontology_fingerprint(endpoint):
+    """
+    Get a cheap fingerprint of the occupation ontology: label count and latest modification time.
+    """
+    results = requests.post(endpoint, {'query': OCCUPATION_FINGERPRINT_QUERY}).json()
+    row = results['results']['bindings'][0]
+    return '{count}|{modified}'.format(count=row['count']['value'],
+                                       modified=row.get('modified', {}).get('value', ''))
+
+
+def get_occupation_ontology(endpoint, snapshot=None):
+    """
+    Get the labels of the occupation ontology from the endpoint, or from a local snapshot file.
+
+    The snapshot is refreshed only when the ontology fingerprint has changed. If the endpoint is not
+    reachable, an existing snapshot is used as is.
+
+    :param endpoint: SPARQL endpoint
+    :param snapshot: snapshot file, None to always query the endpoint
+    :return: list of (URI, label) tuples
+    """
+    if snapshot is None:
+        results = requests.post(endpoint, {'query': OCCUPATION_QUERY}).json()
+        return [(res['id']['value'], res['label']['value']) for res in results['results']['bindings']]
+
+    snapshot_fingerprint, occupations = read_snapshot(snapshot) if os.path.exists(snapshot) else (None, None)
+
+    try:
+        fingerprint = get_ontology_fingerprint(endpoint)
+    except requests.exceptions.RequestException as e:
+        if occupations is None:
+            raise
+        log.warning('Could not get ontology fingerprint, using snapshot {p}: {e}'.format(p=snapshot, e=e))
+        return occupations
+
+    if fingerprint != snapshot_fingerprint:
+        log.info('Occupation ontology changed ({old} -> {new}), refreshing snapshot'.format(
+            old=snapshot_fingerprint, new=fingerprint))
+        occupations = get_occupation_ontology(endpoint)
+        write_snapshot(snapshot, fingerprint, occupations)
+
+    return occupations
+
+
+def ontology_version(occupations):
+    """
+    Hash of the occupation ontology labels. Label order matters, as ties are resolved by it.
+
+    >>> ontology_version([('http://a', 'a')]) == ontology_version([('http://a', 'a')])
+    True
+    >>> a, b = ('http://a', 'a'), ('http://b', 'b')
+    >>> ontology_version([a, b]) == ontology_version([b, a])
+    False
+    """
+    version = hashlib.sha1()
+    for uri, label in occupations:
+        version.update('{}\0{}\0'.format(uri, label).encode('utf-8'))
+    return version.hexdigest()
+
+
+class OccupationMemo:
+    """
+    Persistent memo of harmonized occupation string -> best match (URI, score), stored in an SQLite file.
+
+    Matches are keyed by the ontology version and score threshold, so the same memo file can be shared by
+    all datasets.
+
+    >>> import os, tempfile
+    >>> tmpdir = tempfile.TemporaryDirectory()
+    >>> memo = OccupationMemo(os.path.join(tmpdir.name, 'memo.sqlite'), 'v1', 0.88)
+    >>> memo.put_many({'työmies': ('http://tyomies', 1.0), 'x': (None, 0)})
+    >>> memo.get_many(['työmies', 'x', 'y'])
+    {'työmies': ('http://tyomies', 1.0), 'x': (None, 0.0)}
+    >>> other = OccupationMemo(memo.path, 'v2', 0.88)
+    >>> other.get_many(['työmies'])
+    {}
+    >>> other.close(); memo.close(); tmpdir.cleanup()
+    """
+
+    # Number of occupations per query, below the SQLite limit of query parameters
+    BATCH_SIZE = 500
+
+    def __init__(self, path, version, score_threshold):
+        self.path = path
+        self.version = version
+        self.score_threshold = score_threshold
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS occupation_matches '
+                        '(version TEXT NOT NULL, threshold REAL NOT NULL, occupation TEXT NOT NULL, uri TEXT, '
+                        'score REAL NOT NULL, PRIMARY KEY (version, threshold, occupation))')
+
+    def get_many(self, occupations):
+        found = {}
+        occupations = list(occupations)
+        for start in range(0, len(occupations), self.BATCH_SIZE):
+            batch = occupations[start:start + self.BATCH_SIZE]
+            rows = self.db.execute('SELECT occupation, uri, score FROM occupation_matches '
+                                   'WHERE version = ? AND threshold = ? AND occupation IN ({})'.format(
+                                       ', '.join('?' * len(batch))),
+                                   [self.version, self.score_threshold] + batch)
+            for occupation, uri, score in rows:
+                found[occupation] = (uri, score)
+        return {occupation: found[occupation] for occupation in occupations if occupation in found}
+
+    def put_many(self, matches):
+        self.db.executemany('INSERT OR REPLACE INTO occupation_matches (version, threshold, occupation, uri, score) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            [(self.version, self.score_threshold, occupation, uri, score)
+                             for occupation, (uri, score) in matches.items()])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def _match_distinct(originals, occupation_do, score_threshold, engine, processes, memo=None):
+    """
+    Match distinct harmonized occupation strings and apply the score threshold.
+
+    :param originals: dict of harmonized occupation string -> original literal (for logging)
+    :param memo: path of a persistent OccupationMemo file, None for no memo
+    :return: dict of harmonized occupation string -> URI or None
+    """
+    start = time.time()
+    linked_values = {}
+    occupations = list(originals)
+
+    if memo:
+        memo = OccupationMemo(memo, ontology_version(occupation_do), score_threshold)
+        matches = memo.get_many(occupations)
+        unseen = [occupation for occupation in occupations if occupation not in matches]
+        log.info('Found {m} of {n} distinct occupation strings in memo'.format(m=len(matches), n=len(occupations)))
+        new_matches = dict(zip(unseen, match_occupations(unseen, occupation_do, engine=engine, processes=processes)))
+        memo.put_many(new_matches)
+        memo.close()
+        matches.update(new_matches)
+        matches = [matches[occupation] for occupation in occupations]
+    else:
+        matches = match_occupations(occupations, occupation_do, engine=engine, processes=processes)
+
+    for occupation, (uri, score) in zip(occupations, matches):
+        if uri and score > score_threshold:
+            linked_values[occupation] = uri
+            log.debug('Accepted match for occupation {o} ({orig}): {uri} (score {s:.2f})'.format(
+                o=occupation, orig=originals[occupation], uri=uri, s=score))
+        else:
+            linked_values[occupation] = None
+            if uri:
+                log.debug('No match found for occupation {o} ({orig}) (best match {uri} - score {s:.2f})'.format(
+                    o=occupation, orig=originals[occupation], uri=uri, s=score))
+
+    log.info('Matched {n} distinct occupation strings in {s:.2f} s'.format(n=len(occupations), s=time.time() - start))
+
+    return linked_values
+
+
+def _log_unlinked(unlinked_occupations):
+    for literal, count in sorted(unlinked_occupations.items(), key=operator.itemgetter(1, 0)):
+        log.warning('No URI found for occupation: {o}  ({c})'.format(o=literal, c=count))
+
+
 def link_occupations(graph, endpoint, source_property: URIRef, target_property: URIRef, resource_type: URIRef,
-                     sep=r'[,/]', score_threshold=0.88, subs=occupation_substitutions, valuemap=occupation_mapping):
+                     sep=r'[,/]', score_threshold=0.88, subs=occupation_substitutions, valuemap=occupation_mapping,
+                     engine='index', processes=None, snapshot=None, memo=None):
     """
     Link occupations in graph based on string similarity. Each property value is compared against all values in
     the occupation ontology.
 
+    Linking is done in three phases: distinct harmonized occupation strings are collected, then matched
+    (optionally in a process pool), and the matches are fanned out to the persons.
+
     :param graph: Data in RDFLib Graph object
     :param endpoint: SPARQL endpoint
     :param source_property: Source property for linking
@@ -311,75 +788,136 @@ def link_occupations(graph, endpoint, source_property: URIRef, target_property:
     :param score_threshold: score threshold for linking occupations based on string similarity
     :param subs: Regular expression substitutions for value harmonization as a list of tuples
     :param valuemap: dictionary for direct mapping of values
+    :param engine: string similarity engine, 'index' (pruned label index) or 'numpy' (vectorized batch scorer)
+    :param processes: number of processes for matching occupation strings, None for no process pool
+    :param snapshot: local occupation ontology snapshot file, None to always query the endpoint
+    :param memo: persistent occupation match memo file shared across runs, None for no memo
     :return: RDFLib Graph with updated links
     """
 
-    query = """
-        PREFIX text: <http://jena.apache.org/text#>
-        PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-        SELECT ?id ?label {{
-            GRAPH <http://ldf.fi/warsa/occupations> {{
-                ?id a <http://ldf.fi/schema/ammo/Concept> .
-                ?id skos:prefLabel|skos:altLabel ?label .
-            }}
-         }}
-    """
+    occupation_do_tuples = get_occupation_ontology(endpoint, snapshot)
+    log.debug('Got {} occupations'.format(len(occupation_do_tuples)))
 
-    def find_best_match(occupation_do, occupation_literal):
-        best_score = 0
-        best_uri = None
+    links = Graph()
 
-        for uri, label in occupation_do:
-            match_score = jaro_winkler(label, occupation_literal)
-            if match_score > best_score:
-                best_uri = uri
-                best_score = match_score
+    subs = get_rewriter(subs)
 
-        return best_uri, best_score
+    # Collect distinct harmonized occupation strings
+    start = time.time()
+    person_occupations = []
+    originals = {}
+    for person in graph[:RDF.type:resource_type]:
+        for literal in graph.objects(person, source_property):
+            for occupation in _harmonize_labels(literal, sep, valuemap, subs):
+                person_occupations.append((person, occupation))
+                originals.setdefault(occupation, literal)
+
+    log.info('Collected {d} distinct of {t} occupation strings ({r:.1%}) in {s:.2f} s'.format(
+        d=len(originals), t=len(person_occupations), r=len(originals) / max(len(person_occupations), 1),
+        s=time.time() - start))
+
+    linked_values = _match_distinct(originals, occupation_do_tuples, score_threshold, engine, processes, memo)
 
-    def get_occupation_link(occupation_do, linked_occupations, occupation_str, original):
-        if occupation_str in linked_occupations:
-            uri = linked_values[occupation_str]
+    # Fan out the matches to persons
+    start = time.time()
+    unlinked_occupations = defaultdict(int)
+
+    for person, occupation in person_occupations:
+        occupation_uri = linked_values[occupation]
+        if occupation_uri:
+            links.add((person, target_property, URIRef(occupation_uri)))
         else:
-            uri, score = find_best_match(occupation_do, occupation_str)
-            if uri and occupation_str not in linked_occupations:
-                if score > score_threshold:
-                    linked_occupations[occupation_str] = uri
-                    log.debug('Accepted match for occupation {o} ({orig}): {uri} (score {s:.2f})'.format(
-                        o=occupation_str, orig=original, uri=uri, s=score))
-                else:
-                    linked_occupations[occupation_str] = None
-                    log.debug('No match found for occupation {o} ({orig}) (best match {uri} - score {s:.2f})'.format(
-                        o=occupation_str, orig=original, uri=uri, s=score))
-                    uri = None
-
-        return uri
-
-    results = requests.post(endpoint, {'query': query}).json()
+            unlinked_occupations[occupation] += 1
 
-    links = Graph()
-    linked_values = {}
+    log.info('Added {n} occupation links in {s:.2f} s'.format(n=len(links), s=time.time() - start))
+
+    _log_unlinked(unlinked_occupations)
 
-    occupation_do_tuples = [(res['id']['value'], res['label']['value']) for res in results['results']['bindings']]
+    return links
+
+
+class _TripleSink:
+    def __init__(self, handler):
+        self.triple = handler
+
+
+def _read_ntriples(path, handler):
+    """
+    Parse an N-Triples file one line at a time, calling handler(s, p, o) for each triple.
+    """
+    with open(path, 'rb') as f:
+        NTriplesLineParser(_TripleSink(handler)).parse(f)
+
+
+def link_occupations_ntriples(input_path, output, endpoint, source_property: URIRef, target_property: URIRef,
+                              resource_type: URIRef, sep=r'[,/]', score_threshold=0.88, subs=occupation_substitutions,
+                              valuemap=occupation_mapping, engine='index', processes=None, snapshot=None,
+                              memo=None):
+    """
+    Link occupations in an N-Triples file without loading it into a graph.
+
+    The input is read twice: first to collect the resources of the given class and the distinct occupation
+    strings, then to write the links to the output file as they are found. Memory use depends on the number
+    of resources and distinct occupation strings, not on the size of the input.
+
+    If a resource has several occupation values linked to the same URI, the output may contain duplicate triples.
+
+    :param input_path: N-Triples input file
+    :param output: writable text file for N-Triples output
+    :return: number of link triples written
+
+    Other parameters are as in link_occupations.
+    """
+    occupation_do_tuples = get_occupation_ontology(endpoint, snapshot)
     log.debug('Got {} occupations'.format(len(occupation_do_tuples)))
 
+    subs = get_rewriter(subs)
+
+    start = time.time()
+    resources = set()
+    originals = {}
+
+    def collect(s, p, o):
+        if p == RDF.type and o == resource_type:
+            resources.add(s)
+        elif p == source_property:
+            for occupation in _harmonize_labels(o, sep, valuemap, subs):
+                originals.setdefault(occupation, o)
+
+    _read_ntriples(input_path, collect)
+
+    log.info('Collected {d} distinct occupation strings of {r} resources in {s:.2f} s'.format(
+        d=len(originals), r=len(resources), s=time.time() - start))
+
+    linked_values = _match_distinct(originals, occupation_do_tuples, score_threshold, engine, processes, memo)
+
+    start = time.time()
     unlinked_occupations = defaultdict(int)
+    written = 0
+    predicate = target_property.n3()
 
-    for person in graph[:RDF.type:resource_type]:
-        literals = graph.objects(person, source_property)
-        for literal in literals:
-            harmonized = _harmonize_labels(literal, sep, valuemap, subs)
-            for occupation in harmonized:
-                occupation_uri = get_occupation_link(occupation_do_tuples, linked_values, occupation, literal)
-                if occupation_uri:
-                    links.add((person, target_property, URIRef(occupation_uri)))
-                else:
-                    unlinked_occupations[occupation] += 1
+    def write_links(s, p, o):
+        nonlocal written
+        if p != source_property or s not in resources:
+            return
+        uris = set()
+        for occupation in _harmonize_labels(o, sep, valuemap, subs):
+            occupation_uri = linked_values[occupation]
+            if occupation_uri:
+                uris.add(occupation_uri)
+            else:
+                unlinked_occupations[occupation] += 1
+        for occupation_uri in sorted(uris):
+            output.write('{s} {p} {o} .\n'.format(s=s.n3(), p=predicate, o=URIRef(occupation_uri).n3()))
+            written += 1
 
-    for literal, count in sorted(unlinked_occupations.items(), key=operator.itemgetter(1, 0)):
-        log.warning('No URI found for occupation: {o}  ({c})'.format(o=literal, c=count))
+    _read_ntriples(input_path, write_links)
 
-    return links
+    log.info('Wrote {n} occupation links in {s:.2f} s'.format(n=written, s=time.time() - start))
+
+    _log_unlinked(unlinked_occupations)
+
+    return written
 
 
 if __name__ == '__main__':
@@ -396,16 +934,39 @@ if __name__ == '__main__':
     argparser.add_argument("target_prop", help="Target property")
     argparser.add_argument("res_class", help="Resource class")
     argparser.add_argument("endpoint", help="SPARQL Endpoint")
+    argparser.add_argument("--engine", default='index', choices=['index', 'numpy'], help="String similarity engine")
+    argparser.add_argument("--processes", default=None, type=int, help="Number of processes for matching")
+    argparser.add_argument("--snapshot", default=None, help="Local occupation ontology snapshot file")
+    argparser.add_argument("--memo", default=None, help="Persistent occupation match memo file shared across runs")
+    argparser.add_argument("--stream", action='store_true',
+                           help="Stream N-Triples input to N-Triples output without loading the input graph")
 
     args = argparser.parse_args()
 
-    input_graph = Graph()
-    input_graph.parse(args.input, format=guess_format(args.input))
-
-    links = link_occupations(input_graph,
-                             args.endpoint,
-                             URIRef(args.source_prop),
-                             URIRef(args.target_prop),
-                             URIRef(args.res_class))
-
-    links.serialize(args.output, format=guess_format(args.output))
+    if args.stream:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            link_occupations_ntriples(args.input,
+                                      output,
+                                      args.endpoint,
+                                      URIRef(args.source_prop),
+                                      URIRef(args.target_prop),
+                                      URIRef(args.res_class),
+                                      engine=args.engine,
+                                      processes=args.processes,
+                                      snapshot=args.snapshot,
+                                      memo=args.memo)
+    else:
+        input_graph = Graph()
+        input_graph.parse(args.input, format=guess_format(args.input))
+
+        links = link_occupations(input_graph,
+                                 args.endpoint,
+                                 URIRef(args.source_prop),
+                                 URIRef(args.target_prop),
+                                 URIRef(args.res_class),
+                                 engine=args.engine,
+                                 processes=args.processes,
+                                 snapshot=args.snapshot,
+                                 memo=args.memo)
+
+        links.serialize(args.output, format=guess_format(args.output))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#  -*- coding: UTF-8 -*-
+"""
+Deterministic blocking for person record linkage.
+
+Document records are only compared with WarSampo persons that share a phonetic key of the family name and
+whose birth or death years are within a window of the document's years. Persons whose dates cannot be compared
+with the document's dates are kept as candidates, so missing dates do not prevent linking.
+"""
+import logging
+import re
+from collections import defaultdict
+from datetime import date
+
+from jellyfish import soundex
+
+log = logging.getLogger(__name__)
+
+PHONETIC_TRANSLATION = str.maketrans('wzäåöüé', 'vsaaoye')
+
+
+def family_keys(family):
+    """
+    Phonetic keys of the parts of a family name.
+
+    >>> sorted(family_keys('Herka Hägglund'))
+    ['H245', 'H620']
+    >>> family_keys('Wirtanen') == family_keys('Virtanen')
+    True
+    >>> family_keys(None)
+    set()
+    """
+    if not family:
+        return set()
+    return {soundex(part) for part in re.split(r'[\s\-]+', family.lower().translate(PHONETIC_TRANSLATION)) if part}
+
+
+def record_years(record, begin_field, end_field):
+    """
+    Years of a date range field pair of a record.
+
+    >>> sorted(record_years({'birth_begin': '1896-10-05', 'birth_end': '1897-01-01'}, 'birth_begin', 'birth_end'))
+    [1896, 1897]
+    >>> record_years({'birth_begin': None, 'birth_end': None}, 'birth_begin', 'birth_end')
+    set()
+    >>> record_years({'death_begin': 709758, 'death_end': None}, 'death_begin', 'death_end')
+    {1944}
+    """
+    return {date.fromordinal(value).year if isinstance(value, int) else int(str(value)[:4])
+            for value in (record.get(begin_field), record.get(end_field)) if value}
+
+
+def _percentiles(sizes):
+    if not sizes:
+        return 'no blocks'
+    sizes = sorted(sizes)
+    return 'min {mi}, median {me}, p90 {p90}, p99 {p99}, max {ma}'.format(
+        mi=sizes[0], me=sizes[len(sizes) // 2], p90=sizes[int(len(sizes) * 0.9)], p99=sizes[int(len(sizes) * 0.99)],
+        ma=sizes[-1])
+
+
+class PersonBlocker:
+    """
+    Inverted indexes of WarSampo persons by family name phonetic key and birth and death years.
+
+    >>> persons = {
+    ...     'p1': {'family': 'Virtanen', 'birth_begin': '1915-01-01', 'birth_end': '1915-01-01',
+    ...            'death_begin': '1941-07-01', 'death_end': '1941-07-01'},
+    ...     'p2': {'family': 'Virtanen', 'birth_begin': '1920-01-01', 'birth_end': '1920-01-01',
+    ...            'death_begin': None, 'death_end': None},
+    ...     'p3': {'family': 'Wirtanen', 'birth_begin': None, 'birth_end': None,
+    ...            'death_begin': None, 'death_end': None},
+    ...     'p4': {'family': 'Nurmi', 'birth_begin': '1915-01-01', 'birth_end': '1915-01-01',
+    ...            'death_begin': None, 'death_end': None},
+    ... }
+    >>> blocker = PersonBlocker(persons, year_window=1)
+    >>> sorted(blocker.candidates({'family': 'Virtanen', 'birth_begin': '1916-02-02', 'birth_end': '1916-02-02',
+    ...                            'death_begin': '1941-07-01', 'death_end': '1941-07-01'}))
+    ['p1', 'p3']
+    >>> sorted(blocker.candidates({'family': 'Virtanen', 'birth_begin': None, 'birth_end': None,
+    ...                            'death_begin': '1941-07-01', 'death_end': '1941-07-01'}))
+    ['p1', 'p2', 'p3']
+    """
+
+    def __init__(self, persons, year_window=1):
+        """
+        :param persons: dict of person id -> person record
+        :param year_window: maximum difference of birth or death years of candidate pairs
+        """
+        self.year_window = year_window
+        self.index = defaultdict(set)
+
+        for person_id, person in persons.items():
+            births = record_years(person, 'birth_begin', 'birth_end')
+            deaths = record_years(person, 'death_begin', 'death_end')
+            for key in family_keys(person.get('family')):
+                self.index[(key,)].add(person_id)
+                for year in births:
+                    self.index[(key, 'birth', year)].add(person_id)
+                for year in deaths:
+                    self.index[(key, 'death', year)].add(person_id)
+                if not births:
+                    self.index[(key, 'no birth')].add(person_id)
+                if not deaths:
+                    self.index[(key, 'no death')].add(person_id)
+                if not births and not deaths:
+                    self.index[(key, 'no dates')].add(person_id)
+
+        log.info('Indexed {n} persons into {b} blocks'.format(n=len(persons), b=len(self.index)))
+        log.info('Block sizes: {}'.format(_percentiles([len(block) for block in self.index.values()])))
+
+    def _window(self, years):
+        return {year + diff for year in years for diff in range(-self.year_window, self.year_window + 1)}
+
+    def candidates(self, document):
+        """
+        Persons sharing a family name key with the document, and with compatible birth or death years,
+        or with no dates comparable to the document's.
+
+        :param document: document record
+        :return: set of person ids
+        """
+        births = self._window(record_years(document, 'birth_begin', 'birth_end'))
+        deaths = self._window(record_years(document, 'death_begin', 'death_end'))
+
+        if births and deaths:
+            incomparable = 'no dates'
+        elif births:
+            incomparable = 'no birth'
+        elif deaths:
+            incomparable = 'no death'
+        else:
+            incomparable = None
+
+        candidates = set()
+        for key in family_keys(document.get('family')):
+            if incomparable is None:
+                candidates |= self.index.get((key,), set())
+                continue
+            candidates |= self.index.get((key, incomparable), set())
+            for year in births:
+                candidates |= self.index.get((key, 'birth', year), set())
+            for year in deaths:
+                candidates |= self.index.get((key, 'death', year), set())
+
+        return candidates
+
+    def blocks(self, documents, persons):
+        """
+        Generate record blocks for dedupe's matchBlocks, one block for each document with candidates.
+        Each candidate pair occurs in exactly one block.
+
+        :param documents: dict of document id -> document record
+        :param persons: dict of person id -> person record
+        :return: generator of (document records, person records) tuples
+        """
+        sizes = []
+        for doc_id, document in documents.items():
+            candidates = self.candidates(document)
+            if not candidates:
+                continue
+            sizes.append(len(candidates))
+            yield ([(doc_id, document, set())],
+                   [(person_id, persons[person_id], set()) for person_id in sorted(candidates)])
+
+        log.info('Blocked {d} of {n} documents into {p} candidate pairs'.format(
+            d=len(sizes), n=len(documents), p=sum(sizes)))
+        log.info('Candidates per document: {}'.format(_percentiles(sizes)))
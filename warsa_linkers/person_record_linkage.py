@@ -1,17 +1,32 @@
 #!/usr/bin/env python3
 #  -*- coding: UTF-8 -*-
 """Link person records to WarSampo persons"""
+import gzip
+import hashlib
+import io
 import logging
+import os
 import re
 import json
+import sys
+import time
+import zipfile
+
+import numpy as np
 import requests
 
 from collections import defaultdict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing import Pool
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from dedupe import RecordLink, trainingDataLink, StaticRecordLink
 from rdflib import Graph, URIRef, Namespace
 
+from warsa_linkers.person_blocking import PersonBlocker
+
 log = logging.getLogger(__name__)
 
 CRM = Namespace('http://www.cidoc-crm.org/cidoc-crm/')
@@ -37,6 +52,7 @@ SELECT ?person (SAMPLE(?given_) as ?given) (SAMPLE(?family_) as ?family) (SAMPLE
     (GROUP_CONCAT(DISTINCT ?occupation; separator='|') as ?occupations) 
 WHERE {
   ?person a wsch:Person .
+  #PAGE_FILTER
   ?person foaf:firstName ?given_ .
   ?person foaf:familyName ?family_ .
   OPTIONAL {
@@ -71,44 +87,283 @@ HAVING(MAX(COALESCE(?rank_lvl, 1)) >= MAX(COALESCE(?rank_level2, 1)))
 '''
 
 
-def init_linker(data_fields, training_data_file, training_settings_file, doc_data, per_data, sample_size, training_size):
-    if training_settings_file:
-        try:
+def _field_spec(field):
+    return {key: '{}.{}'.format(value.__module__, value.__qualname__) if callable(value) else value
+            for key, value in field.items()}
+
+
+def _fill_ratio(records, field):
+    if not records:
+        return 0
+    return round(sum(1 for record in records.values() if record.get(field)) / len(records), 2)
+
+
+def get_training_fingerprint(data_fields, training_links, doc_data, per_data, sample_size, training_size):
+    """
+    Fingerprint of everything a trained linker depends on: the data fields, the training links and statistics
+    of the data. The statistics are coarse (magnitude of record counts and field fill ratios to two decimals),
+    so that adding a few records does not require retraining.
+
+    >>> fields = [{'field': 'family', 'type': 'String'}]
+    >>> docs, pers = {'d1': {'family': 'Nurmi'}}, {'p1': {'family': 'Nurmi'}, 'p2': {'family': None}}
+    >>> fingerprint = get_training_fingerprint(fields, [('d1', 'p1')], docs, pers, 100, 10)
+    >>> fingerprint == get_training_fingerprint(fields, [('d1', 'p1')], docs, dict(pers, p2={'family': None}), 100, 10)
+    True
+    >>> fingerprint == get_training_fingerprint(fields, [], docs, pers, 100, 10)
+    False
+    """
+    fields = [field['field'] for field in data_fields if 'field' in field]
+    fingerprint = {
+        'data_fields': [_field_spec(field) for field in data_fields],
+        'training_links': sorted([str(doc), str(per)] for doc, per in training_links),
+        'sample_size': sample_size,
+        'training_size': training_size,
+        'documents': len(doc_data).bit_length(),
+        'persons': len(per_data).bit_length(),
+        'fill_ratios': {field: [_fill_ratio(doc_data, field), _fill_ratio(per_data, field)] for field in fields},
+    }
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def read_artifact_fingerprint(path):
+    """
+    Read the fingerprint stored with a training artifact (settings or training data file).
+
+    :return: fingerprint, or None if the artifact has no fingerprint
+    """
+    try:
+        with open(path + '.fingerprint') as f:
+            return json.load(f)['fingerprint']
+    except FileNotFoundError:
+        return None
+
+
+def write_artifact_fingerprint(path, fingerprint):
+    with open(path + '.fingerprint', 'w') as f:
+        json.dump({'fingerprint': fingerprint}, f)
+
+
+def get_plain_training_pairs(training_pairs):
+    """
+    Convert the records of labeled training pairs (e.g. PersonRecords) into dicts, as dedupe can only write
+    dict records into the training data file.
+
+    >>> pairs = get_plain_training_pairs({'match': [(PersonRecord({'given': 'Aku'}), {'given': 'Aku'})]})
+    >>> [type(record).__name__ for record in pairs['match'][0]], pairs['match'][0][0]['given']
+    (['dict', 'dict'], 'Aku')
+    """
+    return {label: [tuple(dict(record) for record in pair) for pair in pairs]
+            for label, pairs in training_pairs.items()}
+
+
+def init_linker(data_fields, training_data_file, training_settings_file, doc_data, per_data, sample_size, training_size,
+                training_links=(), fingerprint=None, cached_sample_size=None):
+    """
+    Get a trained linker. The settings and training data files are reused if their fingerprints match the current
+    data fields, training links and data (see get_training_fingerprint), and regenerated if not. Files without
+    a fingerprint are regenerated too, as there is no way to tell whether they match the data.
+
+    Training still samples the data when the training data is reused, as dedupe learns the blocking predicates
+    from the sample. The training data is read after sampling so that the learner gets the labeled pairs.
+
+    :param training_links: known person links, used for the fingerprint
+    :param fingerprint: training fingerprint, computed if not given
+    :param cached_sample_size: optional smaller sample size to use when the training data is reused. As the
+        blocking predicates are learned from the sample, a small sample is faster but can lower recall.
+    """
+    if fingerprint is None:
+        fingerprint = get_training_fingerprint(data_fields, training_links, doc_data, per_data, sample_size,
+                                               training_size)
+
+    if training_settings_file and os.path.exists(training_settings_file):
+        cached = read_artifact_fingerprint(training_settings_file)
+        if cached == fingerprint:
             with open(training_settings_file, 'rb') as f:
                 linker = StaticRecordLink(f)
                 log.info('Read settings from {}'.format(training_settings_file))
                 return linker
-        except FileNotFoundError:
-            pass
+        elif cached is None:
+            log.info('Settings in {} have no fingerprint, retraining'.format(training_settings_file))
+        else:
+            log.info('Settings in {} do not match the data, retraining'.format(training_settings_file))
 
     linker = RecordLink(data_fields)
 
-    if training_data_file:
-        try:
-            with open(training_data_file) as f:
-                linker.readTraining(f)
-                log.info('Read training data from {}'.format(training_data_file))
-        except FileNotFoundError:
-            pass
+    cached_training = False
+    if training_data_file and os.path.exists(training_data_file):
+        cached = read_artifact_fingerprint(training_data_file)
+        if cached == fingerprint:
+            cached_training = True
+        elif cached is None:
+            log.info('Training data in {} has no fingerprint, regenerating'.format(training_data_file))
+        else:
+            log.info('Training data in {} does not match the data, regenerating'.format(training_data_file))
 
-    log.info('Generating training data')
+    if not cached_training:
+        log.info('Generating training data')
+    elif cached_sample_size is not None and cached_sample_size < sample_size:
+        log.info('Reusing training data, sampling {c} instead of {s} pairs for learning blocking'.format(
+            c=cached_sample_size, s=sample_size))
+        sample_size = cached_sample_size
     linker.sample(doc_data, per_data, sample_size=sample_size)
-    linker.markPairs(trainingDataLink(doc_data, per_data, common_key='person', training_size=training_size))
+
+    if cached_training:
+        with open(training_data_file) as f:
+            linker.readTraining(f)
+            log.info('Read training data from {}'.format(training_data_file))
+    else:
+        linker.markPairs(get_plain_training_pairs(
+            trainingDataLink(doc_data, per_data, common_key='person', training_size=training_size)))
     linker.train()
 
-    if training_data_file:
+    if training_data_file and not cached_training:
         log.info('Writing training data to {}'.format(training_data_file))
         with open(training_data_file, 'w+') as fp:
             linker.writeTraining(fp)
+        write_artifact_fingerprint(training_data_file, fingerprint)
 
     if training_settings_file:
         log.info('Writing settings data to {}'.format(training_settings_file))
         with open(training_settings_file, 'wb+') as fp:
             linker.writeSettings(fp)
+        write_artifact_fingerprint(training_settings_file, fingerprint)
 
     return linker
 
 
+def get_settings(linker, training_settings_file=None):
+    """
+    Get the learned settings of a linker as bytes, for creating StaticRecordLinks in worker processes.
+    """
+    if training_settings_file and os.path.exists(training_settings_file):
+        with open(training_settings_file, 'rb') as f:
+            return f.read()
+
+    settings = io.BytesIO()
+    linker.writeSettings(settings)
+    return settings.getvalue()
+
+
+def partition_blocks(blocks, chunk_size=1000):
+    """
+    Partition record blocks into chunks of connected components, so that no document or person occurs in two
+    chunks, and one-to-one matching of each chunk gives the same result as matching all blocks at once.
+
+    :param blocks: iterable of (document records, person records) tuples, as from PersonBlocker.blocks
+    :param chunk_size: approximate number of blocks per chunk (components are never split)
+    :return: list of lists of blocks
+
+    >>> blocks = [([('d1', {}, set())], [('p1', {}, set())]), ([('d2', {}, set())], [('p2', {}, set())]),
+    ...           ([('d3', {}, set())], [('p1', {}, set()), ('p3', {}, set())])]
+    >>> [[docs[0][0] for docs, pers in chunk] for chunk in partition_blocks(blocks, chunk_size=1)]
+    [['d1', 'd3'], ['d2']]
+    """
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    blocks = list(blocks)
+    for docs, pers in blocks:
+        root = find(('doc', docs[0][0]))
+        for record in docs[1:]:
+            parent[find(('doc', record[0]))] = root
+        for record in pers:
+            parent[find(('per', record[0]))] = root
+
+    components = defaultdict(list)
+    for block in blocks:
+        components[find(('doc', block[0][0][0]))].append(block)
+
+    chunks = []
+    chunk = []
+    for component in components.values():
+        chunk += component
+        if len(chunk) >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+_match_linker = None
+
+
+def _init_match_worker(settings):
+    global _match_linker
+    _match_linker = StaticRecordLink(io.BytesIO(settings), num_cores=1)
+
+
+def _max_rss_mb():
+    """
+    :return: maximum resident set size of the process in MB, or None if not available on the platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def _match_chunk(args):
+    chunk_number, blocks, threshold = args
+    start = time.time()
+    links = list(_match_linker.matchBlocks(blocks, threshold=threshold))
+    pairs = sum(len(docs) * len(pers) for docs, pers in blocks)
+    return chunk_number, links, pairs, time.time() - start, _max_rss_mb()
+
+
+def match_blocks_parallel(settings, blocks, threshold, processes, chunk_size=1000):
+    """
+    Score and match record blocks in a process pool, yielding links as chunks are finished.
+
+    :param settings: linker settings as bytes (see get_settings)
+    :param blocks: iterable of record blocks
+    :param threshold: match threshold
+    :param processes: number of worker processes
+    :param chunk_size: approximate number of blocks per chunk
+    :return: generator of links ((document id, person id), score)
+    """
+    chunks = partition_blocks(blocks, chunk_size)
+    log.info('Matching {n} chunks in {p} processes'.format(n=len(chunks), p=processes))
+
+    with Pool(processes, initializer=_init_match_worker, initargs=(settings,)) as pool:
+        tasks = ((i, chunk, threshold) for i, chunk in enumerate(chunks))
+        for chunk_number, links, pairs, elapsed, max_rss in pool.imap_unordered(_match_chunk, tasks):
+            log.info('Chunk {c}: {p} pairs, {l} links in {s:.2f} s (worker max RSS {m} MB)'.format(
+                c=chunk_number, p=pairs, l=len(links), s=elapsed,
+                m='{:.0f}'.format(max_rss) if max_rss is not None else 'n/a'))
+            for link in links:
+                yield link
+
+
+def _match_records(linker, doc_data, per_data, threshold, blocking_window=None, processes=None,
+                   training_settings_file=None):
+    """
+    Match document records to person records with dedupe, optionally with PersonBlocker blocks in parallel.
+
+    :return: iterable of links ((document id, person id), score)
+    """
+    if not doc_data or not per_data:
+        return []
+
+    if blocking_window is not None:
+        blocks = PersonBlocker(per_data, year_window=blocking_window).blocks(doc_data, per_data)
+        if processes:
+            return match_blocks_parallel(get_settings(linker, training_settings_file), blocks, threshold, processes)
+        return linker.matchBlocks(blocks, threshold=threshold)
+
+    return linker.match(doc_data, per_data, threshold=threshold)
+
+
 def _finalize_links(link_graph: Graph, training_links: list):
     """
     Add all training links to the output, as some can occasionally be missing.
@@ -147,7 +402,13 @@ def link_persons(endpoint, doc_data, data_fields, training_links,
                  training_size=50000,
                  threshold_ratio=0.5,
                  training_data_file=None,
-                 training_settings_file=None):
+                 training_settings_file=None,
+                 persons_snapshot=None,
+                 persons_snapshot_max_age=None,
+                 compact=False,
+                 blocking_window=None,
+                 processes=None,
+                 link_state=None):
     """
     Link document records of persons to WarSampo person instances.
 
@@ -160,37 +421,98 @@ def link_persons(endpoint, doc_data, data_fields, training_links,
     :param threshold_ratio: Desired recall / precision importance (between 0 and 1)
     :param training_data_file:
     :param training_settings_file:
+    :param persons_snapshot: Local snapshot file of WarSampo persons to reuse (or create)
+    :param persons_snapshot_max_age: maximum age of the persons snapshot in seconds
+    :param compact: use memory-compact PersonRecords for documents and persons
+    :param blocking_window: if given, compare only candidate pairs from PersonBlocker with this year window,
+        instead of the blocking learned by dedupe
+    :param processes: number of processes for matching blocks in parallel (requires blocking_window)
+    :param link_state: link state file of the previous run to link incrementally (created if it does not exist)
     :return: RDFLib Graph with updated links
     """
     log.info('Person record linkage with sample size {ss} and training size {ts} and threshold ratio {tr}'.
              format(ss=sample_size, ts=training_size, tr=threshold_ratio))
     log.info('Got {} document records'.format(len(doc_data)))
 
-    per_data = _generate_persons_dict(endpoint)
+    if processes and blocking_window is None:
+        raise ValueError('Parallel matching requires blocking_window')
+
+    if compact:
+        doc_data = compact_records(doc_data)
+
+    per_data = load_persons(endpoint, persons_snapshot, compact=compact, max_age=persons_snapshot_max_age)
     log.info('Got {} WarSampo persons'.format(len(per_data)))
 
+    doc_hashes = get_record_hashes(doc_data)
+    per_hashes = get_record_hashes(per_data)
+    training_fingerprint = get_training_fingerprint(data_fields, training_links, doc_data, per_data, sample_size,
+                                                    training_size)
+    linkage_key = get_linkage_key(data_fields, threshold_ratio, blocking_window, training_fingerprint)
+    state = read_link_state(link_state, linkage_key) if link_state else None
+
+    date_fields, set_fields = get_comparator_fields(data_fields)
+    doc_data = normalize_records(doc_data, date_fields, set_fields)
+    per_data = normalize_records(per_data, date_fields, set_fields)
+
     doc_data = get_person_links(doc_data, per_data, training_links)
 
     link_graph = Graph()
 
     linker = init_linker(data_fields, training_data_file, training_settings_file, doc_data, per_data,
-                         sample_size, training_size)
+                         sample_size, training_size, training_links=training_links, fingerprint=training_fingerprint)
+
+    def match(docs, pers):
+        return _match_records(linker, docs, pers, threshold_ratio, blocking_window, processes, training_settings_file)
 
     # threshold_ratio = linker.threshold(doc_data, per_data, threshold_ratio)
-    links = linker.match(doc_data, per_data, threshold=threshold_ratio)
+    if state is None:
+        kept_links = []
+        link_batches = [match(doc_data, per_data)]
+    else:
+        kept_links, changed_docs, changed_pers = diff_link_state(state, doc_hashes, per_hashes)
+        linked_docs = {link[0][0] for link in kept_links}
+        linked_pers = {link[0][1] for link in kept_links}
+        log.info('Incremental linkage: kept {k} links, rescoring {d} documents and {p} persons'.format(
+            k=len(kept_links), d=len(changed_docs), p=len(changed_pers)))
 
-    for link in links:
-        doc = link[0][0]
-        per = link[0][1]
-        link_graph.add((URIRef(doc), CRM.P70_documents, URIRef(per)))
+        # Persons are linked one-to-one, so documents are only scored against persons not linked yet.
+        # The batches are generators, so that the second one sees the persons linked by the first one.
+        # Unchanged unlinked documents are not scored again against unchanged unlinked persons, as they were
+        # scored against each other in an earlier run.
+        def changed_links():
+            yield from match({doc: doc_data[doc] for doc in changed_docs},
+                             {per: rec for per, rec in per_data.items() if per not in linked_pers})
+
+        def unchanged_links():
+            yield from match({doc: rec for doc, rec in doc_data.items()
+                              if doc not in changed_docs and doc not in linked_docs},
+                             {per: per_data[per] for per in changed_pers if per not in linked_pers})
+
+        link_batches = [changed_links(), unchanged_links()]
+
+    for link in kept_links:
+        link_graph.add((URIRef(link[0][0]), CRM.P70_documents, URIRef(link[0][1])))
+
+    links = list(kept_links)
+    for batch in link_batches:
+        for link in batch:
+            links.append(link)
+            doc = link[0][0]
+            per = link[0][1]
+            if state is not None:
+                linked_pers.add(per)
+            link_graph.add((URIRef(doc), CRM.P70_documents, URIRef(per)))
 
-        log.info('Found person link: {}  <-->  {} (confidence: {})'.format(doc, per, link[1]))
-        log.debug('\nLinked document: {}\n'.format(dict(doc_data[doc])))
-        log.debug('Linked Warsa person: {}\n'.format(dict(per_data[per])))
+            log.info('Found person link: {}  <-->  {} (confidence: {})'.format(doc, per, link[1]))
+            log.debug('\nLinked document: {}\n'.format(dict(doc_data[doc])))
+            log.debug('Linked Warsa person: {}\n'.format(dict(per_data[per])))
 
     log.info('Got weights: {}'.format(linker.classifier.weights))
     log.info('Found {} person links'.format(len(links)))
 
+    if link_state:
+        write_link_state(link_state, linkage_key, links, doc_hashes, per_hashes)
+
     return _finalize_links(link_graph, training_links)
 
 
@@ -224,56 +546,574 @@ def _sanitize_family_name(name: str):
     return re.sub(r'[()]', '', new)
 
 
-def _generate_persons_dict(endpoint):
+PAGE_FILTER_PLACEHOLDER = '#PAGE_FILTER'
+PAGE_TIMEOUT = 300
+PAGE_RETRIES = 3
+
+PERSON_FIELDS = ('person', 'given', 'family', 'rank', 'rank_level', 'birth_place', 'birth_begin', 'birth_end',
+                 'death_begin', 'death_end', 'death_place', 'activity_end', 'unit', 'occupation')
+
+
+def get_persons_page_query(prefix, query=QUERY_WARSA_PERSONS):
+    """
+    Query for one page of WarSampo persons: the persons whose URI has an MD5 hash starting with the prefix.
+
+    >>> 'FILTER(STRSTARTS(MD5(STR(?person)), "a"))' in get_persons_page_query('a')
+    True
+    >>> get_persons_page_query('a', query='SELECT * { ?person a wsch:Person . }')
+    Traceback (most recent call last):
+     ...
+    ValueError: Persons query has no #PAGE_FILTER placeholder
+    """
+    if PAGE_FILTER_PLACEHOLDER not in query:
+        raise ValueError('Persons query has no {} placeholder'.format(PAGE_FILTER_PLACEHOLDER))
+    return query.replace(PAGE_FILTER_PLACEHOLDER, 'FILTER(STRSTARTS(MD5(STR(?person)), "{}"))'.format(prefix))
+
+
+def get_page_prefixes(prefix_length):
+    """
+    Hash prefixes splitting persons into 16 ** prefix_length stable pages.
+
+    >>> get_page_prefixes(1)[:3], len(get_page_prefixes(2))
+    (['0', '1', '2'], 256)
+    >>> get_page_prefixes(0)
+    ['']
+    """
+    prefixes = ['']
+    for _ in range(prefix_length):
+        prefixes = [prefix + digit for prefix in prefixes for digit in '0123456789abcdef']
+    return prefixes
+
+
+def _person_dict(person_row):
+    person = person_row['person']['value']
+    given = person_row['given']['value']
+    family = person_row['family']['value']
+    ranks = person_row.get('ranks', {}).get('value')
+    rank_level = person_row.get('rank_level', {}).get('value')
+    birth_place = person_row.get('birth_place', {}).get('value')
+    birth_begin = person_row.get('birth_begin', {}).get('value')
+    birth_end = person_row.get('birth_end', {}).get('value')
+    death_begin = person_row.get('death_begin', {}).get('value')
+    death_end = person_row.get('death_end', {}).get('value')
+    death_place = person_row.get('death_place', {}).get('value')
+    activity_end = person_row.get('activity_end', {}).get('value')
+    units = person_row.get('units', {}).get('value')
+    occupations = person_row.get('occupations', {}).get('value')
+
+    return {
+        'person': person,
+        'given': given,
+        'family': _sanitize_family_name(family),
+        'rank': ranks.split('|') if ranks else None,
+        'rank_level': int(rank_level) if rank_level else None,
+        'birth_place': [birth_place] if birth_place else None,
+        'birth_begin': get_date_value(birth_begin),
+        'birth_end': get_date_value(birth_end),
+        'death_begin': get_date_value(death_begin),
+        'death_end': get_date_value(death_end),
+        'death_place': [death_place] if death_place else None,
+        'activity_end': get_date_value(activity_end),
+        'unit': units.split('|') if units else None,
+        'occupation': occupations.split('|') if occupations else None
+    }
+
+
+def _fetch_persons_page(endpoint, prefix, timeout=PAGE_TIMEOUT, retries=PAGE_RETRIES):
+    """
+    Fetch one page of persons and convert the result rows into person dicts, so that the JSON response of
+    the page can be released right away.
+
+    A failed or timed out request is retried `retries` times, with an increasing delay.
+    """
+    query = get_persons_page_query(prefix)
+    for attempt in range(retries + 1):
+        try:
+            response = requests.post(endpoint, {'query': query}, timeout=timeout)
+            response.raise_for_status()
+            results = response.json()
+            break
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if attempt == retries:
+                raise
+            log.warning('Fetching person page {p} failed ({e}), retrying'.format(p=prefix or '-', e=e))
+            time.sleep(2 ** attempt)
+
+    return [_person_dict(person_row) for person_row in results['results']['bindings']]
+
+
+def _generate_persons_dict(endpoint, prefix_length=1, workers=4, compact=False):
     """
     Generate a persons dict from person instances
+
+    Persons are queried in 16 ** prefix_length pages (by the hash of the person URI), `workers` pages at a time.
+    With `compact`, persons are stored as PersonRecords instead of dicts.
+    """
+    prefixes = get_page_prefixes(prefix_length)
+    persons = defaultdict(dict)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = executor.map(lambda prefix: _fetch_persons_page(endpoint, prefix), prefixes)
+        for page_number, page in enumerate(pages, 1):
+            for person_dict in page:
+                person = person_dict['person']
+                if len([val for val in person_dict.values() if val is not None]) > 3:
+                    # Filter out persons with very little information
+                    persons[sys.intern(person) if compact else person] = \
+                        PersonRecord(person_dict) if compact else person_dict
+                    log.debug('Using WarSampo person: {}'.format(person_dict))
+                else:
+                    log.info('Not using person {} for record linkage because of insufficient information'.format(
+                        person))
+
+            log.info('Fetched person page {n}/{t}: {p} persons, {c} persons in total'.format(
+                n=page_number, t=len(prefixes), p=len(page), c=len(persons)))
+
+    return persons
+
+
+SNAPSHOT_FORMAT = 3
+
+# Person fields with lists of strings and integers as values in persons snapshots, other fields have strings
+SNAPSHOT_LIST_FIELDS = ('rank', 'birth_place', 'death_place', 'unit', 'occupation')
+SNAPSHOT_INT_FIELDS = ('rank_level',)
+
+PERSONS_FINGERPRINT_QUERY = '''
+PREFIX wsch: <http://ldf.fi/schema/warsa/>
+SELECT (COUNT(DISTINCT ?person) AS ?persons) (COUNT(*) AS ?triples) WHERE {
+  ?person a wsch:Person .
+  ?person ?p ?o .
+}
+'''
+
+
+def _compact_value(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(sys.intern(v) if isinstance(v, str) else v for v in value)
+    return value
+
+
+class PersonRecord(MutableMapping):
+    """
+    Memory-compact person record with the mapping interface used by dedupe.
+
+    Values are stored in slots, strings are interned (URIs, dates and names repeat across records) and lists
+    are stored as tuples. All PERSON_FIELDS are always present, None if unknown. Other fields, e.g. of
+    person documents, are stored in a dict of their own.
+
+    >>> record = PersonRecord({'person': 'http://ldf.fi/warsa/actors/person_1', 'rank': ['http://rank/1']})
+    >>> record['rank'], record['given'], len(record)
+    (('http://rank/1',), None, 14)
+    >>> record.update({'person': 'http://ldf.fi/warsa/actors/person_2'})
+    >>> record['person'] is sys.intern('http://ldf.fi/warsa/actors/person_2')
+    True
+    >>> record['casualty_id'] = 'c1'
+    >>> record['casualty_id'], len(record), list(record)[-1]
+    ('c1', 15, 'casualty_id')
+    >>> del record['casualty_id']
+    >>> record['casualty_id']
+    Traceback (most recent call last):
+     ...
+    KeyError: 'casualty_id'
+    """
+    __slots__ = PERSON_FIELDS + ('_extra',)
+
+    def __init__(self, values=(), **kwargs):
+        for field in PERSON_FIELDS:
+            setattr(self, field, None)
+        self._extra = None
+        self.update(values, **kwargs)
+
+    def __getitem__(self, key):
+        if key in PERSON_FIELDS:
+            return getattr(self, key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in PERSON_FIELDS:
+            setattr(self, key, _compact_value(value))
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = _compact_value(value)
+
+    def __delitem__(self, key):
+        if key in PERSON_FIELDS:
+            raise TypeError('PersonRecord fields cannot be deleted')
+        if self._extra is None:
+            raise KeyError(key)
+        del self._extra[key]
+
+    def __iter__(self):
+        yield from PERSON_FIELDS
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        return len(PERSON_FIELDS) + (len(self._extra) if self._extra else 0)
+
+    def __repr__(self):
+        return 'PersonRecord({})'.format(dict(self))
+
+
+def compact_records(records):
+    """
+    Convert a dict of record dicts (WarSampo persons or person documents) into PersonRecords.
+
+    :param records: dict of id -> record dict with keys from PERSON_FIELDS
+    :return: dict of id -> PersonRecord
     """
+    return {sys.intern(key): PersonRecord(record) for key, record in records.items()}
+
+
+def get_query_hash(query=QUERY_WARSA_PERSONS):
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()
 
-    results = requests.post(endpoint, {'query': QUERY_WARSA_PERSONS}).json()
+
+def get_persons_fingerprint(persons):
+    """
+    Content fingerprint of a persons dict, independent of the order of persons.
+
+    >>> a, b = {'person': 'a', 'rank': ['x']}, {'person': 'b'}
+    >>> get_persons_fingerprint({'a': a, 'b': b}) == get_persons_fingerprint({'b': b, 'a': a})
+    True
+    """
+    fingerprint = hashlib.sha1()
+    for person in sorted(persons):
+        fingerprint.update(json.dumps(dict(persons[person]), sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        fingerprint.update(b'\0')
+    return fingerprint.hexdigest()
+
+
+def get_remote_persons_fingerprint(endpoint, timeout=PAGE_TIMEOUT):
+    """
+    Cheap fingerprint of the WarSampo persons in the endpoint: the number of persons and of their triples.
+    """
+    response = requests.post(endpoint, {'query': PERSONS_FINGERPRINT_QUERY}, timeout=timeout)
+    response.raise_for_status()
+    row = response.json()['results']['bindings'][0]
+    return '{persons}|{triples}'.format(persons=row['persons']['value'], triples=row['triples']['value'])
+
+
+def _encode_snapshot_columns(persons):
+    """
+    Encode person fields as NumPy arrays: strings as indices into a string table (-1 for None), lists as
+    flat indices with per-person lengths (-1 for None), and integers with a presence mask.
+    """
+    strings = {}
+
+    def index(value):
+        if not isinstance(value, str):
+            raise TypeError('Unsupported person field value: {!r}'.format(value))
+        return strings.setdefault(value, len(strings))
+
+    records = list(persons.values())
+    arrays = {}
+    for field in PERSON_FIELDS:
+        values = [record.get(field) for record in records]
+        if field in SNAPSHOT_LIST_FIELDS:
+            arrays[field] = np.array([index(v) for value in values if value is not None for v in value], dtype=np.int32)
+            arrays[field + '.lengths'] = np.array([-1 if value is None else len(value) for value in values],
+                                                  dtype=np.int32)
+        elif field in SNAPSHOT_INT_FIELDS:
+            arrays[field] = np.array([0 if value is None else value for value in values], dtype=np.int64)
+            arrays[field + '.present'] = np.array([value is not None for value in values], dtype=bool)
+        else:
+            arrays[field] = np.array([-1 if value is None else index(value) for value in values], dtype=np.int32)
+
+    table = list(strings)
+    arrays['strings'] = np.frombuffer(''.join(table).encode('utf-8'), dtype=np.uint8)
+    arrays['string_ends'] = np.cumsum([len(string) for string in table], dtype=np.int64)
+    return arrays
+
+
+def _decode_snapshot_columns(data, fields):
+    """
+    Decode the person field columns of a persons snapshot (see _encode_snapshot_columns).
+
+    :return: dict of field -> list of values
+    """
+    text = data['strings'].tobytes().decode('utf-8')
+    ends = data['string_ends'].tolist()
+    # Index -1 (None) gives the last item of the table
+    table = np.array([text[start:end] for start, end in zip([0] + ends, ends)] + [None], dtype=object)
+
+    columns = {}
+    for field in fields:
+        if field in SNAPSHOT_LIST_FIELDS:
+            flat = table[data[field]].tolist()
+            lengths = data[field + '.lengths']
+            starts = np.cumsum(np.maximum(lengths, 0)) - np.maximum(lengths, 0)
+            column = [None if length < 0 else flat[start:start + length]
+                      for start, length in zip(starts.tolist(), lengths.tolist())]
+        elif field in SNAPSHOT_INT_FIELDS:
+            column = np.where(data[field + '.present'], data[field], None).tolist()
+        else:
+            column = table[data[field]].tolist()
+        columns[field] = column
+
+    return columns
+
+
+def write_persons_snapshot(path, persons, endpoint, remote_fingerprint=None):
+    """
+    Write a persons dict as a versioned snapshot: a NumPy .npz file with a JSON header, a string table and
+    one array column per person field, so that loading it does not parse the persons.
+
+    :param path: snapshot file
+    :param persons: persons dict as returned by _generate_persons_dict
+    :param endpoint: endpoint the persons were queried from
+    :param remote_fingerprint: fingerprint of the persons in the endpoint, from get_remote_persons_fingerprint
+    """
+    header = {
+        'format': SNAPSHOT_FORMAT,
+        'query_hash': get_query_hash(),
+        'endpoint': endpoint,
+        'created': time.time(),
+        'remote_fingerprint': remote_fingerprint,
+        'fingerprint': get_persons_fingerprint(persons),
+        'fields': PERSON_FIELDS,
+    }
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, header=np.array(json.dumps(header)), **_encode_snapshot_columns(persons))
+
+    log.info('Wrote {n} WarSampo persons to snapshot {p}'.format(n=len(persons), p=path))
+
+
+def read_persons_snapshot(path, compact=False, verify=False):
+    """
+    Read a persons snapshot. The compressed columns are checked against their CRC when read.
+
+    :param path: snapshot file
+    :param compact: return PersonRecords instead of dicts
+    :param verify: also check the persons against the content fingerprint of the snapshot (slow)
+    :return: tuple of snapshot header and persons dict
+    """
+    with np.load(path) as data:
+        header = json.loads(str(data['header']))
+        if header.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError('Unsupported persons snapshot format: {}'.format(header.get('format')))
+        columns = _decode_snapshot_columns(data, header['fields'])
 
     persons = defaultdict(dict)
-    for person_row in results['results']['bindings']:
-        person = person_row['person']['value']
-        given = person_row['given']['value']
-        family = person_row['family']['value']
-        ranks = person_row.get('ranks', {}).get('value')
-        rank_level = person_row.get('rank_level', {}).get('value')
-        birth_place = person_row.get('birth_place', {}).get('value')
-        birth_begin = person_row.get('birth_begin', {}).get('value')
-        birth_end = person_row.get('birth_end', {}).get('value')
-        death_begin = person_row.get('death_begin', {}).get('value')
-        death_end = person_row.get('death_end', {}).get('value')
-        death_place = person_row.get('death_place', {}).get('value')
-        activity_end = person_row.get('activity_end', {}).get('value')
-        units = person_row.get('units', {}).get('value')
-        occupations = person_row.get('occupations', {}).get('value')
-
-        person_dict = {
-            'person': person,
-            'given': given,
-            'family': _sanitize_family_name(family),
-            'rank': ranks.split('|') if ranks else None,
-            'rank_level': int(rank_level) if rank_level else None,
-            'birth_place': [birth_place] if birth_place else None,
-            'birth_begin': get_date_value(birth_begin),
-            'birth_end': get_date_value(birth_end),
-            'death_begin': get_date_value(death_begin),
-            'death_end': get_date_value(death_end),
-            'death_place': [death_place] if death_place else None,
-            'activity_end': get_date_value(activity_end),
-            'unit': units.split('|') if units else None,
-            'occupation': occupations.split('|') if occupations else None
-        }
-        if len([val for val in person_dict.values() if val is not None]) > 3:
-            # Filter out persons with very little information
-            persons[person] = person_dict
-            log.debug('Using WarSampo person: {}'.format(person_dict))
+    for values in zip(*(columns[field] for field in header['fields'])):
+        person_dict = dict(zip(header['fields'], values))
+        if compact:
+            persons[sys.intern(person_dict['person'])] = PersonRecord(person_dict)
+        else:
+            persons[person_dict['person']] = person_dict
+
+    if verify and get_persons_fingerprint(persons) != header['fingerprint']:
+        raise ValueError('Persons snapshot {} does not match its fingerprint'.format(path))
+
+    return header, persons
+
+
+def load_persons(endpoint, snapshot=None, compact=False, max_age=None):
+    """
+    Get the WarSampo persons dict, reusing a local snapshot if it was made with the same query and endpoint,
+    and the persons in the endpoint have not changed since (see get_remote_persons_fingerprint).
+
+    An unreadable or outdated snapshot is replaced with freshly queried persons. If the endpoint cannot be
+    reached for checking the fingerprint, the snapshot is used as is.
+
+    :param endpoint: Endpoint to query persons from, None to use the snapshot regardless of its endpoint
+    :param snapshot: snapshot file, None to always query the endpoint
+    :param compact: use PersonRecords instead of dicts
+    :param max_age: maximum age of the snapshot in seconds, None for no limit
+    :return: persons dict
+    """
+    remote_fingerprint = None
+
+    if snapshot and os.path.exists(snapshot):
+        try:
+            header, persons = read_persons_snapshot(snapshot, compact=compact)
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            log.warning('Unable to read persons snapshot {p}: {e}'.format(p=snapshot, e=e))
+            header = None
+
+        if header is None:
+            pass
+        elif header['query_hash'] != get_query_hash() or endpoint not in (None, header['endpoint']):
+            log.info('Persons snapshot {} was made with another query or endpoint'.format(snapshot))
+        elif endpoint is None:
+            log.info('Using WarSampo persons snapshot {p} ({e}) without checking it'.format(
+                p=snapshot, e=header['endpoint']))
+            return persons
+        elif max_age is not None and time.time() - header['created'] > max_age:
+            log.info('Persons snapshot {} is older than {} seconds'.format(snapshot, max_age))
         else:
-            log.info('Not using person {} for record linkage because of insufficient information'.format(person))
+            try:
+                remote_fingerprint = get_remote_persons_fingerprint(endpoint)
+            except requests.exceptions.RequestException as e:
+                log.warning('Unable to check persons in {e} ({err}), using snapshot {p} as is'.format(
+                    e=endpoint, err=e, p=snapshot))
+                return persons
+
+            if remote_fingerprint == header['remote_fingerprint']:
+                log.info('Using WarSampo persons snapshot {p} ({e}, fingerprint {f})'.format(
+                    p=snapshot, e=header['endpoint'], f=header['fingerprint']))
+                return persons
+            log.info('WarSampo persons have changed since snapshot {}'.format(snapshot))
+
+    if endpoint is None:
+        raise ValueError('No endpoint given and no usable persons snapshot')
+
+    if snapshot and remote_fingerprint is None:
+        # Get the fingerprint before the persons, so that changes made meanwhile are noticed on the next run
+        try:
+            remote_fingerprint = get_remote_persons_fingerprint(endpoint)
+        except requests.exceptions.RequestException as e:
+            log.warning('Unable to get fingerprint of persons in {e}: {err}'.format(e=endpoint, err=e))
+
+    persons = _generate_persons_dict(endpoint, compact=compact)
+
+    if snapshot:
+        write_persons_snapshot(snapshot, persons, endpoint, remote_fingerprint)
 
     return persons
 
 
+LINK_STATE_FORMAT = 2
+
+
+def _record_json(record):
+    return json.dumps(dict(record), sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+
+
+def get_record_hashes(records):
+    """
+    Content hashes of records, for detecting new and changed records between linkage runs.
+
+    >>> hashes = get_record_hashes({'a': {'family': 'Virtanen', 'rank': ['x']}, 'b': {'family': 'Nurmi'}})
+    >>> hashes['a'] == get_record_hashes({'a': {'rank': ('x',), 'family': 'Virtanen'}})['a']
+    True
+    >>> hashes['a'] == hashes['b']
+    False
+    """
+    return {key: hashlib.sha1(_record_json(record)).hexdigest() for key, record in records.items()}
+
+
+def get_linkage_key(data_fields, threshold_ratio, blocking_window=None, training_fingerprint=None):
+    """
+    Key of the linkage parameters that previous links depend on.
+
+    >>> get_linkage_key([{'field': 'family', 'type': 'String'}], 0.5)
+    [[['family', 'String']], 0.5, None, None]
+    """
+    return [[[field.get('field'), field.get('type')] for field in data_fields], threshold_ratio, blocking_window,
+            training_fingerprint]
+
+
+def write_link_state(path, linkage_key, links, doc_hashes, per_hashes):
+    """
+    Write the links and record content hashes of a linkage run as gzipped JSON.
+
+    :param path: link state file
+    :param linkage_key: key of the linkage parameters, from get_linkage_key
+    :param links: list of links ((document id, person id), score)
+    :param doc_hashes: content hashes of document records
+    :param per_hashes: content hashes of person records
+    """
+    state = {
+        'format': LINK_STATE_FORMAT,
+        'linkage_key': linkage_key,
+        'links': [(doc, per, float(score)) for (doc, per), score in links],
+        'doc_hashes': doc_hashes,
+        'per_hashes': per_hashes,
+    }
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+
+    log.info('Wrote {n} links to link state {p}'.format(n=len(links), p=path))
+
+
+def read_link_state(path, linkage_key):
+    """
+    Read the link state of a previous linkage run.
+
+    :param path: link state file
+    :param linkage_key: key of the current linkage parameters
+    :return: link state dict, or None if there is no usable previous state
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            state = json.load(f)
+        state_format = state.get('format')
+    except FileNotFoundError:
+        log.info('No link state {}, linking all documents'.format(path))
+        return None
+    except (OSError, EOFError, ValueError, AttributeError) as e:
+        log.warning('Unable to read link state {p}, linking all documents: {e}'.format(p=path, e=e))
+        return None
+
+    if state_format != LINK_STATE_FORMAT:
+        log.warning('Unsupported link state format {f} in {p}, linking all documents'.format(f=state_format, p=path))
+        return None
+
+    if not (isinstance(state.get('links'), list) and isinstance(state.get('doc_hashes'), dict)
+            and isinstance(state.get('per_hashes'), dict)):
+        log.warning('Invalid link state {}, linking all documents'.format(path))
+        return None
+
+    if state.get('linkage_key') != linkage_key:
+        log.info('Linkage parameters have changed since link state {}, linking all documents'.format(path))
+        return None
+
+    return state
+
+
+def diff_link_state(state, doc_hashes, per_hashes):
+    """
+    Compare the records of a previous linkage run to the current records.
+
+    Records to rescore are the new and changed records, and the unchanged records whose link was dropped
+    because the record at the other end changed or was removed.
+
+    :param state: link state of the previous run
+    :param doc_hashes: content hashes of the current document records
+    :param per_hashes: content hashes of the current person records
+    :return: tuple of links between unchanged records, document ids to rescore, person ids to rescore
+
+    >>> state = {'links': [('d1', 'p1', 0.9), ('d2', 'p2', 0.8), ('d3', 'p3', 0.7)],
+    ...          'doc_hashes': {'d1': 'a', 'd2': 'b', 'd3': 'c'}, 'per_hashes': {'p1': 'x', 'p2': 'y', 'p3': 'z'}}
+    >>> kept, docs, pers = diff_link_state(state, {'d1': 'a', 'd2': 'B', 'd3': 'c', 'd4': 'd'},
+    ...                                    {'p1': 'x', 'p2': 'y', 'p3': 'Z'})
+    >>> kept, sorted(docs), sorted(pers)
+    ([(('d1', 'p1'), 0.9)], ['d2', 'd3', 'd4'], ['p2', 'p3'])
+    """
+    old_docs = state['doc_hashes']
+    old_pers = state['per_hashes']
+    changed_docs = {doc for doc, doc_hash in doc_hashes.items() if old_docs.get(doc) != doc_hash}
+    changed_pers = {per for per, per_hash in per_hashes.items() if old_pers.get(per) != per_hash}
+
+    kept = []
+    for doc, per, score in state['links']:
+        doc_kept = doc in doc_hashes and doc not in changed_docs
+        per_kept = per in per_hashes and per not in changed_pers
+        if doc_kept and per_kept:
+            kept.append(((doc, per), score))
+        elif doc_kept:
+            changed_docs.add(doc)
+        elif per_kept:
+            changed_pers.add(per)
+
+    return kept, changed_docs, changed_pers
+
+
+@lru_cache(maxsize=65536)
+def _parse_date(date_str, date_format):
+    # The same dates occur in many records, so parse each only once
+    try:
+        return datetime.strptime(date_str, date_format).date()
+    except ValueError:
+        return None
+
+
 def get_date_value(date_str, date_format=INPUT_DATE_FORMAT):
     """
     Validate date values and return them in the format expected by dedupe (string).
@@ -285,10 +1125,77 @@ def get_date_value(date_str, date_format=INPUT_DATE_FORMAT):
     >>> get_date_value('1945-02-XX')
     """
     if date_str:
-        try:
-            return datetime.strptime(str(date_str), date_format).date().isoformat()
-        except ValueError:
+        date = _parse_date(str(date_str), date_format)
+        if date is None:
             log.warning('Unable to parse date {}'.format(date_str))
+            return None
+        return date.isoformat()
+
+
+def get_date_ordinal(date_value):
+    """
+    Day number of an ISO date, as used by activity_comparator.
+
+    >>> get_date_ordinal('1944-04-02')
+    709758
+    >>> get_date_ordinal(709758)
+    709758
+    >>> get_date_ordinal('1944-04-XX')
+    >>> get_date_ordinal(None)
+    """
+    if isinstance(date_value, int) or not date_value:
+        return date_value or None
+    date = _parse_date(str(date_value), ISO_FORMAT)
+    return date.toordinal() if date else None
+
+
+def get_comparator_fields(data_fields):
+    """
+    Fields compared with activity_comparator (dates) and intersection_comparator (sets) in dedupe data fields.
+    Only these can be normalized, as other field types need the original values.
+
+    >>> get_comparator_fields([{'field': 'activity_end', 'type': 'Custom', 'comparator': activity_comparator},
+    ...                        {'field': 'unit', 'type': 'Custom', 'comparator': intersection_comparator},
+    ...                        {'field': 'rank', 'type': 'Set'}])
+    (('activity_end',), ('unit',))
+    """
+    date_fields = tuple(field['field'] for field in data_fields if field.get('comparator') is activity_comparator)
+    set_fields = tuple(field['field'] for field in data_fields if field.get('comparator') is intersection_comparator)
+    return date_fields, set_fields
+
+
+def normalize_records(records, date_fields, set_fields):
+    """
+    Copy records with fields converted to the values the comparators use directly: dates to day numbers and lists
+    to frozensets.
+
+    :param records: dict of id -> record (dict or PersonRecord)
+    :param date_fields: fields compared with activity_comparator
+    :param set_fields: fields compared with intersection_comparator
+    :return: dict of id -> normalized record of the same type
+
+    >>> records = {'a': {'activity_end': '1944-04-02', 'rank': ['x', 'y'], 'unit': None}}
+    >>> normalized = normalize_records(records, ('activity_end',), ('rank', 'unit'))
+    >>> normalized['a']['activity_end'], sorted(normalized['a']['rank']), normalized['a']['unit']
+    (709758, ['x', 'y'], None)
+    >>> records['a']['activity_end']
+    '1944-04-02'
+    """
+    if not date_fields and not set_fields:
+        return records
+
+    normalized = {}
+    for key, record in records.items():
+        record = type(record)(record)
+        for field in date_fields:
+            if field in record:
+                record[field] = get_date_ordinal(record[field])
+        for field in set_fields:
+            if record.get(field) is not None:
+                record[field] = frozenset(record[field])
+        normalized[key] = record
+
+    return normalized
 
 
 def get_person_links(documents: dict, persons: dict, links):
@@ -308,11 +1215,19 @@ def get_person_links(documents: dict, persons: dict, links):
 
 
 def intersection_comparator(field_1, field_2):
+    """
+    Compare two collections of values, 0 if they share a value and 1 if not.
+
+    >>> intersection_comparator(frozenset(['a', 'b']), frozenset(['b']))
+    0
+    >>> intersection_comparator(['a'], ('b', 'c'))
+    1
+    >>> intersection_comparator(['a'], None)
+    """
     if field_1 and field_2:
-        if set(field_1) & set(field_2):
-            return 0
-        else:
-            return 1
+        if not isinstance(field_1, (set, frozenset)):
+            field_1 = set(field_1)
+        return 1 if field_1.isdisjoint(field_2) else 0
 
 
 def activity_comparator(cas_death, per_activity):
@@ -330,12 +1245,18 @@ def activity_comparator(cas_death, per_activity):
     Traceback (most recent call last):
      ...
     ValueError: unconverted data remains: 1
+
+    Dates can also be given as day numbers, as normalized by normalize_records:
+
+    >>> activity_comparator(get_date_ordinal('1941-11-24'), '1944-04-02')
+    1
     """
     if cas_death and per_activity:
-        death = datetime.strptime(cas_death, ISO_FORMAT)
-        activity = datetime.strptime(per_activity, ISO_FORMAT)
+        death = cas_death if isinstance(cas_death, int) else datetime.strptime(cas_death, ISO_FORMAT).toordinal()
+        activity = per_activity if isinstance(per_activity, int) \
+            else datetime.strptime(per_activity, ISO_FORMAT).toordinal()
 
         if death >= activity:
             return 0
-        if death + timedelta(days=30) < activity:
+        if death + 30 < activity:
             return 1  # Was active after death
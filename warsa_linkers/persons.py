@@ -3,6 +3,7 @@ from datetime import date, datetime, timedelta
 from arpa_linker.link_helper import process_stage
 from rdflib import URIRef
 # from rdflib.namespace import SKOS
+from warsa_linkers.arpa_cache import setup_cache
 import logging
 import re
 import sys
@@ -1191,6 +1192,8 @@ if __name__ == '__main__':
         doctest.testmod()
         exit()
 
+    setup_cache(sys.argv, preprocessor)
+
     set_dataset(sys.argv[1])
 
     args = sys.argv[0:1] + sys.argv[2:]
@@ -1,6 +1,7 @@
 import re
 import sys
 from arpa_linker.link_helper import process_stage
+from warsa_linkers.arpa_cache import setup_cache
 
 
 ISLAND_TYPE = 'http://ldf.fi/pnr-schema#place_type_350'
@@ -152,6 +153,8 @@ if __name__ == '__main__':
         doctest.testmod()
         exit()
 
+    setup_cache(sys.argv, preprocessor)
+
     ignore = [
         'sillanpää',
         'ritva',
@@ -1,116 +1,267 @@
 #!/usr/bin/env python3
 #  -*- coding: UTF-8 -*-
 """Link rank strings to WarSampo rank ontology"""
+import logging
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from jellyfish import jaro_winkler
+from requests.adapters import HTTPAdapter
 
 from rdflib import Graph, RDF, URIRef
+from rdflib.namespace import RDFS, SKOS
+
+log = logging.getLogger(__name__)
+
+rank_mapping = {
+    'aliluutn': 'aliluutnantti',
+    'aliluutn.': 'aliluutnantti',
+    'alisot.ohj.': 'Alisotilasohjaaja',
+    'alisot.virk.': 'Alisotilasvirkamies',
+    'asemest.': 'asemestari',
+    'au.opp.': 'aliupseerioppilas',
+    'el.lääk.ev.luutn.': 'Eläinlääkintäeverstiluutnantti',
+    'el.lääk.kapt.': 'Eläinlääkintäkapteeni',
+    'el.lääk.maj.': 'Eläinlääkintämajuri',
+    'GRUF': 'Gruppenführer',
+    'II lk. nstm.': 'Toisen luokan nostomies',
+    'ins.kapt.': 'Insinöörikapteeni',
+    'ins.kapt.luutn.': 'Insinöörikapteeniluutnantti',
+    'ins.luutn.': 'Insinööriluutnantti',
+    'ins.maj.': 'Insinöörimajuri',
+    'is-mies': 'Ilmasuojelumies',
+    'is.stm.': 'Ilmasuojelusotamies',
+    'kaart': 'stm',
+    'kapt.luutn.': 'kapteeniluutnantti',
+    'kom.kapt.': 'komentajakapteeni',
+    'lääk.alik': 'lääkintäalikersantti',
+    'lääk.alikers.': 'Lääkintäalikersantti',
+    'lääk.kapt.': 'Lääkintäkapteeni',
+    'lääk.kers.': 'Lääkintäkersantti',
+    'lääk.korpr.': 'Lääkintäkorpraali',
+    'lääk.lotta': 'Lääkintälotta',
+    'lääk.maj.': 'Lääkintämajuri',
+    'lääk.stm': 'lääkintäsotamies',
+    'lääk.stm.': 'Lääkintäsotamies',
+    'lääk.vääp.': 'Lääkintävääpeli',
+    'lääk.virk.': 'Lääkintävirkamies',
+    'lentomek.': 'Lentomekaanikko',
+    'linn.työnjoht.': 'Linnoitustyönjohtaja',
+    'merivart.': 'Merivartija',
+    'mus.luutn.': 'Musiikkiluutnantti',
+    'OSTUF': 'Obersturmführer',
+    'paik.pääll.': 'Paikallispäällikkö',
+    'pans.jääk.': 'Panssarijääkäri',
+    'pursim.': 'pursimies',
+    'rajavääp.': 'rajavääpeli',
+    'RTTF': 'Rottenführer',
+    'sair.hoit.': 'Sairaanhoitaja',
+    'sair.hoit.opp.': 'Sairaanhoitajaoppilas',
+    'SCHTZ': 'Schütze',
+    'sivili': 'siviili',
+    'sk.korpr.': 'Suojeluskuntakorpraali',
+    'sot.alivirk.': 'Sotilasalivirkamies',
+    'sot.inval.': 'Sotainvalidi',
+    'sot.kotisisar': 'Sotilaskotisisar',
+    'sot.past.': 'Sotilaspastori',
+    'sot.pka': 'Sotilaspoika',
+    'sot.poika': 'Sotilaspoika',
+    'sotilasmest.': 'Sotilasmestari',
+    'STRM': 'Sturmmann',
+    'ups.kok': 'upseerikokelas',
+    'ups.kok.': 'Upseerikokelas',
+    'ups.opp.': 'Upseerioppilas',
+    'USCHA': 'Unterscharführer',
+    'USTUF': 'Untersturmführer',
+    'ylihoit.': 'Ylihoitaja',
+    'ylivääp.': 'Ylivääpeli',
+}
+
+# Works in Fuseki because SAMPLE returns the first value and text:query sorts by score
+RANK_QUERY = """
+    PREFIX text: <http://jena.apache.org/text#>
+    SELECT ?rank (SAMPLE(?id_) AS ?id) {{
+        VALUES ?rank {{ "{values}" }}
+        GRAPH <http://ldf.fi/warsa/ranks> {{
+            ?id_ text:query ?rank .
+            ?id_ a <http://ldf.fi/schema/warsa/Rank> .
+        }}
+    }} GROUP BY ?rank
+"""
+
+
+def _query_ranks(session, endpoint, literals, chunk):
+    start = time.time()
+    results = session.post(endpoint, {'query': RANK_QUERY.format(values='" "'.join(literals))}).json()
+    ranks = {rank['rank']['value']: rank['id']['value'] for rank in results['results']['bindings']}
+    log.debug('Rank chunk {c}: {n} literals, {m} matches in {s:.2f} s'.format(
+        c=chunk, n=len(literals), m=len(ranks), s=time.time() - start))
+    return ranks
 
 
-def link_ranks(graph, endpoint, source_prop, target_prop, class_uri):
+def query_ranks(endpoint, rank_literals, chunk_size=200, workers=4):
     """
-    Link military ranks in graph.
+    Query rank URIs for rank literals, in chunks of literals sent concurrently over a pooled HTTP session.
 
-    :param graph: Data in RDFLib Graph object
     :param endpoint: Endpoint to query military ranks from
+    :param rank_literals: iterable of (preprocessed) rank literals
+    :param chunk_size: number of literals per query
+    :param workers: number of concurrent queries
+    :return: dict of rank literal -> rank URI
+    """
+    rank_literals = sorted(rank_literals)
+    chunks = [rank_literals[i:i + chunk_size] for i in range(0, len(rank_literals), chunk_size)]
+
+    ranks = {}
+    with requests.Session() as session:
+        session.mount('http://', HTTPAdapter(pool_maxsize=workers))
+        session.mount('https://', HTTPAdapter(pool_maxsize=workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(lambda c: _query_ranks(session, endpoint, chunks[c], c), range(len(chunks))):
+                ranks.update(result)
+
+    log.info('Found {m} ranks for {n} rank literals in {c} queries'.format(
+        m=len(ranks), n=len(rank_literals), c=len(chunks)))
+
+    return ranks
+
+
+def preprocess_rank(literal):
+    """
+    >>> preprocess_rank(' ups.kok. ')
+    'Upseerikokelas'
+    >>> preprocess_rank('kapteeni')
+    'kapteeni'
+    """
+    value = str(literal).strip()
+    return rank_mapping.get(value, value)
+
+
+RANK_CLASS = URIRef('http://ldf.fi/schema/warsa/Rank')
+
+
+class RankResolver:
+    """
+    Resolve rank literals to rank URIs locally, using the labels of the rank ontology.
+
+    Literals are resolved by exact label, case-folded label, rank_mapping abbreviation and finally by the most
+    similar label (Jaro-Winkler). Preferred labels take precedence over alternative labels, and ties are broken
+    by URI, so results do not depend on the order of the ontology triples.
+
+    >>> resolver = RankResolver([('http://ranks/Kapteeni', 'kapteeni', True),
+    ...                          ('http://ranks/Kapteeni', 'kapt.', False),
+    ...                          ('http://ranks/Aliluutnantti', 'aliluutnantti', True)])
+    >>> resolver.resolve('kapteeni'), resolver.resolve('Kapt.'), resolver.resolve('aliluutn.')
+    ('http://ranks/Kapteeni', 'http://ranks/Kapteeni', 'http://ranks/Aliluutnantti')
+    >>> resolver.resolve('kapteenni')
+    'http://ranks/Kapteeni'
+    >>> resolver.resolve('sotamies')
+    """
+
+    def __init__(self, labels, mapping=None, fuzzy_threshold=0.9):
+        """
+        :param labels: iterable of (rank URI, label, is preferred label) tuples
+        :param mapping: abbreviation mapping, by default rank_mapping
+        :param fuzzy_threshold: minimum similarity for the fuzzy fallback, None for no fuzzy matching
+        """
+        self.mapping = rank_mapping if mapping is None else mapping
+        self.fuzzy_threshold = fuzzy_threshold
+        self.exact = {}
+        self.folded = {}
+
+        # Preferred labels first, then by URI
+        for uri, label, preferred in sorted(labels, key=lambda x: (not x[2], x[0], x[1])):
+            self.exact.setdefault(label, uri)
+            self.folded.setdefault(label.casefold(), uri)
+
+        self.fuzzy_labels = sorted(self.folded.items())
+
+    @classmethod
+    def from_graph(cls, graph, **kwargs):
+        """
+        Create a resolver from the rank ontology.
+
+        :param graph: RDFLib Graph of the ranks graph (http://ldf.fi/warsa/ranks)
+        """
+        labels = []
+        for rank in graph[:RDF.type:RANK_CLASS]:
+            for prop, preferred in ((SKOS.prefLabel, True), (RDFS.label, True), (SKOS.altLabel, False)):
+                labels += [(str(rank), str(label), preferred) for label in graph.objects(rank, prop)]
+
+        return cls(labels, **kwargs)
+
+    def _lookup(self, value):
+        return self.exact.get(value) or self.folded.get(value.casefold())
+
+    def resolve(self, literal):
+        """
+        :param literal: rank literal
+        :return: rank URI or None
+        """
+        value = str(literal).strip()
+        uri = self._lookup(value)
+        if uri is None and value in self.mapping:
+            uri = self._lookup(self.mapping[value])
+        if uri is None and self.fuzzy_threshold is not None:
+            uri = self._fuzzy(self.mapping.get(value, value).casefold())
+        return uri
+
+    def _fuzzy(self, value):
+        best_uri = None
+        best_score = self.fuzzy_threshold
+        for label, uri in self.fuzzy_labels:
+            score = jaro_winkler(label, value)
+            if score > best_score:
+                best_uri, best_score = uri, score
+        return best_uri
+
+    def resolve_all(self, literals):
+        """
+        :return: dict of literal -> rank URI for the resolved literals
+        """
+        ranks = {}
+        for literal in literals:
+            uri = self.resolve(literal)
+            if uri:
+                ranks[literal] = uri
+        return ranks
+
+
+def link_ranks(graph, endpoint, source_prop, target_prop, class_uri, chunk_size=200, workers=4, resolver=None):
+    """
+    Link military ranks in graph. Resources with several rank values are linked by one of them.
+
+    :param graph: Data in RDFLib Graph object
+    :param endpoint: Endpoint to query military ranks from, not used if a resolver is given
     :param source_prop:
     :param target_prop:
     :param class_uri:
+    :param chunk_size: number of rank literals per query
+    :param workers: number of concurrent queries
+    :param resolver: RankResolver for resolving ranks locally instead of querying the endpoint
     :return: RDFLib Graph with updated links
     """
 
-    def preprocess(literal):
-        value = str(literal).strip()
-        return rank_mapping.get(value, value)
-
-    rank_mapping = {
-        'aliluutn': 'aliluutnantti',
-        'aliluutn.': 'aliluutnantti',
-        'alisot.ohj.': 'Alisotilasohjaaja',
-        'alisot.virk.': 'Alisotilasvirkamies',
-        'asemest.': 'asemestari',
-        'au.opp.': 'aliupseerioppilas',
-        'el.lääk.ev.luutn.': 'Eläinlääkintäeverstiluutnantti',
-        'el.lääk.kapt.': 'Eläinlääkintäkapteeni',
-        'el.lääk.maj.': 'Eläinlääkintämajuri',
-        'GRUF': 'Gruppenführer',
-        'II lk. nstm.': 'Toisen luokan nostomies',
-        'ins.kapt.': 'Insinöörikapteeni',
-        'ins.kapt.luutn.': 'Insinöörikapteeniluutnantti',
-        'ins.luutn.': 'Insinööriluutnantti',
-        'ins.maj.': 'Insinöörimajuri',
-        'is-mies': 'Ilmasuojelumies',
-        'is.stm.': 'Ilmasuojelusotamies',
-        'kaart': 'stm',
-        'kapt.luutn.': 'kapteeniluutnantti',
-        'kom.kapt.': 'komentajakapteeni',
-        'lääk.alik': 'lääkintäalikersantti',
-        'lääk.alikers.': 'Lääkintäalikersantti',
-        'lääk.kapt.': 'Lääkintäkapteeni',
-        'lääk.kers.': 'Lääkintäkersantti',
-        'lääk.korpr.': 'Lääkintäkorpraali',
-        'lääk.lotta': 'Lääkintälotta',
-        'lääk.maj.': 'Lääkintämajuri',
-        'lääk.stm': 'lääkintäsotamies',
-        'lääk.stm.': 'Lääkintäsotamies',
-        'lääk.vääp.': 'Lääkintävääpeli',
-        'lääk.virk.': 'Lääkintävirkamies',
-        'lentomek.': 'Lentomekaanikko',
-        'linn.työnjoht.': 'Linnoitustyönjohtaja',
-        'merivart.': 'Merivartija',
-        'mus.luutn.': 'Musiikkiluutnantti',
-        'OSTUF': 'Obersturmführer',
-        'paik.pääll.': 'Paikallispäällikkö',
-        'pans.jääk.': 'Panssarijääkäri',
-        'pursim.': 'pursimies',
-        'rajavääp.': 'rajavääpeli',
-        'RTTF': 'Rottenführer',
-        'sair.hoit.': 'Sairaanhoitaja',
-        'sair.hoit.opp.': 'Sairaanhoitajaoppilas',
-        'SCHTZ': 'Schütze',
-        'sivili': 'siviili',
-        'sk.korpr.': 'Suojeluskuntakorpraali',
-        'sot.alivirk.': 'Sotilasalivirkamies',
-        'sot.inval.': 'Sotainvalidi',
-        'sot.kotisisar': 'Sotilaskotisisar',
-        'sot.past.': 'Sotilaspastori',
-        'sot.pka': 'Sotilaspoika',
-        'sot.poika': 'Sotilaspoika',
-        'sotilasmest.': 'Sotilasmestari',
-        'STRM': 'Sturmmann',
-        'ups.kok': 'upseerikokelas',
-        'ups.kok.': 'Upseerikokelas',
-        'ups.opp.': 'Upseerioppilas',
-        'USCHA': 'Unterscharführer',
-        'USTUF': 'Untersturmführer',
-        'ylihoit.': 'Ylihoitaja',
-        'ylivääp.': 'Ylivääpeli',
-    }
-
-    # Works in Fuseki because SAMPLE returns the first value and text:query sorts by score
-    query = """
-        PREFIX text: <http://jena.apache.org/text#>
-        SELECT ?rank (SAMPLE(?id_) AS ?id) {{
-            VALUES ?rank {{ "{values}" }}
-            GRAPH <http://ldf.fi/warsa/ranks> {{
-                ?id_ text:query ?rank .
-                ?id_ a <http://ldf.fi/schema/warsa/Rank> .
-            }}
-        }} GROUP BY ?rank
-    """
+    rank_literals = {literal: preprocess_rank(literal) for literal in set(graph.objects(None, source_prop))}
 
-    rank_literals = set(map(preprocess, graph.objects(None, source_prop)))
+    if resolver:
+        ranks = resolver.resolve_all(set(rank_literals.values()))
+    else:
+        ranks = query_ranks(endpoint, set(rank_literals.values()), chunk_size=chunk_size, workers=workers)
 
-    results = requests.post(endpoint, {'query': query.format(values='" "'.join(rank_literals))}).json()
+    literal_links = {literal: URIRef(ranks[value]) for literal, value in rank_literals.items() if value in ranks}
+    resources = set(graph.subjects(RDF.type, class_uri))
 
-    rank_links = Graph()
-    ranks = {}
-    for rank in results['results']['bindings']:
-        ranks[rank['rank']['value']] = rank['id']['value']
+    resource_literals = {}
+    for person, _, literal in graph.triples((None, source_prop, None)):
+        if person in resources:
+            resource_literals.setdefault(person, literal)
 
-    for person in graph[:RDF.type:class_uri]:
-        rank_literal = preprocess(str(graph.value(person, source_prop)))
-        if rank_literal in ranks:
-            rank_links.add((person, target_prop, URIRef(ranks[rank_literal])))
+    rank_links = Graph()
+    for person, literal in resource_literals.items():
+        if literal in literal_links:
+            rank_links.add((person, target_prop, literal_links[literal]))
 
     return rank_links
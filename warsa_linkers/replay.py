@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#  -*- coding: UTF-8 -*-
+"""
+Record and replay HTTP traffic of the linkers, for reproducible offline benchmarks.
+
+Record all ARPA and SPARQL requests made by a linker run into a gzipped archive:
+
+    python -m warsa_linkers.replay record requests.jsonl.gz warsa_linkers.units input.ttl output.ttl ...
+
+Serve the recorded responses on localhost with artificial latency:
+
+    python -m warsa_linkers.replay serve requests.jsonl.gz --port 8000 --latency 0.05
+
+The linkers are then run against http://localhost:8000/ with the same paths as the original services.
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import runpy
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+log = logging.getLogger(__name__)
+
+
+def request_key(method, path, body):
+    """
+    Key identifying a request independently of the host it is sent to.
+
+    Form encoded bodies are canonicalized so that parameter order does not matter.
+
+    :param method: HTTP method
+    :param path: path including the query string
+    :param body: request body as bytes or str
+    :return: hex digest
+
+    >>> request_key('POST', '/arpa', 'text=JR+8&x=1') == request_key('POST', '/arpa', b'x=1&text=JR%208')
+    True
+    >>> request_key('POST', '/arpa', 'text=JR+8') == request_key('POST', '/sparql', 'text=JR+8')
+    False
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    body = body or b''
+
+    try:
+        params = parse_qsl(body.decode('utf-8'), keep_blank_values=True, strict_parsing=True)
+        body = json.dumps(sorted(params), ensure_ascii=False).encode('utf-8')
+    except (UnicodeDecodeError, ValueError):
+        pass
+
+    key = hashlib.sha1()
+    for part in (method.upper().encode('utf-8'), path.encode('utf-8'), body):
+        key.update(part)
+        key.update(b'\0')
+    return key.hexdigest()
+
+
+def _url_path(url):
+    parts = urlsplit(url)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+def read_archive(path):
+    """
+    Read a recorded archive.
+
+    :param path: archive file
+    :return: dict of request key -> (status, content type, content)
+    """
+    responses = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            if 'content' in entry:
+                content = entry['content'].encode('utf-8')
+            else:
+                content = base64.b64decode(entry['content_b64'])
+            responses[entry['key']] = (entry['status'], entry['content_type'], content)
+
+    log.info('Read {} recorded responses from {}'.format(len(responses), path))
+    return responses
+
+
+class Recorder:
+    """
+    Capture every request/response pair sent through requests while active.
+    Repeated identical requests are stored once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._send = None
+
+    def start(self):
+        send = self._send = requests.Session.send
+        recorder = self
+
+        def recording_send(session, request, **kwargs):
+            response = send(session, request, **kwargs)
+            recorder.add(request, response)
+            return response
+
+        requests.Session.send = recording_send
+
+    def add(self, request, response):
+        path = _url_path(request.url)
+        entry = {
+            'key': request_key(request.method, path, request.body),
+            'method': request.method,
+            'url': request.url,
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type', 'application/json'),
+        }
+        try:
+            entry['content'] = response.content.decode('utf-8')
+        except UnicodeDecodeError:
+            entry['content_b64'] = base64.b64encode(response.content).decode('ascii')
+
+        with self._lock:
+            self.entries[entry['key']] = entry
+
+    def stop(self):
+        requests.Session.send = self._send
+
+        with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+        log.info('Recorded {} responses to {}'.format(len(self.entries), self.path))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    responses = {}
+    latency = 0.0
+
+    def _replay(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        recorded = self.responses.get(request_key(self.command, self.path, body))
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if recorded is None:
+            log.warning('No recorded response for {} {}'.format(self.command, self.path))
+            self.send_error(404, 'No recorded response')
+            return
+
+        status, content_type, content = recorded
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _replay
+    do_POST = _replay
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def make_server(responses, port=0, latency=0.0, host='localhost'):
+    """
+    Create a replay server for recorded responses.
+
+    :param responses: dict as returned by read_archive
+    :param port: port to listen on, 0 for any free port
+    :param latency: artificial latency in seconds added to each response
+    :return: ThreadingHTTPServer, run with serve_forever()
+    """
+    handler = type('RecordedReplayHandler', (ReplayHandler,), {'responses': responses, 'latency': latency})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Record and replay linker HTTP traffic')
+    argparser.add_argument('--loglevel', default='INFO', help='Logging level')
+    subparsers = argparser.add_subparsers(dest='command')
+
+    record_parser = subparsers.add_parser('record', help='Run a linker module and record its requests')
+    record_parser.add_argument('archive', help='Archive file to write')
+    record_parser.add_argument('module', help='Linker module to run, e.g. warsa_linkers.units')
+    record_parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments for the linker module')
+
+    serve_parser = subparsers.add_parser('serve', help='Serve recorded responses')
+    serve_parser.add_argument('archive', help='Archive file to read')
+    serve_parser.add_argument('--port', default=8000, type=int, help='Port to listen on')
+    serve_parser.add_argument('--latency', default=0.0, type=float, help='Artificial latency per request in seconds')
+
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.command == 'record':
+        sys.argv = [args.module] + args.args
+        with Recorder(args.archive):
+            runpy.run_module(args.module, run_name='__main__', alter_sys=True)
+    elif args.command == 'serve':
+        server = make_server(read_archive(args.archive), port=args.port, latency=args.latency)
+        log.info('Replaying on http://localhost:{} with latency {}s'.format(args.port, args.latency))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    else:
+        argparser.print_help()
@@ -5,9 +5,12 @@ import unittest
 import os
 import sys
 from unittest import TestCase
-from rdflib import Graph, URIRef
+from rdflib import Graph, URIRef, Literal
+from rdflib.namespace import SKOS
 
-from .units import Validator, preprocessor, get_match_scores
+from .unit_scanner import UnitGazetteer, Automaton, link_units
+from .units import (Validator, preprocessor, get_match_scores, parse_units, format_unit_designation,
+                    UnitDesignation, INT_TO_ROMAN, ROMAN_TO_INT)
 
 
 def setUpModule():
@@ -163,6 +166,66 @@ class TestUnitDisambiguation(TestCase):
         self.assertEqual(preprocessor("Nyhamn´in linnakkeen"), 'Nyhamnin linnakkeen')
         self.assertEqual(preprocessor("JR 50´s avresa"), 'JR 50 avresa')
         self.assertEqual(preprocessor("II/ JR 50"), 'II/JR 50')
+        # Rules applying to numbers uncovered by an earlier rewrite
+        self.assertEqual(preprocessor("J.r14/Jr 5"), 'JR 14./JR 5')
+        self.assertEqual(preprocessor("JRIV/JR8"), 'JR 4./JR 8')
+        self.assertEqual(preprocessor("JR.12 D"), 'JR 12. D')
+        self.assertEqual(preprocessor("JR12 D"), 'JR 12 D')
+        self.assertEqual(preprocessor("J.R.5AKE"), 'JR V AKE')
+        self.assertEqual(preprocessor("Kenttäsairaala 12/JR8"), '12. Kenttäsairaala./JR 8')
+        self.assertEqual(preprocessor("KS 5 AKE"), 'KS V AKE')
+        self.assertEqual(preprocessor("LLv. 1/JR"), 'LLv 1 # LeLv 1./JR')
+        self.assertEqual(preprocessor("LLv 1 D"), 'LLv 1 # LeLv 1. D')
+        self.assertEqual(preprocessor("LLv1D"), 'LLv 1 # LeLv 1D')
+        self.assertEqual(preprocessor("LLv 7 AKE"), 'LLv VII AKE')
+        self.assertEqual(preprocessor("7 LLv. 8AKE"), 'LLv 7 # LeLv 7. VIII AKE')
+        # A LeLv takes the number of a preceding JR or JP
+        self.assertEqual(preprocessor("JR8 LeLv"), 'JR LLv 8 # LeLv 8')
+        self.assertEqual(preprocessor("JR 8 LeLv"), 'JR LLv 8 # LeLv 8')
+        self.assertEqual(preprocessor("J.R.8 LeLv"), 'JR LLv 8 # LeLv 8')
+        self.assertEqual(preprocessor("JR II LLv"), 'JR LLv 2 # LeLv 2')
+
+    def test_parse_units(self):
+        cases = {
+            "Tyk.K/JR22:n hyökkäyskaistaa.": [('JR', 22, 'TykK')],
+            "1/JR10:ssä.": [('JR', 10, '1.')],
+            "JP1:n radioasema": [('JP', 1, None)],
+            "2./I/15.Pr.": [('Pr', 15, '2./I')],
+            "IV.AKE.": [('AKE', 4, None)],
+            "7AKE": [('AKE', 7, None)],
+            "(1/12.Pr.)": [('Pr', 12, '1')],
+            "Tsto 3/2. DE aliupseerit.": [('DE', 2, '3')],
+            "Raskas patteristo/14.D. Elo-syyskuu 1944.": [('D', 14, None)],
+            "J.R.8. komentaja, ev. Antti": [('JR', 8, None)],
+            "Harlu JP.I.": [('JP', 1, None)],
+            "11/JR 9.": [('JR', 9, '11.')],
+            "Kenttäsairaala 35: Shakkia pelataan": [('KS', 35, None)],
+            "25.KS Os.": [('KS', 25, None)],
+            "Llv.14:n": [('LLv', 14, None)],
+            "32llv": [('LLv', 32, None)],
+            "I/JR II": [('JR', 2, 'I')],
+            "JR 50´s avresa": [('JR', 50, None)],
+            "II/ JR 50": [('JR', 50, 'II')],
+            "E/II RPr": [('RPr', 2, 'E')],
+            "Kenraalimajuri E.J.Raappana seurueineen.": [],
+            "pistooli m/41.": [],
+        }
+        for text, expected in cases.items():
+            normalized, designations = parse_units(text)
+            self.assertEqual(normalized, preprocessor(text))
+            self.assertEqual([tuple(d) for d in designations], expected, text)
+            for d in designations:
+                if d.unit_type != 'KS':
+                    self.assertIn(format_unit_designation(d), normalized)
+
+        self.assertEqual(format_unit_designation(UnitDesignation('KS', 25, None)), '25. KS')
+
+    def test_numeral_tables(self):
+        for i, r in INT_TO_ROMAN.items():
+            self.assertEqual(ROMAN_TO_INT[r], i)
+        self.assertEqual(INT_TO_ROMAN[1944], 'MCMXLIV')
+        self.assertNotIn('IIII', ROMAN_TO_INT)
+        self.assertEqual(preprocessor('JR IIII'), 'JR')
 
     def test_get_match_scores(self):
         props = {
@@ -183,6 +246,99 @@ class TestUnitDisambiguation(TestCase):
         self.assertEqual(res['long'], True)
 
 
+class TestUnitScanner(TestCase):
+
+    def setUp(self):
+        g = Graph()
+        dire = os.path.dirname(os.path.realpath(__file__))
+        f = os.path.join(dire, 'test_photo_person.ttl')
+        g.parse(f, format='turtle')
+        self.graph = g
+        self.gazetteer = UnitGazetteer([
+            ('http://ldf.fi/warsa/actors/actor_15034', 'III/KTR 11', False,
+             {'http://ldf.fi/warsa/conflicts/ContinuationWar'}),
+            ('http://ldf.fi/warsa/actors/actor_15035', 'III/KTR 11', False,
+             {'http://ldf.fi/warsa/conflicts/WinterWar'}),
+            ('http://ldf.fi/warsa/actors/actor_1', 'KTR 11', False, set()),
+            ('http://ldf.fi/warsa/actors/actor_2', '1940', True, set()),
+            ('http://ldf.fi/warsa/actors/actor_3', 'Turku', False, set()),
+        ], ignore=['Turku'])
+
+    def test_scan(self):
+        results = self.gazetteer.scan('Turku 1940 III/KTR 11 miehiä.')
+        self.assertEqual(sorted((r['id'], tuple(r['matches'])) for r in results), [
+            ('http://ldf.fi/warsa/actors/actor_1', ('KTR 11',)),
+            ('http://ldf.fi/warsa/actors/actor_15034', ('III/KTR 11',)),
+            ('http://ldf.fi/warsa/actors/actor_15035', ('III/KTR 11',)),
+            ('http://ldf.fi/warsa/actors/actor_2', ('1940',)),
+        ])
+
+    def test_validate_scanned(self):
+        validator = Validator(self.graph)
+        text = preprocessor('1940 III/KTR 11:n miehiä.')
+        results = self.gazetteer.scan(text)
+
+        s = URIRef('http://ldf.fi/warsa/photographs/sakuva_1000')
+        self.assertEqual([r['id'] for r in validator.validate(results, text, s)],
+                         ['http://ldf.fi/warsa/actors/actor_15034'])
+
+        s = URIRef('http://ldf.fi/warsa/photographs/sakuva_104726')
+        self.assertEqual([r['id'] for r in validator.validate(results, text, s)],
+                         ['http://ldf.fi/warsa/actors/actor_15035'])
+
+    def test_link_units(self):
+        period = URIRef('http://ldf.fi/schema/warsa/events/related_period')
+        continuation_war = 'http://ldf.fi/warsa/conflicts/ContinuationWar'
+        winter_war = 'http://ldf.fi/warsa/conflicts/WinterWar'
+        texts = [
+            ('http://photo/1', 'III/KTR 11:n miehiä.', continuation_war),
+            ('http://photo/2', 'III/KTR 11:n miehiä.', winter_war),
+            ('http://photo/3', 'JR 8. D:n esikunta', continuation_war),
+            ('http://photo/4', '2./JR 8 Turku', continuation_war),
+            ('http://photo/5', 'KTR 11 ja JR 8', continuation_war),
+            ('http://photo/6', 'Kenttäkeittiö', continuation_war),
+        ]
+        graph = Graph()
+        for s, text, war in texts:
+            graph.add((URIRef(s), SKOS.prefLabel, Literal(text)))
+            graph.add((URIRef(s), period, URIRef(war)))
+
+        gazetteer = UnitGazetteer([
+            ('http://unit/III_KTR_11_cw', 'III/KTR 11', False, {continuation_war}),
+            ('http://unit/III_KTR_11_ww', 'III/KTR 11', False, {winter_war}),
+            ('http://unit/KTR_11', 'KTR 11', False, set()),
+            ('http://unit/JR_8', 'JR 8', False, set()),
+            ('http://unit/2_JR_8', '2./JR 8', False, set()),
+            ('http://unit/8_D', '8. D', False, set()),
+            ('http://unit/Turku', 'Turku', False, set()),
+        ], ignore=['Turku'])
+
+        links = link_units(graph, gazetteer, URIRef('http://unit'))
+        self.assertEqual(sorted((str(s), str(o)) for s, o in links.subject_objects(URIRef('http://unit'))), [
+            # Longest match, by war
+            ('http://photo/1', 'http://unit/III_KTR_11_cw'),
+            ('http://photo/2', 'http://unit/III_KTR_11_ww'),
+            # Overlapping matches
+            ('http://photo/3', 'http://unit/8_D'),
+            ('http://photo/3', 'http://unit/JR_8'),
+            # Longest match, ignored label
+            ('http://photo/4', 'http://unit/2_JR_8'),
+            ('http://photo/5', 'http://unit/JR_8'),
+            ('http://photo/5', 'http://unit/KTR_11'),
+        ])
+
+    def test_automaton(self):
+        keys = ['jr', 'jr8', 'r8', '8', 'ktr11', 'tr1', 'a']
+        automaton = Automaton()
+        for key in keys:
+            automaton.add(key, key)
+        automaton.build()
+
+        text = 'ajr8ktr11jr88atr1'
+        expected = sorted((i, i + len(k), k) for k in keys for i in range(len(text)) if text.startswith(k, i))
+        self.assertEqual(sorted(automaton.iter(text)), expected)
+
+
 if __name__ == '__main__':
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(TestUnitDisambiguation))
@@ -1,14 +1,37 @@
 #!/usr/bin/env python3
 #  -*- coding: UTF-8 -*-
 import datetime
+import gzip
+import hashlib
+import json
+import os
+import pickle
 import pprint
+import re
+import tempfile
+import threading
+import tracemalloc
 import unittest
 from unittest import mock
 
+import requests
 from rdflib import URIRef, Graph, Literal, RDF
+from rdflib.namespace import SKOS
 
-from .person_record_linkage import _generate_persons_dict
-from .occupations import link_occupations, _harmonize_labels, occupation_substitutions, occupation_mapping
+from .person_record_linkage import _generate_persons_dict, load_persons, read_persons_snapshot, PersonRecord, \
+    compact_records, get_person_links, link_persons, CRM, \
+    partition_blocks, init_linker, intersection_comparator
+from .person_blocking import PersonBlocker
+from jellyfish import jaro_winkler
+
+from .occupations import link_occupations, _harmonize_labels, occupation_substitutions, occupation_mapping, \
+    OccupationIndex, SubstitutionRewriter, get_occupation_ontology, read_snapshot, link_occupations_ntriples, \
+    match_occupations
+from .arpa_cache import ArpaCache, install
+from .ranks import link_ranks, RankResolver
+from .municipalities import link_to_pnr, link_warsa_municipality, WarsaMunicipalityIndex
+from .batch_jaro_winkler import JaroWinklerScorer, check_scorer
+from .replay import Recorder, make_server, read_archive, request_key
 
 
 class OccupationTest(unittest.TestCase):
@@ -92,6 +115,169 @@ class OccupationTest(unittest.TestCase):
             self.assertEqual(_harmonize_labels(original, r'[,/]', occupation_mapping, occupation_substitutions),
                              [substitution])
 
+    def test_occupation_index(self):
+        labels = sorted(set(occupation_mapping.values()))
+        occupations = [('http://ldf.fi/warsa/occupations/{}'.format(i), label) for i, label in enumerate(labels)]
+        index = OccupationIndex(occupations)
+
+        for literal in list(occupation_mapping.keys()) + ['työmies', 'maanviljelijän poika', 'x', '']:
+            best_uri, best_score = None, 0
+            for uri, label in occupations:
+                score = jaro_winkler(label, literal)
+                if score > best_score:
+                    best_uri, best_score = uri, score
+
+            self.assertEqual(index.find_best_match(literal), (best_uri, best_score), literal)
+
+        self.assertLess(index.comparisons, len(occupations) * (len(occupation_mapping) + 4))
+
+    def test_link_occupations_numpy(self):
+        source_prop = URIRef('http://occupation')
+        target_prop = URIRef('http://occupation_link')
+        ptype = URIRef('http://tyomies')
+
+        graph = Graph()
+        for i, occupation in enumerate(['silinterimies', 'työm.', 'juuston suolaaja', 'pakkaaja', 'linn.työm.']):
+            graph.add((URIRef('http://person/{}'.format(i)), source_prop, Literal(occupation)))
+            graph.add((URIRef('http://person/{}'.format(i)), RDF.type, ptype))
+
+        with mock.patch('requests.post', side_effect=lambda x, y: PostMock(self.OCCUPATION_LINK_SPARQL_RESULTS)):
+            index_results = link_occupations(graph, '', source_prop, target_prop, ptype, engine='index')
+            numpy_results = link_occupations(graph, '', source_prop, target_prop, ptype, engine='numpy')
+
+        self.assertEqual(4, len(numpy_results))
+        self.assertEqual(set(index_results), set(numpy_results))
+
+    def test_link_occupations_parallel(self):
+        source_prop = URIRef('http://occupation')
+        target_prop = URIRef('http://occupation_link')
+        ptype = URIRef('http://tyomies')
+
+        graph = Graph()
+        for i, occupation in enumerate(['silinterimies', 'työm.', 'juuston suolaaja', 'pakkaaja', 'linn.työm.',
+                                        'työmies', 'pakkaaja', 'silinterimies']):
+            graph.add((URIRef('http://person/{}'.format(i)), source_prop, Literal(occupation)))
+            graph.add((URIRef('http://person/{}'.format(i)), RDF.type, ptype))
+
+        with mock.patch('requests.post', side_effect=lambda x, y: PostMock(self.OCCUPATION_LINK_SPARQL_RESULTS)):
+            serial_results = link_occupations(graph, '', source_prop, target_prop, ptype)
+            parallel_results = link_occupations(graph, '', source_prop, target_prop, ptype, processes=2)
+
+        self.assertEqual(6, len(serial_results))
+        self.assertEqual(set(serial_results), set(parallel_results))
+
+    def test_link_occupations_ntriples(self):
+        source_prop = URIRef('http://occupation')
+        target_prop = URIRef('http://occupation_link')
+        ptype = URIRef('http://tyomies')
+
+        graph = Graph()
+        for i, occupation in enumerate(['silinterimies', 'työm.', 'juuston suolaaja', 'pakkaaja', 'linn.työm.',
+                                        'työmies/työm.']):
+            graph.add((URIRef('http://person/{}'.format(i)), source_prop, Literal(occupation)))
+            graph.add((URIRef('http://person/{}'.format(i)), RDF.type, ptype))
+        graph.add((URIRef('http://other/1'), source_prop, Literal('työmies')))
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch('requests.post', side_effect=lambda x, y: PostMock(self.OCCUPATION_LINK_SPARQL_RESULTS)):
+            input_path = os.path.join(tmpdir, 'input.nt')
+            graph.serialize(input_path, format='nt')
+
+            output_path = os.path.join(tmpdir, 'output.nt')
+            with open(output_path, 'w', encoding='utf-8') as output:
+                written = link_occupations_ntriples(input_path, output, '', source_prop, target_prop, ptype)
+
+            streamed = Graph()
+            streamed.parse(output_path, format='nt')
+            expected = link_occupations(graph, '', source_prop, target_prop, ptype)
+
+        self.assertEqual(written, 5)
+        self.assertEqual(set(streamed), set(expected))
+
+    def test_link_occupations_memo(self):
+        source_prop = URIRef('http://occupation')
+        target_prop = URIRef('http://occupation_link')
+        ptype = URIRef('http://tyomies')
+
+        graph = Graph()
+        for i, occupation in enumerate(['silinterimies', 'työm.', 'juuston suolaaja', 'pakkaaja']):
+            graph.add((URIRef('http://person/{}'.format(i)), source_prop, Literal(occupation)))
+            graph.add((URIRef('http://person/{}'.format(i)), RDF.type, ptype))
+
+        other = Graph()
+        other.add((URIRef('http://person/x'), source_prop, Literal('linn.työm./työm.')))
+        other.add((URIRef('http://person/x'), RDF.type, ptype))
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch('requests.post', side_effect=lambda x, y: PostMock(self.OCCUPATION_LINK_SPARQL_RESULTS)), \
+                mock.patch('warsa_linkers.occupations.match_occupations', wraps=match_occupations) as matcher:
+            memo = os.path.join(tmpdir, 'memo.sqlite')
+
+            expected = link_occupations(graph, '', source_prop, target_prop, ptype)
+            self.assertEqual(set(link_occupations(graph, '', source_prop, target_prop, ptype, memo=memo)),
+                             set(expected))
+            self.assertEqual(len(matcher.call_args[0][0]), 4)
+
+            self.assertEqual(set(link_occupations(graph, '', source_prop, target_prop, ptype, memo=memo)),
+                             set(expected))
+            self.assertEqual(matcher.call_args[0][0], [])
+
+            link_occupations(other, '', source_prop, target_prop, ptype, memo=memo)
+            self.assertEqual(matcher.call_args[0][0], ['linnoitustyömies'])
+
+    def test_batch_scorer(self):
+        labels = sorted(set(occupation_mapping.values())) + ['mv', 'abd', '1234y', '2. luokan']
+        occupations = [('http://ldf.fi/warsa/occupations/{}'.format(i), label) for i, label in enumerate(labels)]
+        literals = list(occupation_mapping.keys()) + ['työmies', 'x', '', 'mv.', 'abc', '1234x', '2. luokka']
+
+        self.assertEqual(check_scorer(occupations, literals), 0.0)
+
+        index = OccupationIndex(occupations)
+        self.assertEqual(JaroWinklerScorer(occupations).find_best_matches(literals),
+                         [index.find_best_match(literal) for literal in literals])
+
+    def test_substitution_rewriter(self):
+        rewriter = SubstitutionRewriter(occupation_substitutions)
+        tokens = list(occupation_mapping.keys()) + ['työm.', 'maanv.', 'its.pka', 'linn.työm.', 'mv.pka', 'yo-opisk.']
+
+        for token in tokens + tokens:
+            expected = token
+            for pattern, repl in occupation_substitutions:
+                expected = re.sub(pattern, repl, expected)
+            self.assertEqual(rewriter(token), expected, token)
+
+        self.assertEqual(len(rewriter.memo), len(set(tokens)))
+
+    def test_ontology_snapshot(self):
+        queries = []
+        fingerprint = {'count': '4'}
+
+        def post(endpoint, data):
+            queries.append(data['query'])
+            if 'COUNT' in data['query']:
+                return PostMock({'results': {'bindings': [{'count': {'value': fingerprint['count']}}]}})
+            return PostMock(self.OCCUPATION_LINK_SPARQL_RESULTS)
+
+        expected = [(res['id']['value'], res['label']['value'])
+                    for res in self.OCCUPATION_LINK_SPARQL_RESULTS['results']['bindings']]
+
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch('requests.post', side_effect=post):
+            snapshot = os.path.join(tmpdir, 'occupations.json.gz')
+
+            self.assertEqual(get_occupation_ontology('', snapshot), expected)
+            self.assertEqual(len(queries), 2)
+
+            self.assertEqual(get_occupation_ontology('', snapshot), expected)
+            self.assertEqual(len(queries), 3)
+
+            fingerprint['count'] = '5'
+            self.assertEqual(get_occupation_ontology('', snapshot), expected)
+            self.assertEqual(len(queries), 5)
+            self.assertEqual(read_snapshot(snapshot)[0], '5|')
+
+            with mock.patch('requests.post', side_effect=requests.exceptions.ConnectionError):
+                self.assertEqual(get_occupation_ontology('', snapshot), expected)
+
     def test_harmonize_mapping(self):
         for (original, substitution) in occupation_mapping.items():
             self.assertEqual(_harmonize_labels(original, r'[,/]', occupation_mapping, occupation_substitutions),
@@ -241,20 +427,722 @@ class PersonRecordLinkageTest(unittest.TestCase):
     }
 
     def test_generate_persons_dict(self):
-        with mock.patch('requests.post', side_effect=lambda x, y: PostMock(self.WARSA_PERSONS_SPARQL_RESULTS)):
+        with mock.patch('requests.post', side_effect=lambda x, y, **kwargs: PostMock(self.WARSA_PERSONS_SPARQL_RESULTS)):
             results = _generate_persons_dict('http://sparql')
 
             self.assertEqual(results, self.EXPECTED_RESULTS, pprint.pformat(results))
 
+    def test_generate_persons_dict_paged(self):
+        queries = []
+
+        def post(endpoint, data, timeout=None):
+            self.assertIsNotNone(timeout)
+            prefix = re.search(r'MD5\(STR\(\?person\)\), "(\w*)"', data['query']).group(1)
+            queries.append(prefix)
+            bindings = [row for row in self.WARSA_PERSONS_SPARQL_RESULTS['results']['bindings']
+                        if hashlib.md5(row['person']['value'].encode('utf-8')).hexdigest().startswith(prefix)]
+            return PostMock({'results': {'bindings': bindings}})
+
+        with mock.patch('requests.post', side_effect=post):
+            results = _generate_persons_dict('http://sparql', prefix_length=2, workers=8)
+
+        self.assertEqual(len(queries), 256)
+        self.assertEqual(results, self.EXPECTED_RESULTS, pprint.pformat(results))
+
+    def test_generate_persons_dict_retry(self):
+        responses = [requests.exceptions.Timeout(), PostMock(self.WARSA_PERSONS_SPARQL_RESULTS)]
+
+        def post(endpoint, data, timeout=None):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        with mock.patch('requests.post', side_effect=post), mock.patch('time.sleep') as sleep:
+            results = _generate_persons_dict('http://sparql', prefix_length=0)
+
+        self.assertEqual(results, self.EXPECTED_RESULTS)
+        self.assertEqual(sleep.call_count, 1)
+
+        with mock.patch('requests.post', side_effect=requests.exceptions.Timeout), mock.patch('time.sleep'):
+            self.assertRaises(requests.exceptions.Timeout, _generate_persons_dict, 'http://sparql', prefix_length=0)
+
+    def test_persons_snapshot(self):
+        fingerprint = {'persons': '2'}
+        queries = []
+
+        def post(endpoint, data, timeout=None):
+            if 'COUNT' in data['query']:
+                queries.append('fingerprint')
+                return PostMock({'results': {'bindings': [{'persons': {'value': fingerprint['persons']},
+                                                           'triples': {'value': '30'}}]}})
+            queries.append('persons')
+            return PostMock(self.WARSA_PERSONS_SPARQL_RESULTS)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            snapshot = os.path.join(tmpdir, 'persons.npz')
+
+            with mock.patch('requests.post', side_effect=post):
+                self.assertEqual(load_persons('http://sparql', snapshot), self.EXPECTED_RESULTS)
+                self.assertEqual(list(dict.fromkeys(queries)), ['fingerprint', 'persons'])
+
+                header, persons = read_persons_snapshot(snapshot, verify=True)
+                self.assertEqual(persons, self.EXPECTED_RESULTS)
+                self.assertEqual(set(read_persons_snapshot(snapshot, compact=True)[1]), set(self.EXPECTED_RESULTS))
+                self.assertEqual(header['endpoint'], 'http://sparql')
+                self.assertEqual(header['remote_fingerprint'], '2|30')
+
+                queries.clear()
+                self.assertEqual(load_persons('http://sparql', snapshot), self.EXPECTED_RESULTS)
+                self.assertEqual(queries, ['fingerprint'])
+
+                queries.clear()
+                fingerprint['persons'] = '3'
+                self.assertEqual(load_persons('http://sparql', snapshot), self.EXPECTED_RESULTS)
+                self.assertEqual(list(dict.fromkeys(queries)), ['fingerprint', 'persons'])
+
+                queries.clear()
+                load_persons('http://sparql', snapshot, max_age=0)
+                self.assertEqual(list(dict.fromkeys(queries)), ['fingerprint', 'persons'])
+
+            with mock.patch('requests.post', side_effect=requests.exceptions.ConnectionError):
+                self.assertEqual(load_persons('http://sparql', snapshot), self.EXPECTED_RESULTS)
+
+            with mock.patch('requests.post', side_effect=AssertionError):
+                self.assertEqual(load_persons(None, snapshot), self.EXPECTED_RESULTS)
+                self.assertRaises(AssertionError, load_persons, 'http://other', snapshot)
+
+            with open(snapshot, 'wb') as f:
+                f.write(b'corrupted')
+            self.assertRaises(ValueError, load_persons, None, snapshot)
+            with mock.patch('requests.post', side_effect=post):
+                self.assertEqual(load_persons('http://sparql', snapshot), self.EXPECTED_RESULTS)
+            self.assertEqual(read_persons_snapshot(snapshot)[1], self.EXPECTED_RESULTS)
+
+    def test_compact_records(self):
+        with mock.patch('requests.post', side_effect=lambda x, y, **kwargs: PostMock(self.WARSA_PERSONS_SPARQL_RESULTS)):
+            results = _generate_persons_dict('http://sparql', compact=True)
+
+        self.assertEqual(set(results), set(self.EXPECTED_RESULTS))
+        for person, record in results.items():
+            self.assertIsInstance(record, PersonRecord)
+            expected = {key: tuple(value) if isinstance(value, list) else value
+                        for key, value in self.EXPECTED_RESULTS[person].items()}
+            self.assertEqual(dict(record), expected)
+
+        records = compact_records(self.EXPECTED_RESULTS)
+        documents = compact_records({'doc': {'given': 'Eino', 'family': 'Virtanen'}})
+        get_person_links(documents, records, [('doc', next(iter(records)))])
+        self.assertEqual(documents['doc']['person'], next(iter(records)))
+
+        documents = compact_records({'doc': {'family': 'Virtanen', 'casualty_id': 'c1', 'units': ['u1']}})
+        self.assertEqual(documents['doc']['casualty_id'], 'c1')
+        self.assertEqual(dict(documents['doc'])['units'], ('u1',))
+
+        dict_bytes, compact_bytes = measure_records_memory(synthetic_persons(2000))
+        self.assertLess(compact_bytes, dict_bytes)
+
+    def test_blocking(self):
+        documents = {
+            'doc/1': {'family': 'Lahdenperä', 'birth_begin': '1897-01-01', 'birth_end': '1897-01-01',
+                      'death_begin': None, 'death_end': None},
+            'doc/2': {'family': 'Hägglund', 'birth_begin': '1890-01-01', 'birth_end': '1890-01-01',
+                      'death_begin': '1962-05-04', 'death_end': '1962-05-04'},
+            'doc/3': {'family': 'Holmberg', 'birth_begin': '1920-01-01', 'birth_end': '1920-01-01',
+                      'death_begin': None, 'death_end': None},
+            'doc/4': {'family': 'Virtanen', 'birth_begin': None, 'birth_end': None,
+                      'death_begin': None, 'death_end': None},
+        }
+        persons = self.EXPECTED_RESULTS
+
+        blocks = list(PersonBlocker(persons, year_window=1).blocks(documents, persons))
+        pairs = sorted((doc[0], per[0]) for docs, pers in blocks for doc in docs for per in pers)
+
+        self.assertEqual(pairs, [('doc/1', 'http://ldf.fi/warsa/actors/person_3380'),
+                                 ('doc/2', 'http://ldf.fi/warsa/actors/person_4399'),
+                                 ('doc/3', 'http://ldf.fi/warsa/actors/person_1270')])
+        self.assertEqual(blocks[0][0][0][1], documents['doc/1'])
+
+        linker = mock.MagicMock()
+        linker.matchBlocks.side_effect = lambda blocks, threshold: [((docs[0][0], pers[0][0]), 0.9)
+                                                                    for docs, pers in blocks]
+        with mock.patch('warsa_linkers.person_record_linkage.init_linker', return_value=linker), \
+                mock.patch('warsa_linkers.person_record_linkage.load_persons', return_value=persons):
+            links = link_persons('http://sparql', documents, [], [], blocking_window=1)
+
+        self.assertFalse(linker.match.called)
+        self.assertEqual(len(links), 3)
+        self.assertIn((URIRef('doc/2'), CRM.P70_documents, URIRef('http://ldf.fi/warsa/actors/person_4399')), links)
+
+    def test_parallel_matching(self):
+        documents = {'doc/{}'.format(i): {'family': 'Virtanen', 'birth_begin': None, 'birth_end': None,
+                                          'death_begin': None, 'death_end': None} for i in range(3)}
+        documents['doc/3'] = {'family': 'Nurmi', 'birth_begin': None, 'birth_end': None,
+                              'death_begin': None, 'death_end': None}
+        persons = {'per/1': dict(documents['doc/0']), 'per/2': dict(documents['doc/3'])}
+
+        blocks = list(PersonBlocker(persons).blocks(documents, persons))
+        chunks = partition_blocks(blocks, chunk_size=1)
+        self.assertEqual([[docs[0][0] for docs, pers in chunk] for chunk in chunks],
+                         [['doc/0', 'doc/1', 'doc/2'], ['doc/3']])
+
+        def static_linker(settings, num_cores=None):
+            self.assertEqual(settings.read(), b'settings')
+            linker = mock.MagicMock()
+            # One-to-one: link each person to its first document only
+            linker.matchBlocks.side_effect = lambda blocks, threshold: [
+                ((doc_id, per_id), 0.9) for per_id, doc_id in
+                {pers[0][0]: docs[0][0] for docs, pers in reversed(list(blocks))}.items()]
+            return linker
+
+        linker = mock.MagicMock()
+        linker.writeSettings.side_effect = lambda f: f.write(b'settings')
+        with mock.patch('warsa_linkers.person_record_linkage.init_linker', return_value=linker), \
+                mock.patch('warsa_linkers.person_record_linkage.load_persons', return_value=persons), \
+                mock.patch('warsa_linkers.person_record_linkage.StaticRecordLink', side_effect=static_linker):
+            links = link_persons('http://sparql', documents, [], [], blocking_window=1, processes=2)
+
+        self.assertFalse(linker.match.called)
+        self.assertEqual(len(links), 2)
+        self.assertIn((URIRef('doc/3'), CRM.P70_documents, URIRef('per/2')), links)
+
+        with self.assertRaises(ValueError):
+            link_persons('http://sparql', documents, [], [], processes=2)
+
+    def test_incremental_linkage(self):
+        def record(family, birth):
+            return {'family': family, 'birth_begin': birth, 'birth_end': birth, 'death_begin': None,
+                    'death_end': None}
+
+        documents = {'doc/1': record('Virtanen', '1915-01-01'), 'doc/2': record('Nurmi', '1916-01-01'),
+                     'doc/3': record('Lahti', '1917-01-01'), 'doc/5': record('Koski', '1919-01-01')}
+        persons = {'per/1': record('Virtanen', '1915-01-01'), 'per/2': record('Nurmi', '1916-01-01'),
+                   'per/3': record('Laine', '1917-01-01')}
+
+        def match(docs, pers, threshold):
+            calls.append((sorted(docs), sorted(pers)))
+            return [((doc, per), 0.9) for doc in docs for per in pers if docs[doc] == pers[per]]
+
+        linker = mock.MagicMock()
+        linker.match.side_effect = match
+
+        def run(documents, persons):
+            with mock.patch('warsa_linkers.person_record_linkage.init_linker', return_value=linker), \
+                    mock.patch('warsa_linkers.person_record_linkage.load_persons', return_value=persons):
+                return link_persons('http://sparql', documents, [{'field': 'family', 'type': 'String'}], [],
+                                    link_state=state_file)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_file = os.path.join(tmpdir, 'links.json.gz')
+
+            calls = []
+            links = run(documents, persons)
+            self.assertEqual(len(links), 2)
+            self.assertEqual(len(calls), 1)
+
+            calls = []
+            links = run(documents, persons)
+            self.assertEqual(len(links), 2)
+            self.assertEqual(calls, [])
+
+            documents['doc/4'] = record('Laine', '1917-01-01')
+            persons['per/3'] = record('Lahti', '1917-01-01')
+            persons['per/2'] = record('Nurmi', '1918-01-01')
+            calls = []
+            links = run(documents, persons)
+
+            # doc/2 lost its link to the changed per/2, so it is rescored like a changed document
+            self.assertEqual(calls, [(['doc/2', 'doc/4'], ['per/2', 'per/3']),
+                                     (['doc/3', 'doc/5'], ['per/2', 'per/3'])])
+            self.assertEqual(sorted((str(s), str(o)) for s, o in links.subject_objects()),
+                             [('doc/1', 'per/1'), ('doc/3', 'per/3')])
+
+            # A person freed by a changed document is scored against the unchanged unlinked documents
+            documents['doc/6'] = record('Virtanen', '1915-01-01')
+            run(documents, persons)
+            documents['doc/1'] = record('Virtala', '1915-01-01')
+            calls = []
+            links = run(documents, persons)
+            self.assertEqual(calls, [(['doc/1'], ['per/1', 'per/2']),
+                                     (['doc/2', 'doc/4', 'doc/5', 'doc/6'], ['per/1'])])
+            self.assertEqual(sorted((str(s), str(o)) for s, o in links.subject_objects()),
+                             [('doc/3', 'per/3'), ('doc/6', 'per/1')])
+
+            with gzip.open(state_file, 'rt') as f:
+                self.assertEqual(json.load(f)['format'], 2)
+
+            # Unreadable or unsupported state files relink everything
+            for content in (b'not gzip', gzip.compress(b'{"links": '), gzip.compress(b'{"format": 1}'),
+                            gzip.compress(pickle.dumps({'format': 2}))):
+                with open(state_file, 'wb') as f:
+                    f.write(content)
+                calls = []
+                links = run(documents, persons)
+                self.assertEqual(len(calls), 1)
+                self.assertEqual(len(links), 2)
+
+    def test_normalize_comparator_fields(self):
+        documents = {'doc/1': {'family': 'Nurmi', 'rank': ['http://rank/1'], 'unit': ['http://unit/1']}}
+        persons = {'per/1': {'family': 'Nurmi', 'rank': ['http://rank/1'], 'unit': ['http://unit/1', 'http://unit/2']}}
+        fields = [{'field': 'rank', 'type': 'Set'},
+                  {'field': 'unit', 'type': 'Custom', 'comparator': intersection_comparator}]
+
+        linker = mock.MagicMock()
+        linker.match.return_value = []
+        with mock.patch('warsa_linkers.person_record_linkage.init_linker', return_value=linker) as init, \
+                mock.patch('warsa_linkers.person_record_linkage.load_persons', return_value=persons):
+            link_persons('http://sparql', documents, fields, [])
+
+        doc_data, per_data = init.call_args[0][3:5]
+        self.assertEqual(doc_data['doc/1']['rank'], ['http://rank/1'])
+        self.assertEqual(per_data['per/1']['unit'], frozenset(['http://unit/1', 'http://unit/2']))
+        self.assertEqual(documents['doc/1']['unit'], ['http://unit/1'])
+
+    def test_training_cache(self):
+        fields = [{'field': 'family', 'type': 'String'}]
+        documents = {'doc/1': {'family': 'Nurmi'}}
+        persons = {'per/1': {'family': 'Nurmi'}}
+
+        record_link = mock.MagicMock()
+        record_link.return_value.writeSettings.side_effect = lambda f: f.write(b'settings')
+        record_link.return_value.writeTraining.side_effect = lambda f: f.write('training')
+
+        def init(fields, links, cached_sample_size=None):
+            record_link.reset_mock(return_value=False, side_effect=False)
+            with mock.patch('warsa_linkers.person_record_linkage.RecordLink', record_link), \
+                    mock.patch('warsa_linkers.person_record_linkage.StaticRecordLink') as static_link, \
+                    mock.patch('warsa_linkers.person_record_linkage.trainingDataLink'):
+                linker = init_linker(fields, training_file, settings_file, documents, persons, 5000, 10,
+                                     training_links=links, cached_sample_size=cached_sample_size)
+            return linker, static_link
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            training_file = os.path.join(tmpdir, 'training.json')
+            settings_file = os.path.join(tmpdir, 'settings')
+
+            linker, static_link = init(fields, [('doc/1', 'per/1')])
+            self.assertIs(linker, record_link.return_value)
+            self.assertTrue(linker.train.called)
+            self.assertTrue(os.path.exists(settings_file + '.fingerprint'))
+
+            linker, static_link = init(fields, [('doc/1', 'per/1')])
+            self.assertIs(linker, static_link.return_value)
+            self.assertFalse(record_link.called)
+
+            linker, static_link = init(fields + [{'field': 'given', 'type': 'String'}], [('doc/1', 'per/1')])
+            self.assertIs(linker, record_link.return_value)
+            self.assertFalse(linker.readTraining.called)
+            self.assertTrue(linker.markPairs.called)
+            linker.sample.assert_called_once_with(documents, persons, sample_size=5000)
+
+            os.remove(settings_file)
+            linker, static_link = init(fields + [{'field': 'given', 'type': 'String'}], [('doc/1', 'per/1')])
+            self.assertTrue(linker.readTraining.called)
+            self.assertFalse(linker.markPairs.called)
+            self.assertTrue(linker.train.called)
+            linker.sample.assert_called_once_with(documents, persons, sample_size=5000)
+            calls = [name for name, args, kwargs in linker.mock_calls]
+            self.assertLess(calls.index('sample'), calls.index('readTraining'))
+
+            os.remove(settings_file)
+            linker, static_link = init(fields + [{'field': 'given', 'type': 'String'}], [('doc/1', 'per/1')],
+                                       cached_sample_size=1000)
+            self.assertTrue(linker.readTraining.called)
+            linker.sample.assert_called_once_with(documents, persons, sample_size=1000)
+
+            # Files without a fingerprint are not trusted
+            os.remove(settings_file + '.fingerprint')
+            os.remove(training_file + '.fingerprint')
+            linker, static_link = init(fields + [{'field': 'given', 'type': 'String'}], [('doc/1', 'per/1')])
+            self.assertIs(linker, record_link.return_value)
+            self.assertFalse(linker.readTraining.called)
+            self.assertTrue(linker.markPairs.called)
+            self.assertTrue(os.path.exists(settings_file + '.fingerprint'))
+            self.assertTrue(os.path.exists(training_file + '.fingerprint'))
+
+    def test_compact_training_data(self):
+        fields = [{'field': 'family', 'type': 'String'}]
+        documents = {'doc/1': {'family': 'Nurmi', 'rank': ['http://rank/1']}, 'doc/2': {'family': 'Virtanen'}}
+        persons = compact_records({'per/1': {'person': 'per/1', 'family': 'Nurmi'},
+                                   'per/2': {'person': 'per/2', 'family': 'Virtanen'}})
+
+        def to_json(value):
+            # Serializer of dedupe training data
+            if isinstance(value, (frozenset, tuple)):
+                return {'__class__': type(value).__name__, '__value__': list(value)}
+            raise TypeError('{!r} is not JSON serializable'.format(value))
+
+        class RecordLink:
+            def __init__(self, fields):
+                self.training_pairs = {'match': [], 'distinct': []}
+                self.classifier = mock.MagicMock()
+
+            def markPairs(self, pairs):
+                for label, examples in pairs.items():
+                    self.training_pairs[label].extend(examples)
+
+            def writeTraining(self, f):
+                json.dump(self.training_pairs, f, default=to_json)
+
+            def writeSettings(self, f):
+                f.write(b'settings')
+
+            def sample(self, *args, **kwargs):
+                pass
+
+            def train(self):
+                pass
+
+            def match(self, docs, pers, threshold):
+                return []
+
+        def training_data_link(docs, pers, common_key, training_size):
+            return {'match': [(doc, per) for doc in docs.values() for per in pers.values()
+                              if doc.get(common_key) == per[common_key]], 'distinct': []}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            training_file = os.path.join(tmpdir, 'training.json')
+            with mock.patch('warsa_linkers.person_record_linkage.RecordLink', RecordLink), \
+                    mock.patch('warsa_linkers.person_record_linkage.trainingDataLink', training_data_link), \
+                    mock.patch('warsa_linkers.person_record_linkage.load_persons', return_value=persons):
+                link_persons('http://sparql', documents, fields, [('doc/1', 'per/1')], compact=True,
+                             training_data_file=training_file)
+
+            with open(training_file) as f:
+                training = json.load(f)
+
+        self.assertEqual(len(training['match']), 1)
+        doc, per = training['match'][0]
+        self.assertEqual((doc['family'], doc['person'], per['person']), ('Nurmi', 'per/1', 'per/1'))
+        self.assertEqual(doc['rank'], ['http://rank/1'])
+
+
+class RankTest(unittest.TestCase):
+
+    RANKS = {
+        'kapteeni': 'http://ldf.fi/warsa/ranks/Kapteeni',
+        'aliluutnantti': 'http://ldf.fi/warsa/ranks/Aliluutnantti',
+        'Upseerikokelas': 'http://ldf.fi/warsa/ranks/Upseerikokelas',
+        'sotamies': 'http://ldf.fi/warsa/ranks/Sotamies',
+    }
+
+    def post(self, endpoint, data):
+        values = re.search(r'VALUES \?rank { "(.*)" }', data['query']).group(1).split('" "')
+        self.chunks.append(values)
+        return PostMock({'results': {'bindings': [{'rank': {'value': v}, 'id': {'value': self.RANKS[v]}}
+                                                  for v in values if v in self.RANKS]}})
+
+    def test_link_ranks(self):
+        source_prop = URIRef('http://rank')
+        target_prop = URIRef('http://rank_link')
+        ptype = URIRef('http://person')
+
+        graph = Graph()
+        for i, rank in enumerate(['kapteeni', 'aliluutn.', 'ups.kok.', 'sotamies', 'tuntematon', 'kapteeni']):
+            graph.add((URIRef('http://person/{}'.format(i)), source_prop, Literal(rank)))
+            graph.add((URIRef('http://person/{}'.format(i)), RDF.type, ptype))
+
+        self.chunks = []
+        with mock.patch.object(requests.Session, 'post', side_effect=self.post):
+            links = link_ranks(graph, 'http://endpoint', source_prop, target_prop, ptype, chunk_size=2, workers=2)
+
+        self.assertEqual(sorted(len(chunk) for chunk in self.chunks), [1, 2, 2])
+        self.assertEqual(len(links), 5)
+        self.assertIn((URIRef('http://person/2'), target_prop, URIRef(self.RANKS['Upseerikokelas'])), links)
+        self.assertIsNone(links.value(URIRef('http://person/4'), target_prop))
+
+    def test_link_ranks_one_per_resource(self):
+        source_prop = URIRef('http://rank')
+        target_prop = URIRef('http://rank_link')
+        ptype = URIRef('http://person')
+
+        graph = Graph()
+        for rank in ['kapteeni', 'aliluutn.', 'sotamies']:
+            graph.add((URIRef('http://person/0'), source_prop, Literal(rank)))
+        graph.add((URIRef('http://person/0'), RDF.type, ptype))
+
+        self.chunks = []
+        with mock.patch.object(requests.Session, 'post', side_effect=self.post):
+            links = link_ranks(graph, 'http://endpoint', source_prop, target_prop, ptype)
+
+        self.assertEqual(len(links), 1)
+        self.assertIn(links.value(URIRef('http://person/0'), target_prop),
+                      [URIRef(self.RANKS[rank]) for rank in ['kapteeni', 'aliluutnantti', 'sotamies']])
+
+    def test_link_ranks_offline(self):
+        source_prop = URIRef('http://rank')
+        target_prop = URIRef('http://rank_link')
+        ptype = URIRef('http://person')
+
+        rank_graph = Graph()
+        for label, uri in self.RANKS.items():
+            rank_graph.add((URIRef(uri), RDF.type, URIRef('http://ldf.fi/schema/warsa/Rank')))
+            rank_graph.add((URIRef(uri), SKOS.prefLabel, Literal(label.capitalize(), lang='fi')))
+        rank_graph.add((URIRef(self.RANKS['sotamies']), SKOS.altLabel, Literal('stm.')))
+        resolver = RankResolver.from_graph(rank_graph)
+
+        graph = Graph()
+        for i, rank in enumerate(['kapteeni', 'aliluutn.', 'ups.kok.', 'stm.', 'tuntematon', 'Kapteenni']):
+            graph.add((URIRef('http://person/{}'.format(i)), source_prop, Literal(rank)))
+            graph.add((URIRef('http://person/{}'.format(i)), RDF.type, ptype))
+
+        with mock.patch.object(requests.Session, 'post', side_effect=AssertionError):
+            links = link_ranks(graph, None, source_prop, target_prop, ptype, resolver=resolver)
+
+        self.assertEqual(len(links), 5)
+        self.assertEqual(links.value(URIRef('http://person/3'), target_prop), URIRef(self.RANKS['sotamies']))
+        self.assertEqual(links.value(URIRef('http://person/5'), target_prop), URIRef(self.RANKS['kapteeni']))
+        self.assertIsNone(links.value(URIRef('http://person/4'), target_prop))
+
+
+class MunicipalityTest(unittest.TestCase):
+
+    def test_link_to_pnr(self):
+        target_prop = URIRef('http://pnr_link')
+        municipality = URIRef('http://municipality')
+        pnr = {'Tornio': 'http://pnr/tornio', 'Turku': 'http://pnr/turku'}
+        arpa = mock.MagicMock()
+        arpa.query.side_effect = lambda text: {'results': [{'id': pnr[text]}] if text in pnr else []}
+        validated = []
+
+        def process_graph(graph, target_prop, arpa, new_graph=False, source_prop=None, rdf_class=None,
+                          preprocessor=None, validator=None, progress=None):
+            self.assertTrue(progress)
+            links = Graph()
+            for s in set(graph.subjects(source_prop)):
+                if rdf_class and (s, RDF.type, rdf_class) not in graph:
+                    continue
+                text = preprocessor(graph.value(s, source_prop), s, graph)
+                validated.append(s)
+                for result in arpa.query(text)['results']:
+                    links.add((s, target_prop, URIRef(result['id'])))
+            return {'graph': links, 'matches': [], 'errors': []}
+
+        graph = Graph()
+        for i, label in enumerate(['Alatornio', 'Tornio', 'Karunki', 'Turku', 'Foobar']):
+            graph.add((URIRef('http://muni/{}'.format(i)), SKOS.prefLabel, Literal(label)))
+            graph.add((URIRef('http://muni/{}'.format(i)), RDF.type, municipality))
+        graph.add((URIRef('http://muni/0'), SKOS.altLabel, Literal('Nedertorneå')))
+        graph.add((URIRef('http://other'), SKOS.prefLabel, Literal('Turku')))
+
+        with mock.patch('warsa_linkers.municipalities.process_graph', side_effect=process_graph):
+            result = link_to_pnr(graph, target_prop, None, arpa, new_graph=True, workers=2,
+                                 rdf_class=municipality, validator=mock.MagicMock())
+
+        self.assertEqual(sorted(call[0][0] for call in arpa.query.call_args_list), ['Foobar', 'Tornio', 'Turku'])
+        self.assertEqual(sorted(validated), [URIRef('http://muni/{}'.format(i)) for i in range(5)])
+        self.assertEqual(len(result['graph']), 4)
+        for i in range(3):
+            self.assertEqual(result['graph'].value(URIRef('http://muni/{}'.format(i)), target_prop),
+                             URIRef(pnr['Tornio']))
+        self.assertIsNone(result['graph'].value(URIRef('http://other'), target_prop))
+
+    def test_link_to_pnr_prefetch_error(self):
+        target_prop = URIRef('http://pnr_link')
+        failures = {'Turku': 1, 'Foobar': 2}
+
+        def query(text):
+            if failures.get(text):
+                failures[text] -= 1
+                raise RuntimeError('ARPA failed')
+            return {'results': [{'id': 'http://pnr/' + text}]}
+
+        arpa = mock.MagicMock()
+        arpa.query.side_effect = query
+
+        def process_graph(graph, target_prop, arpa, new_graph=False, source_prop=None, rdf_class=None,
+                          preprocessor=None, progress=None):
+            links = Graph()
+            errors = []
+            for s in set(graph.subjects(source_prop)):
+                text = preprocessor(graph.value(s, source_prop), s, graph)
+                try:
+                    results = arpa.query(text)['results']
+                except RuntimeError as e:
+                    errors.append(str(e))
+                    continue
+                for result in results:
+                    links.add((s, target_prop, URIRef(result['id'])))
+            return {'graph': links, 'matches': [], 'errors': errors}
+
+        graph = Graph()
+        for label in ['Tornio', 'Turku', 'Foobar']:
+            graph.add((URIRef('http://muni/' + label), SKOS.prefLabel, Literal(label)))
+
+        with mock.patch('warsa_linkers.municipalities.process_graph', side_effect=process_graph):
+            result = link_to_pnr(graph, target_prop, None, arpa, new_graph=True, workers=2)
+
+        self.assertEqual(result['errors'], ['ARPA failed'])
+        self.assertEqual(result['graph'].value(URIRef('http://muni/Turku'), target_prop), URIRef('http://pnr/Turku'))
+        self.assertEqual(result['graph'].value(URIRef('http://muni/Tornio'), target_prop),
+                         URIRef('http://pnr/Tornio'))
+        self.assertIsNone(result['graph'].value(URIRef('http://muni/Foobar'), target_prop))
+
+    def test_warsa_municipality_index(self):
+        warsa_munics = Graph()
+        warsa_munics.add((URIRef('http://muni/Espoo'), SKOS.prefLabel, Literal('Espoo', lang='fi')))
+        warsa_munics.add((URIRef('http://muni/Esbo'), SKOS.prefLabel, Literal('Esbo', lang='sv')))
+        warsa_munics.add((URIRef('http://muni/Turku'), SKOS.prefLabel, Literal('Turku')))
+        warsa_munics.add((URIRef('http://muni/Pyhäjärvi_1'), SKOS.prefLabel, Literal('Pyhäjärvi')))
+        warsa_munics.add((URIRef('http://muni/Pyhäjärvi_2'), SKOS.prefLabel, Literal('Pyhäjärvi', lang='fi')))
+        warsa_munics.add((URIRef('http://muni/Oulu_mlk'), SKOS.prefLabel, Literal('Oulun mlk', lang='fi')))
+
+        label_lists = [
+            ['Espoo'],
+            ['Esbo'],
+            [' Turku '],
+            ['Pyhäjärvi'],
+            ['Oulun kunta'],
+            ['Espoo', 'Turku'],
+            ['Kemi'],
+            ['Foobar'],
+            [],
+        ]
+        index = WarsaMunicipalityIndex(warsa_munics, mapping={'Kemi': URIRef('http://muni/Kemi')})
+        links = index.link_many(label_lists)
+
+        self.assertEqual(links, [
+            URIRef('http://muni/Espoo'),
+            None,
+            URIRef('http://muni/Turku'),
+            None,
+            URIRef('http://muni/Oulu_mlk'),
+            None,
+            URIRef('http://muni/Kemi'),
+            None,
+            None,
+        ])
+        with mock.patch.dict('warsa_linkers.municipalities.MUNICIPALITY_MAPPING',
+                             {'Kemi': URIRef('http://muni/Kemi')}, clear=True):
+            self.assertEqual(links, [link_warsa_municipality(warsa_munics, labels) for labels in label_lists])
+
+
+class ArpaCacheTest(unittest.TestCase):
+
+    def test_cached_post(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cache = ArpaCache(tmp.name, version='test')
+        arpa_results = {'results': [{'id': 'http://ldf.fi/warsa/actors/actor_940', 'label': 'JR 8'}]}
+
+        patcher = mock.patch('requests.post', return_value=PostMock(arpa_results, b'{"results": []}'))
+        post = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(install(cache))
+
+        self.assertEqual(requests.post('http://arpa', {'text': 'JR 8'}).json(), arpa_results)
+        self.assertEqual(requests.post('http://arpa', {'text': 'JR 8'}).json(), {'results': []})
+        requests.post('http://sparql', {'query': 'SELECT * {}'})
+        requests.post('http://sparql', {'query': 'SELECT * {}'})
+
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_uninstall(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        post = requests.post
+
+        uninstall = install(ArpaCache(tmp.name))
+        self.assertIsNot(requests.post, post)
+        uninstall()
+        self.assertIs(requests.post, post)
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_record_and_replay(self):
+        import requests
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        original = os.path.join(tmp.name, 'original.jsonl.gz')
+        recorded = os.path.join(tmp.name, 'recorded.jsonl.gz')
+        content = '{"results": [{"label": "JR 8"}]}'
+
+        with gzip.open(original, 'wt', encoding='utf-8') as f:
+            entry = {'key': request_key('POST', '/arpa', 'text=JR+8'), 'status': 200,
+                     'content_type': 'application/json', 'content': content}
+            f.write(json.dumps(entry) + '\n')
+
+        server = make_server(read_archive(original), latency=0.01)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://localhost:{}'.format(server.server_address[1])
+
+        with Recorder(recorded):
+            self.assertEqual(requests.post(url + '/arpa', {'text': 'JR 8'}).json(), json.loads(content))
+            self.assertEqual(requests.post(url + '/arpa', {'text': 'JR 9'}).status_code, 404)
+
+        server.shutdown()
+        server.server_close()
+
+        self.assertEqual(read_archive(recorded)[request_key('POST', '/arpa', 'text=JR%208')],
+                         (200, 'application/json', content.encode('utf-8')))
+
 
 class PostMock:
 
-    def __init__(self, results):
+    def __init__(self, results, content=b''):
         self.results = results
+        self.content = content
+        self.status_code = 200
 
     def json(self):
         return self.results
 
+    def raise_for_status(self):
+        pass
+
+
+def synthetic_persons(n):
+    """
+    Generate persons with a realistic amount of repetition in values, for benchmarking.
+    """
+    persons = {}
+    for i in range(n):
+        uri = 'http://ldf.fi/warsa/actors/person_{}'.format(i)
+        persons[uri] = {
+            'person': uri,
+            'given': 'Etunimi{}'.format(i % 500),
+            'family': 'Sukunimi{}'.format(i % 5000),
+            'rank': ['http://ldf.fi/warsa/actors/ranks/Rank{}'.format(i % 60)],
+            'rank_level': i % 20,
+            'birth_place': ['http://ldf.fi/warsa/places/municipalities/m_place_{}'.format(i % 600)],
+            'birth_begin': '19{:02d}-{:02d}-{:02d}'.format(i % 30, i % 12 + 1, i % 28 + 1),
+            'birth_end': '19{:02d}-{:02d}-{:02d}'.format(i % 30, i % 12 + 1, i % 28 + 1),
+            'death_begin': '194{}-{:02d}-{:02d}'.format(i % 5, i % 12 + 1, i % 28 + 1),
+            'death_end': '194{}-{:02d}-{:02d}'.format(i % 5, i % 12 + 1, i % 28 + 1),
+            'death_place': ['http://ldf.fi/warsa/places/municipalities/m_place_{}'.format(i % 700)],
+            'activity_end': None,
+            'unit': ['http://ldf.fi/warsa/actors/actor_{}'.format(i % 3000)],
+            'occupation': ['http://ldf.fi/warsa/occupations/{}'.format(i % 400)],
+        }
+    return persons
+
+
+def measure_records_memory(persons):
+    """
+    Measure memory allocated for a persons dict in the plain dict layout and as PersonRecords.
+
+    :param persons: persons dict
+    :return: tuple of bytes allocated for dicts and for PersonRecords
+    """
+    serialized = pickle.dumps(dict(persons))
+
+    tracemalloc.start()
+    dicts = pickle.loads(serialized)
+    dict_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del dicts
+
+    tracemalloc.start()
+    records = compact_records(pickle.loads(serialized))
+    compact_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+
+    return dict_size, compact_size
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#  -*- coding: UTF-8 -*-
+"""
+Link military units in texts by scanning them against a local gazetteer of WarSampo unit labels.
+
+An alternative to querying ARPA with every n-gram: all unit labels and cover numbers are compiled
+into an Aho-Corasick automaton, which finds all mentions in a text in one pass. The hits are then
+validated with units.Validator.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+from collections import defaultdict, deque
+
+import requests
+from rdflib import Graph, URIRef
+from rdflib.namespace import SKOS
+from rdflib.util import guess_format
+
+from warsa_linkers.units import Validator, preprocessor, ignore as units_ignore
+
+log = logging.getLogger(__name__)
+
+COVERNUMBER = 'http://ldf.fi/schema/warsa/actors/covernumber'
+
+TOKEN_RE = re.compile(r'[^\s/]+')
+TOKEN_STRIP = '()[]{}"\'!?;:,'
+
+
+def get_dump_query():
+    with open(os.path.join(os.path.dirname(__file__), 'units_dump.sparql')) as f:
+        return f.read()
+
+
+def normalize_label(label):
+    """
+    Normalize a unit label the same way as the ARPA unit query does.
+
+    >>> normalize_label('1./JR 10.')
+    '1jr10'
+    >>> normalize_label('III/KTR 11')
+    'iiiktr11'
+    """
+    return re.sub(r'[,./\s]', '', label).lower()
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton for finding all occurrences of a set of keys in a text in linear time.
+
+    >>> a = Automaton()
+    >>> a.add('jr8', 'JR 8')
+    >>> a.add('8', 'cover 8')
+    >>> a.build()
+    >>> list(a.iter('ajr8'))
+    [(1, 4, 'JR 8'), (3, 4, 'cover 8')]
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+
+    def add(self, key, value):
+        state = 0
+        for char in key:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            state = next_state
+        self.out[state].append((len(key), value))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    def iter(self, text):
+        """
+        Iterate over all occurrences of keys in the text.
+
+        :return: generator of (start, end, value) tuples
+        """
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for length, value in self.out[state]:
+                yield i + 1 - length, i + 1, value
+
+
+def read_units_dump(path):
+    """
+    Read units from a SPARQL JSON result file of the units_dump.sparql query.
+
+    :return: list of (unit URI, label, is cover number, set of wars) tuples
+    """
+    with open(path) as f:
+        bindings = json.load(f)['results']['bindings']
+
+    wars = defaultdict(set)
+    for row in bindings:
+        key = (row['id']['value'], row['label']['value'], row['label_prop']['value'] == COVERNUMBER)
+        if 'war' in row:
+            wars[key].add(row['war']['value'])
+        else:
+            wars[key]
+
+    log.info('Read {} unit labels from {}'.format(len(wars), path))
+
+    return [key + (war,) for key, war in wars.items()]
+
+
+class UnitGazetteer:
+    """
+    Find unit mentions in preprocessed texts.
+
+    Mentions are aligned to tokens (separated by whitespace and slashes), and returned in the same format
+    as ARPA results, so that they can be validated with units.Validator.
+
+    >>> gazetteer = UnitGazetteer([('http://unit/1', 'JR 8', False, set()),
+    ...                            ('http://unit/2', '3100', True, {'http://ldf.fi/warsa/conflicts/WinterWar'})])
+    >>> [(r['id'], r['matches']) for r in gazetteer.scan('Tsto 2./JR 8. ja 3100.')]
+    [('http://unit/1', ['JR 8.']), ('http://unit/2', ['3100.'])]
+    >>> gazetteer.scan('JR 81 ja 31.00')
+    []
+    """
+
+    def __init__(self, units, ignore=None):
+        self.ignore = set(i.lower() for i in ignore or ())
+        self.automaton = Automaton()
+        self.units = []
+
+        for unit_id, label, is_cover, wars in units:
+            key = normalize_label(label)
+            if key:
+                self.automaton.add(key, len(self.units))
+                self.units.append((unit_id, label, is_cover, wars))
+
+        self.automaton.build()
+
+    def tokenize(self, text):
+        """
+        :return: list of (start, end) spans of tokens and the normalized token stream with token boundaries
+        """
+        spans = []
+        stream = []
+        starts = {}
+        ends = {}
+        offset = 0
+        for m in TOKEN_RE.finditer(text):
+            token = m.group().strip(TOKEN_STRIP)
+            norm = normalize_label(token)
+            if not norm:
+                continue
+            start = m.start() + m.group().index(token)
+            starts[offset] = len(spans)
+            offset += len(norm)
+            ends[offset] = len(spans)
+            spans.append((start, start + len(token)))
+            stream.append(norm)
+
+        return spans, ''.join(stream), starts, ends
+
+    def is_valid_ngram(self, ngram):
+        if ngram.lower() in self.ignore:
+            return False
+        return len(ngram) > 2 or len(ngram) > 1 and ngram.upper() == ngram
+
+    def scan(self, text):
+        """
+        Find all unit mentions in the text.
+
+        :param text: preprocessed text
+        :return: list of ARPA style results
+        """
+        spans, stream, starts, ends = self.tokenize(text)
+        results = {}
+
+        for start, end, index in self.automaton.iter(stream):
+            if start not in starts or end not in ends:
+                continue
+            ngram = text[spans[starts[start]][0]:spans[ends[end]][1]]
+            unit_id, label, is_cover, wars = self.units[index]
+
+            if is_cover and re.sub(r'\.$', '', ngram) != label:
+                continue
+            if not self.is_valid_ngram(ngram):
+                continue
+
+            result = results.get(unit_id)
+            if result is None:
+                result = results[unit_id] = {'id': unit_id, 'label': label, 'matches': [], 'properties': {}}
+                if wars:
+                    result['properties']['war'] = ['<{}>'.format(war) for war in sorted(wars)]
+            if ngram not in result['matches']:
+                result['matches'].append(ngram)
+            result['properties'].setdefault('label', [])
+            if '"{}"'.format(label) not in result['properties']['label']:
+                result['properties']['label'].append('"{}"'.format(label))
+
+        return list(results.values())
+
+
+def link_units(graph, gazetteer, target_prop, source_prop=SKOS.prefLabel, validator=None, preprocess=preprocessor):
+    """
+    Link units in graph using the gazetteer.
+
+    :param graph: Data in RDFLib Graph object
+    :param gazetteer: UnitGazetteer
+    :param target_prop: Property to use for writing found links
+    :param source_prop: Property of texts to link
+    :param validator: Validator instance, by default units.Validator for the graph
+    :param preprocess: Text preprocessor
+    :return: RDFLib Graph with found links
+    """
+    validator = validator or Validator(graph)
+    links = Graph()
+
+    for s, text in graph.subject_objects(source_prop):
+        text = preprocess(str(text)) if preprocess else str(text)
+        results = gazetteer.scan(text)
+        for unit in validator.validate(results, text, s):
+            links.add((s, target_prop, URIRef(unit['id'])))
+
+    log.info('Found {} unit links'.format(len(links)))
+
+    return links
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Unit linking with a local unit gazetteer')
+    argparser.add_argument('--loglevel', default='INFO', help='Logging level')
+    subparsers = argparser.add_subparsers(dest='command')
+
+    dump_parser = subparsers.add_parser('dump', help='Fetch unit labels from a SPARQL endpoint')
+    dump_parser.add_argument('endpoint', help='SPARQL Endpoint')
+    dump_parser.add_argument('output', help='Output JSON file')
+
+    link_parser = subparsers.add_parser('link', help='Link units in an RDF file')
+    link_parser.add_argument('dump', help='Unit dump JSON file')
+    link_parser.add_argument('input', help='Input RDF file')
+    link_parser.add_argument('output', help='Output file location')
+    link_parser.add_argument('target_prop', help='Target property')
+    link_parser.add_argument('--prop', default=str(SKOS.prefLabel), help='Source property')
+    link_parser.add_argument('--no_cover', action='store_true', help='Reject units matched by cover number')
+    link_parser.add_argument('--no_length_filter', action='store_true', help='Do not reject short matches')
+    link_parser.add_argument('--naive', action='store_true', help='No preprocessing and ignored labels')
+
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.command == 'dump':
+        results = requests.post(args.endpoint, {'query': get_dump_query()}).json()
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
+    elif args.command == 'link':
+        Validator.accept_cover = not args.no_cover
+        Validator.filter_by_length = not args.no_length_filter
+
+        input_graph = Graph()
+        input_graph.parse(args.input, format=guess_format(args.input))
+
+        gazetteer = UnitGazetteer(read_units_dump(args.dump), ignore=None if args.naive else units_ignore)
+        links = link_units(input_graph, gazetteer, URIRef(args.target_prop), source_prop=URIRef(args.prop),
+                           preprocess=None if args.naive else preprocessor)
+
+        links.serialize(args.output, format=guess_format(args.output))
+    else:
+        argparser.print_help()
@@ -3,9 +3,11 @@ import re
 import sys
 import logging
 import roman
+from collections import namedtuple
 from rdflib import URIRef
 from arpa_linker.link_helper import process_stage
 from warsa_linkers.persons import get_ranked_matches
+from warsa_linkers.arpa_cache import setup_cache
 
 logger = logging.getLogger('arpa_linker.arpa')
 
@@ -18,8 +20,14 @@ def get_query_template():
         return f.read()
 
 
+# Numeral conversion tables, precomputed for the range supported by roman
+INT_TO_ROMAN = {i: roman.toRoman(i) for i in range(1, 5000)}
+ROMAN_TO_INT = {r: i for i, r in INT_TO_ROMAN.items()}
+
+
 def roman_repl(m):
-    return roman.toRoman(int(m.group(1)))
+    number = int(m.group(1))
+    return INT_TO_ROMAN.get(number) or roman.toRoman(number)
 
 
 def roman_repl_w_space(m):
@@ -27,10 +35,8 @@ def roman_repl_w_space(m):
 
 
 def int_from_roman_repl(m):
-    try:
-        return str(roman.fromRoman(m.group(1)))
-    except roman.InvalidRomanNumeralError:
-        return ''
+    number = ROMAN_TO_INT.get(m.group(1))
+    return str(number) if number else ''
 
 
 def get_match_scores(results):
@@ -103,6 +109,137 @@ def preprocessor(text, *args):
     return text
 
 
+UnitDesignation = namedtuple('UnitDesignation', ['unit_type', 'number', 'subunit'])
+
+UNIT_DESIGNATION_RE = re.compile(r"""
+    (?<![\w.])
+    (?:(?P<subunit>(?:\d+\.?|[IVX]+|[A-ZÄÖ]\w*)(?:/(?:\d+\.?|[IVX]+))*)/)?
+    (?:
+        (?P<jr>J[RrPp])\ (?P<jr_number>\d+)
+      | (?P<number>\d+)\.\ (?P<unit_type>DE|D|Pr|KS|[Kk]enttäsairaala\w*)(?!\w)
+      | (?P<ak_number>[IVX]+)\ (?P<ak>AKE?)\b
+      | LLv\ (?P<llv_number>\d+)\ \#\ LeLv\ (?P=llv_number)\b
+      | (?P<rpr_number>\d+)\.RPr\.(?P<rpr_subunit>E)?
+    )
+    """, re.X)
+
+
+def parse_unit_designations(text):
+    """
+    Parse unit designations from preprocessed text in a single pass.
+
+    API only: the linkers send the normalized text of preprocessor to ARPA and do not use the parsed keys.
+
+    :param text: text normalized by preprocessor
+    :return: list of UnitDesignation (unit type, number, subunit) tuples
+
+    >>> parse_unit_designations('1./JR 10.')
+    [UnitDesignation(unit_type='JR', number=10, subunit='1.')]
+    >>> parse_unit_designations('2./I/15. Pr. ja VII AKE')
+    [UnitDesignation(unit_type='Pr', number=15, subunit='2./I'), UnitDesignation(unit_type='AKE', number=7, subunit=None)]
+    >>> [tuple(d) for d in parse_unit_designations('35. Kenttäsairaala, LLv 14 # LeLv 14 ja 2.RPr.E')]
+    [('KS', 35, None), ('LLv', 14, None), ('RPr', 2, 'E')]
+    >>> parse_unit_designations('klo 8.52 pistooli m/41.')
+    []
+    """
+    designations = []
+    for m in UNIT_DESIGNATION_RE.finditer(text):
+        subunit = m.group('subunit')
+        if m.group('jr'):
+            unit_type, number = m.group('jr').upper(), int(m.group('jr_number'))
+        elif m.group('unit_type'):
+            unit_type, number = m.group('unit_type'), int(m.group('number'))
+            if unit_type.lower().startswith('kenttäsairaala'):
+                unit_type = 'KS'
+        elif m.group('ak'):
+            unit_type, number = m.group('ak'), ROMAN_TO_INT.get(m.group('ak_number'))
+        elif m.group('llv_number'):
+            unit_type, number = 'LLv', int(m.group('llv_number'))
+        else:
+            unit_type, number, subunit = 'RPr', int(m.group('rpr_number')), m.group('rpr_subunit')
+        designations.append(UnitDesignation(unit_type, number, subunit))
+
+    return designations
+
+
+def format_unit_designation(designation):
+    """
+    Format a unit designation as normalized text, as produced by preprocessor.
+
+    API only, like parse_unit_designations.
+
+    >>> format_unit_designation(UnitDesignation('JR', 10, '1.'))
+    '1./JR 10'
+    >>> format_unit_designation(UnitDesignation('Pr', 15, '2./I'))
+    '2./I/15. Pr'
+    >>> format_unit_designation(UnitDesignation('AKE', 7, None))
+    'VII AKE'
+    >>> format_unit_designation(UnitDesignation('LLv', 14, None))
+    'LLv 14 # LeLv 14'
+    >>> format_unit_designation(UnitDesignation('RPr', 2, 'E'))
+    '2.RPr.E'
+    """
+    unit_type, number, subunit = designation
+    if unit_type in ('JR', 'JP'):
+        text = '{} {}'.format(unit_type, number)
+    elif unit_type in ('AK', 'AKE'):
+        return '{} {}'.format(INT_TO_ROMAN.get(number, number), unit_type)
+    elif unit_type == 'LLv':
+        return 'LLv {n} # LeLv {n}'.format(n=number)
+    elif unit_type == 'RPr':
+        return '{}.RPr.{}'.format(number, subunit or '')
+    else:
+        text = '{}. {}'.format(number, unit_type)
+
+    return '{}/{}'.format(subunit, text) if subunit else text
+
+
+def parse_units(text):
+    """
+    Preprocess text and parse the unit designations in it.
+
+    :return: tuple of normalized text and list of UnitDesignation
+
+    >>> parse_units('JR II')
+    ('JR 2', [UnitDesignation(unit_type='JR', number=2, subunit=None)])
+    """
+    text = preprocessor(text)
+    return text, parse_unit_designations(text)
+
+
+class NumberContext:
+    """
+    Numbers of a caption with their context, for checking cover numbers with dict lookups.
+
+    Numbers preceded by "n." or "noin" are stored by all their prefixes, and numbers followed by
+    a unit of measure by all their suffixes, matching the unanchored regular expressions
+    of the cover number check.
+
+    >>> ctx = NumberContext('noin 2010 miestä ja 3030 m', re.compile(r'\\s*(m|miestä)\\b', re.I))
+    >>> sorted(ctx.marked)
+    ['2', '20', '201', '2010']
+    >>> sorted(ctx.measured.items())
+    [('0', 'miestä'), ('010', 'miestä'), ('030', 'm'), ('10', 'miestä'), ('2010', 'miestä'), ('30', 'm'), ('3030', 'm')]
+    """
+    marker_re = re.compile(r'\bn(?:\.|oin)?\s*(?=\d)', re.I)
+    number_re = re.compile(r'\d+')
+
+    def __init__(self, text, measure_re):
+        self.marked = set()
+        self.measured = {}
+
+        marker_ends = {m.end() for m in self.marker_re.finditer(text)}
+
+        for m in self.number_re.finditer(text):
+            number = m.group()
+            if m.start() in marker_ends:
+                self.marked.update(number[:i] for i in range(1, len(number) + 1))
+            measure = measure_re.match(text, m.end())
+            if measure:
+                for i in range(len(number)):
+                    self.measured.setdefault(number[i:], measure.group(1))
+
+
 class Validator:
     accept_cover = True
     filter_by_length = True
@@ -112,6 +249,13 @@ class Validator:
         self.known_covers = (1812, 1814,)
         self.known_wrong_covers = (1000, 2000, 3000, 4000, 6000, 10000, 16)
         self.cover_re = r'\s*(-|valistusta|kpl|kappale(tta|en)|tonni[na]?|(m(etri([än]|stä)?|eter)?)|kg|(kilo[na]?)|([lL](itra[an])?)|mk|markkaa|vankia|(watt?i[na]?)|(nime[än])|mie(hen|stä))\b'
+        self.measure_re = re.compile(self.cover_re, re.I)
+        self._number_context = (None, None)
+
+    def get_number_context(self, text):
+        if self._number_context[0] != text:
+            self._number_context = (text, NumberContext(text, self.measure_re))
+        return self._number_context[1]
 
     def check_cover(self, cover, text):
         try:
@@ -123,9 +267,11 @@ class Validator:
         except ValueError:
             return None
 
-        if re.search(r'\bn(\.|oin)?\s*' + cover, text, re.I):
-            return False
-        if re.search(cover + self.cover_re, text, re.I):
+        if NumberContext.number_re.fullmatch(cover):
+            context = self.get_number_context(text)
+            if cover in context.marked or cover in context.measured:
+                return False
+        elif re.search(r'\bn(\.|oin)?\s*' + cover, text, re.I) or re.search(cover + self.cover_re, text, re.I):
             return False
 
         logger.info('Matched by cover number ({})'.format(cover))
@@ -196,6 +342,8 @@ if __name__ == '__main__':
         doctest.testmod()
         exit()
 
+    setup_cache(sys.argv, preprocessor)
+
     special_args = sys.argv[-2:]
     if 'no_cover' in special_args:
         Validator.accept_cover = False